@@ -2,6 +2,7 @@ from stimulant_noise.stimulant_noise import run
 import os
 
 import logging
+import sys
 
 if __name__ == "__main__":
     loggin_file = "stimulant_noise.log"
@@ -10,7 +11,7 @@ if __name__ == "__main__":
     os.environ["PYTHONUNBUFFERED"] = "1"
     os.environ["GIN_MODE"] = "release"
     try:
-        run()
+        run(headless="--headless" in sys.argv, startup_report="--startup-report" in sys.argv)
     except Exception as e:
         logging.exception(e)
         raise e
@@ -0,0 +1,293 @@
+import os
+import sys
+import json
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import platform
+import queue
+
+# Headless: no sound card, no keyboard hook, no window. Has to be set before pygame and pynput are imported.
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYNPUT_BACKEND", "dummy")
+
+try:
+    import resource
+except ImportError:
+    # Windows, peak RSS is reported as null
+    resource = None
+
+import pynput
+import pygame as pg
+
+from stimulant_noise.settings import (InternalSettings, PresetsManagerSettings, PresetSettings, HotkeySettings,
+                                      flush_all)
+from stimulant_noise.preset import PresetsManager
+from stimulant_noise.hotkeys import Hotkeys, ACTIONS
+from stimulant_noise.pressed_keys import VK_BASE
+from stimulant_noise.sound_cache import sound_cache
+from stimulant_noise.mixer import array_cache
+from stimulant_noise.streaming import stop_stream_pump
+from stimulant_noise.generators import NoiseGenerator, GENERATORS, generators_available
+# Headless benchmarks for startup, preset switching and persistence. python benchmark.py [output.json]
+
+SOUNDS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "sounds"))
+PRESET_COUNTS = (10, 100, 1000)
+SWITCH_PRESETS = 12
+SAVE_STORM = 5000
+# Hotkeys bound for bench_hotkeys, keys plain typing never reaches
+HOTKEY_KEYS = {"next": "1", "previous": "2", "mute": "3"}
+
+
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes everywhere but macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def summary(samples):
+    samples = [sample * 1000 for sample in samples]
+    return {
+        "count": len(samples),
+        "mean_ms": statistics.mean(samples),
+        "median_ms": statistics.median(samples),
+        "max_ms": max(samples),
+    }
+
+
+class Library:
+    # Throwaway working directory with generated presets, the program runs in it as if it was its install folder
+    def __init__(self, presets_count, internal_settings=None, seed=0):
+        self.root = tempfile.mkdtemp(prefix="stimulant_noise_bench_")
+        self.previous_dir = os.getcwd()
+        os.chdir(self.root)
+        settings = {"sounds_dir": SOUNDS_DIR, "presets_dir": "presets", "prefetch_depth": 0}
+        settings.update(internal_settings or {})
+        with open("internal_settings.json", "w") as f:
+            json.dump(settings, f)
+        self.internal_settings = InternalSettings()
+        os.mkdir("presets")
+
+        sound_paths = [os.path.join(SOUNDS_DIR, name) for name in sorted(os.listdir(SOUNDS_DIR))]
+        rng = random.Random(seed)
+        for index in range(presets_count):
+            preset_settings = PresetSettings(os.path.join("presets", f"Preset {index}.json"),
+                                             internal_settings=self.internal_settings)
+            for sound_path in rng.sample(sound_paths, 3):
+                preset_settings.add_sound(sound_path, volume=rng.uniform(10, 90), mute=False)
+            preset_settings.settings["mute"] = False
+            preset_settings.flush()
+        # First run: every preset file is parsed to build preset_manager_settings.json. Every start after that
+        # reads only that file and the current preset, which is what open() measures.
+        start = time.perf_counter()
+        PresetsManagerSettings("preset_manager_settings.json", internal_settings=self.internal_settings)
+        self.create_seconds = time.perf_counter() - start
+        self.presets_manager = None
+        self.presets_managers = []
+
+    def open(self):
+        sound_cache.clear()
+        array_cache.clear()
+        start = time.perf_counter()
+        self.presets_manager = PresetsManager(PresetsManagerSettings("preset_manager_settings.json",
+                                                                     internal_settings=self.internal_settings))
+        elapsed = time.perf_counter() - start
+        self.presets_managers.append(self.presets_manager)
+        return elapsed
+
+    def close(self):
+        # Threads of every PresetsManager opened here are stopped, so the next case doesn't run next to them
+        for presets_manager in self.presets_managers:
+            presets_manager.audio.stop()
+            presets_manager.audio.transitions.join(1.0)
+            presets_manager.prefetcher.stop()
+            presets_manager.prefetcher.join(1.0)
+        stop_stream_pump()
+        # Pending write-behind saves go to this library, not to whatever directory is current later
+        flush_all()
+        os.chdir(self.previous_dir)
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def bench_startup():
+    results = {}
+    for presets_count in PRESET_COUNTS:
+        library = Library(presets_count)
+        try:
+            results[str(presets_count)] = {"first_run_seconds": library.create_seconds, "seconds": library.open()}
+        finally:
+            library.close()
+    return results
+
+
+def cycle(presets_manager, clear=None):
+    samples = []
+    # Let the last crossfade finish, otherwise layers still fading out are reused and the switch looks free
+    settle = presets_manager.presets_manager_settings.internal_settings.crossfade_ms / 1000 + 0.1
+    for preset_name in presets_manager.presets_order:
+        time.sleep(settle)
+        if clear is not None:
+            clear()
+        start = time.perf_counter()
+        presets_manager.set_current_preset(preset_name)
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def bench_switching(audio_backend):
+    results = {}
+    # Without the disk cache: cold is a full decode of every layer. Warm is going back to presets whose sounds were
+    # kept decoded in memory.
+    library = Library(SWITCH_PRESETS, internal_settings={"pcm_cache": False, "audio_backend": audio_backend,
+                                                         "keep_released_sounds": True})
+    try:
+        library.open()
+        presets_manager = library.presets_manager
+        results["cold"] = summary(cycle(presets_manager, clear=presets_manager.audio.sound_cache.clear))
+        results["warm"] = summary(cycle(presets_manager))
+        # Warm switches still decode whatever the memory budget pushed out
+        results["sound_cache"] = presets_manager.audio.sound_cache.stats()
+        # Peak of the whole process so far, so later backends include the earlier ones
+        results["process_peak_rss_bytes"] = peak_rss()
+    finally:
+        library.close()
+    # Nothing decoded in memory, but every layer already in the disk cache
+    library = Library(SWITCH_PRESETS, internal_settings={"audio_backend": audio_backend})
+    try:
+        library.open()
+        presets_manager = library.presets_manager
+        cycle(presets_manager)
+        results["disk"] = summary(cycle(presets_manager, clear=presets_manager.audio.sound_cache.clear))
+    finally:
+        library.close()
+    return results
+
+
+def bench_settings_save():
+    results = {}
+    library = Library(2)
+    try:
+        for index, write_behind in enumerate((False, True)):
+            preset_settings = PresetSettings(os.path.join("presets", f"Preset {index}.json"),
+                                             internal_settings=library.internal_settings)
+            preset_settings.write_behind = write_behind
+            sound_name = next(iter(preset_settings.settings["sounds"]))
+            # Slider drag: a new value on every event
+            updates = SAVE_STORM if write_behind else SAVE_STORM // 10
+            start = time.perf_counter()
+            for update in range(updates):
+                preset_settings.set_sound_volume(sound_name, update % 100)
+                preset_settings.save()
+            elapsed = time.perf_counter() - start
+            preset_settings.flush()
+            results["write_behind" if write_behind else "immediate"] = {
+                "updates": updates,
+                "updates_per_second": updates / elapsed,
+                "writes_done": preset_settings.writes_done,
+                "writes_avoided": preset_settings.writes_avoided,
+            }
+    finally:
+        library.close()
+    return results
+
+
+def bench_hotkeys(events=20000, extra_bindings=(0, 1000)):
+    # Cost per key event inside the keyboard hook: pressing the hotkeys themselves, and plain typing with the default
+    # bindings and with many more. Typing is what the hook sees all day, it should cost the same for any number.
+    library = Library(1)
+    try:
+        # Ordinary keys: with PYNPUT_BACKEND=dummy every special key (up, down, shift...) is the same key, so the
+        # default bindings would all be one chord
+        with open("hotkey_settings.json", "w") as f:
+            json.dump({which: {"modifiers": [], "key": key} for which, key in HOTKEY_KEYS.items()}, f)
+        bound = [pynput.keyboard.KeyCode.from_char(key) for key in HOTKEY_KEYS.values()]
+
+        # Plain Queue, CommandQueue would merge the moves and cancel the mutes this posts
+        hotkeys = Hotkeys(HotkeySettings(), None, queue.Queue())
+        keys = bound + [pynput.keyboard.KeyCode.from_char('a')]
+        presses = events // 2
+        for index in range(presses):
+            key = keys[index % len(keys)]
+            hotkeys.on_press(key)
+            hotkeys.on_release(key)
+        expect_commands(hotkeys, sum(keys[index % len(keys)] in bound for index in range(presses)))
+        results = {"hotkeys": dict(hotkeys.stats(), commands_queued=hotkeys.main_queue.qsize()), "typing": {}}
+
+        # Hotkey held down: the OS sends a press per auto-repeat, only the first should become a command
+        hotkeys = Hotkeys(HotkeySettings(), None, queue.Queue())
+        for index in range(presses):
+            hotkeys.on_press(bound[0])
+        hotkeys.on_release(bound[0])
+        expect_commands(hotkeys, 1)
+        results["held"] = dict(hotkeys.stats(), commands_queued=hotkeys.main_queue.qsize())
+
+        typing = [pynput.keyboard.KeyCode.from_char(char) for char in "the quick brown fox jumps over the lazy dog"]
+        for extra in extra_bindings:
+            hotkeys = Hotkeys(HotkeySettings(), None, queue.Queue())
+            for index in range(extra):
+                hotkeys.dispatch[frozenset({VK_BASE + index, ord('a')})] = ACTIONS['mute']
+            if len(hotkeys.dispatch) != len(HOTKEY_KEYS) + extra:
+                raise RuntimeError(f"Expected {len(HOTKEY_KEYS) + extra} bindings, got {len(hotkeys.dispatch)}")
+            for index in range(presses):
+                key = typing[index % len(typing)]
+                hotkeys.on_press(key)
+                hotkeys.on_release(key)
+            expect_commands(hotkeys, 0)
+            results["typing"][f"{len(hotkeys.dispatch)}_bindings"] = dict(hotkeys.stats(),
+                                                                          commands_queued=hotkeys.main_queue.qsize())
+        return results
+    finally:
+        library.close()
+
+
+def expect_commands(hotkeys, count):
+    # A run where the hotkeys never fire measures nothing, it shouldn't come out as a fast result
+    if hotkeys.main_queue.qsize() != count:
+        raise RuntimeError(f"Expected {count} hotkey commands, got {hotkeys.main_queue.qsize()}")
+
+
+def bench_generators(seconds=20.0, block_seconds=0.25):
+    # CPU time a generator layer costs per second of audio, in the blocks StreamingSound asks for
+    if not generators_available():
+        return None
+    pg.mixer.init()
+    frames = int(pg.mixer.get_init()[0] * block_seconds)
+    blocks = int(seconds / block_seconds)
+    results = {}
+    for kind in GENERATORS:
+        generator = NoiseGenerator(kind, seed=0)
+        start = time.process_time()
+        for _ in range(blocks):
+            generator.read(frames)
+        elapsed = time.process_time() - start
+        results[kind] = {"block_frames": frames, "core_percent": 100 * elapsed / (blocks * block_seconds)}
+    return results
+
+
+def run():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "startup": bench_startup(),
+        "switching": {audio_backend: bench_switching(audio_backend) for audio_backend in ("pygame", "numpy")},
+        "settings_save": bench_settings_save(),
+        "hotkeys_on_press": bench_hotkeys(),
+        "generators": bench_generators(),
+    }
+
+
+def main(argv):
+    results = json.dumps(run(), indent=4)
+    if len(argv) > 1:
+        with open(argv[1], "w") as f:
+            f.write(results)
+    print(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
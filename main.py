@@ -1,13 +1,14 @@
 from stimulant_noise.stimulant_noise import run
 
 import logging
+import sys
 
 if __name__ == "__main__":
     loggin_file = "noise_generator.log"
     logging.basicConfig(filename=loggin_file, level=logging.DEBUG)
     logging.info("Starting noise generator")
     try:
-        run()
+        run(headless="--headless" in sys.argv, startup_report="--startup-report" in sys.argv)
     except Exception as e:
         logging.exception(e)
         raise e
@@ -1,42 +1,327 @@
+import threading
+import time
+import logging
+
 import pygame as pg
+
+from .settings import InternalSettings
+from .sound_cache import sound_cache, sound_size, resolve_path
+from .transitions import TransitionEngine
+from .streaming import StreamingSound, should_stream
+from .mixer import SoftwareMixer, MixerLayer, ArraySource, software_mixer_available, array_cache, load_array
+from .mixdown import MixdownCache, mixdown_available
+from .pcm_cache import PcmCache
+from .metrics import metrics
+from .startup import startup
+from .generators import NoiseGenerator, generators_available
 # Classes for audio component of the program, made with pygame
 
+# Layer lifecycle: decoding, audible (or muted) in the current preset, fading out after a switch, let go
+LOADING = 'loading'
+PLAYING = 'playing'
+FADING = 'fading'
+RELEASED = 'released'
+
+# Channels are grown to the number of layers plus this many, and never go below min_channels
+CHANNEL_SPARE = 4
+
+
+class Layer:
+    # One sound Audio holds, from being asked for until its buffers are let go
+    def __init__(self, key, sound_settings):
+        self.key = key
+        self.path = sound_settings.get('path')
+        self.sound = None
+        self.state = LOADING
+        self.since = time.monotonic()
+        # Its own level in the current preset, the preset's volume and mute go on top
+        self.volume = 0.0
+        self.mute = False
+
+    def set_levels(self, sound_settings):
+        self.volume = float(sound_settings['volume'])/100
+        self.mute = sound_settings['mute']
+
+    def set_state(self, state):
+        self.state = state
+        self.since = time.monotonic()
+
+
+def layer_bytes(sound):
+    # Memory a layer holds on its own: a whole decoded sound, or just the blocks a stream has queued
+    if isinstance(sound, StreamingSound):
+        return sum(sound_size(block) for block in list(sound.blocks))
+    if isinstance(sound, MixerLayer):
+        array = getattr(sound.source, 'array', None)
+        return 0 if array is None else array.nbytes
+    return sound_size(sound)
+
 
 class Audio:
-    def __init__(self, current_preset, channels_num=64):
+    def __init__(self, current_preset, min_channels=8, internal_settings=None):
+        if internal_settings is None:
+            internal_settings = InternalSettings()
+        self.internal_settings = internal_settings
+        # "numpy" mixes every layer in software into one channel, "pygame" gives each layer its own channel
+        self.software_mixer = None
+        if self.internal_settings.audio_backend == "numpy" and software_mixer_available():
+            self.sound_cache = array_cache
+        else:
+            self.sound_cache = sound_cache
+        self.sound_cache.set_budget(self.internal_settings.sound_cache_bytes)
+        # Decoded PCM on disk, so only the first load of each file pays for decoding
+        self.pcm_cache = None
+        if self.internal_settings.pcm_cache:
+            self.pcm_cache = PcmCache(self.internal_settings.pcm_cache_dir,
+                                      max_bytes=self.internal_settings.pcm_cache_bytes)
+            if self.sound_cache is array_cache:
+                self.sound_cache.loader = self.pcm_cache.load_array
+            else:
+                self.sound_cache.loader = self.pcm_cache.load_sound
+        elif self.sound_cache is array_cache:
+            # The caches are shared, don't keep a loader an earlier Audio set up
+            self.sound_cache.loader = load_array
+        else:
+            self.sound_cache.loader = pg.mixer.Sound
+
         self.current_preset = current_preset
         self.volume = self.current_preset.volume/100
         self.mute = self.current_preset.mute
         self.volume_with_mute = self.volume * float(not self.mute)
         self.sounds = {}
+        # Layers of the current preset by sound name, and every layer not yet released (fading ones too) by key.
+        # Layers are released from the transitions thread once faded out, lifecycle_lock covers both sides.
+        self.sound_layers = {}
+        self.layers = {}
+        self.lifecycle_lock = threading.Lock()
+        self.released = 0
+        # Set by PresetsManager: paths the prefetcher wants decoded, they stay in the cache when released
+        self.retained = lambda sound_path: False
+        # Streamed (or software mixer) layers by path, so a layer re-added while fading out is the same object
+        self.streams = {}
+        self.streamed = {}
 
         self.mixer = pg.mixer
         self.mixer.init()
-        self.mixer.set_num_channels(channels_num)
+        self.min_channels = min_channels
+        self.mixer.set_num_channels(min_channels)
+        startup.mark('mixer_ready')
+        if self.sound_cache is array_cache:
+            self.software_mixer = SoftwareMixer()
+            self.software_mixer.start()
+
+        self.mixdowns = None
+        if self.internal_settings.mixdown and mixdown_available():
+            make_layer = None
+            if self.software_mixer is not None:
+                make_layer = lambda array: MixerLayer(self.software_mixer, lambda: ArraySource(array))
+            # Room for the current preset and every neighbour the prefetcher prepares
+            self.mixdowns = MixdownCache(self.internal_settings.mixdown_dir, self.sound_cache, make_layer=make_layer,
+                                         max_bytes=self.internal_settings.mixdown_cache_bytes,
+                                         loaded_max=max(3, 2 * self.internal_settings.prefetch_depth + 1))
+        # Preset being edited plays from its own layers, so slider changes are heard before any re-render
+        self.live_preset = None
+
+        self.transitions = TransitionEngine(crossfade=self.internal_settings.crossfade_ms / 1000,
+                                            volume_ramp=self.internal_settings.volume_ramp_ms / 1000)
+        self.transitions.start()
+
+        metrics.gauge('sound_cache.bytes', lambda: self.sound_cache.bytes)
+        metrics.gauge('audio.layers', lambda: len(self.layers))
+        metrics.gauge('mixer.channels', self.mixer.get_num_channels)
+        metrics.gauge('mixer.channels_busy', self.channels_busy)
 
         self.build()
         self.play()
+        startup.mark('first_sound')
+
+    def layer_gain(self, layer):
+        if layer.mute:
+            return 0.0
+        return layer.volume * self.volume_with_mute
+
+    def preset_layers(self, preset):
+        # What actually gets played for a preset: its sounds, or a single layer with all of them mixed down
+        if self.mixdowns is None or preset is self.live_preset or not self.mixdowns.eligible(preset, self.is_streamed):
+            return self.distinct_layers(preset.sounds)
+        try:
+            key = self.mixdowns.prepare(preset, pin=True)
+        except (OSError, pg.error):
+            # Missing or unreadable file, the preset plays live the way it always did
+            return self.distinct_layers(preset.sounds)
+        # Preset volume and mute are still applied on top, through layer_gain
+        return {f"mixdown {key}": {"mixdown": key, "volume": 100, "mute": False}}
+
+    def distinct_layers(self, sounds):
+        # A layer has one gain and one lifecycle, so one file can't be two sounds of a preset. Presets can't get such
+        # duplicates any more (see PresetSettings.add_sound), files edited by hand only play the first of them.
+        layers = {}
+        keys = set()
+        for sound_name, sound_settings in sounds.items():
+            key = self.layer_key(sound_settings)
+            if key in keys:
+                logging.warning(f"{sound_name} plays the same file as another sound of the preset, skipped")
+                continue
+            keys.add(key)
+            layers[sound_name] = sound_settings
+        return layers
+
+    def go_live(self):
+        if self.live_preset is not self.current_preset:
+            self.live_preset = self.current_preset
+            self.set_current_preset(self.current_preset)
 
     def build(self):
-        for sound_name, sound_settings in self.current_preset.sounds.items():
+        for sound_name, sound_settings in self.preset_layers(self.current_preset).items():
             if sound_name not in self.sounds:
-                sound_path = sound_settings['path']
-                sound = self.mixer.Sound(sound_path)
-                volume = float(sound_settings['volume'])/100 * self.volume_with_mute
-                mute = sound_settings['mute']
-                if not mute:
-                    sound.set_volume(volume)
-                else:
-                    sound.set_volume(0)
-                self.sounds[sound_name] = sound
+                sound = self.acquire(sound_name, sound_settings)
+                self.transitions.jump(sound, 0.0)
+                self.transitions.fade_in(sound, self.layer_gain(self.sound_layers[sound_name]))
+            else:
+                layer = self.sound_layers[sound_name]
+                layer.set_levels(sound_settings)
+                self.transitions.set_gain(layer.sound, self.layer_gain(layer))
+
+    def layer_key(self, sound_settings):
+        # Same key as the streams and caches use, so one file (or generator) is one layer whichever preset has it
+        if 'mixdown' in sound_settings:
+            return f"mixdown:{sound_settings['mixdown']}"
+        if 'generator' in sound_settings:
+            return f"generator:{sound_settings['generator']}:{sound_settings.get('seed')}"
+        return resolve_path(sound_settings['path'])
+
+    def acquire(self, sound_name, sound_settings):
+        key = self.layer_key(sound_settings)
+        with self.lifecycle_lock:
+            layer = self.layers.get(key)
+            if layer is None:
+                layer = Layer(key, sound_settings)
+                self.layers[key] = layer
+                # Grown before the new layer starts playing, pygame won't play a sound without a free channel
+                self.fit_channels()
+            elif layer.state == FADING:
+                # Still fading out from a switch, taken back instead of loaded again
+                layer.set_state(PLAYING)
+        if layer.sound is None:
+            try:
+                layer.sound = self.load_layer(sound_settings)
+            except BaseException:
+                with self.lifecycle_lock:
+                    self.layers.pop(key, None)
+                raise
+            layer.set_state(PLAYING)
+        layer.set_levels(sound_settings)
+        self.sounds[sound_name] = layer.sound
+        self.sound_layers[sound_name] = layer
+        return layer.sound
+
+    def retire(self, sound_name):
+        sound = self.sounds.pop(sound_name)
+        layer = self.sound_layers.pop(sound_name)
+        with self.lifecycle_lock:
+            layer.set_state(FADING)
+        self.transitions.fade_out(sound, on_done=lambda: self.release(layer))
+
+    def release(self, layer):
+        # End of the fade-out, on the transitions thread (or from stop())
+        with self.lifecycle_lock:
+            if layer.state != FADING or self.layers.get(layer.key) is not layer:
+                # Taken back by another switch while it was fading out
+                return
+            del self.layers[layer.key]
+            layer.set_state(RELEASED)
+            layer.sound.stop()
+            self.transitions.forget(layer.sound)
+            self.streams.pop(layer.key, None)
+            if layer.path is not None and not self.internal_settings.keep_released_sounds \
+                    and not self.retained(layer.path):
+                # Neighbouring presets' sounds stay decoded, anything further away is loaded again if it comes back
+                self.sound_cache.discard(layer.path)
+            layer.sound = None
+            self.released += 1
+            self.fit_channels()
+
+    def holds(self, sound_path):
+        with self.lifecycle_lock:
+            return resolve_path(sound_path) in self.layers
+
+    def fit_channels(self):
+        # Enough channels for every layer not yet released, plus spare ones. Shrinking stops whatever plays on the
+        # channels that go, so it only goes down as far as the highest channel still busy.
+        if self.software_mixer is not None:
+            # Layers are summed into the mixer's one output channel
+            wanted = self.min_channels
+        else:
+            wanted = max(self.min_channels, len(self.layers) + CHANNEL_SPARE)
+        current = self.mixer.get_num_channels()
+        if wanted < current:
+            busy = next((channel + 1 for channel in reversed(range(current))
+                         if self.mixer.Channel(channel).get_busy()), 0)
+            wanted = max(wanted, busy)
+        if wanted != current:
+            self.mixer.set_num_channels(wanted)
+
+    def layer_stats(self):
+        # Every layer Audio holds, with what it costs
+        with self.lifecycle_lock:
+            layers = list(self.layers.values())
+        names = {layer.key: sound_name for sound_name, layer in self.sound_layers.items()}
+        now = time.monotonic()
+        return {
+            'layers': [{
+                'key': layer.key,
+                'name': names.get(layer.key),
+                'state': layer.state,
+                'seconds_in_state': now - layer.since,
+                'bytes': 0 if layer.sound is None else layer_bytes(layer.sound),
+                'channels': 0 if layer.sound is None else layer.sound.get_num_channels(),
+            } for layer in layers],
+            'channels': self.mixer.get_num_channels(),
+            'channels_busy': self.channels_busy(),
+            'released': self.released,
+            'sound_cache': self.sound_cache.stats(),
+        }
+
+    def is_streamed(self, sound_path):
+        if sound_path not in self.streamed:
+            self.streamed[sound_path] = should_stream(sound_path, self.internal_settings.stream_threshold_bytes)
+        return self.streamed[sound_path]
+
+    def load_layer(self, sound_settings):
+        # A preset sound is either a file ("path") or synthesized noise ("generator"), or a whole preset mixed down
+        if 'mixdown' in sound_settings:
+            return self.mixdowns.layer(sound_settings['mixdown'])
+        if 'generator' in sound_settings:
+            return self.load_generator(sound_settings['generator'], sound_settings.get('seed'))
+        return self.load_sound(sound_settings['path'])
+
+    def load_generator(self, kind, seed=None):
+        key = f"generator:{kind}:{seed}"
+        if not generators_available():
+            raise RuntimeError("Generator layers need numpy")
+        if key not in self.streams:
+            if self.software_mixer is not None:
+                self.streams[key] = MixerLayer(self.software_mixer, lambda: NoiseGenerator(kind, seed=seed))
             else:
-                sound = self.sounds[sound_name]
-                volume = float(sound_settings['volume'])/100 * self.volume_with_mute
-                mute = sound_settings['mute']
-                if not mute:
-                    sound.set_volume(volume)
-                else:
-                    sound.set_volume(0)
+                self.streams[key] = StreamingSound(source=NoiseGenerator(kind, seed=seed))
+        return self.streams[key]
+
+    def load_sound(self, sound_path):
+        # Resolved like layer keys, so a stream is found again under the key its layer is released with
+        sound_path = resolve_path(sound_path)
+        if self.software_mixer is not None:
+            if sound_path not in self.streams:
+                self.streams[sound_path] = self.software_mixer.load_layer(sound_path,
+                                                                          streamed=self.is_streamed(sound_path))
+            return self.streams[sound_path]
+        if self.is_streamed(sound_path):
+            if sound_path not in self.streams:
+                self.streams[sound_path] = StreamingSound(sound_path)
+            return self.streams[sound_path]
+        return self.sound_cache.get(sound_path)
+
+    def channels_busy(self):
+        return sum(self.mixer.Channel(channel).get_busy() for channel in range(self.mixer.get_num_channels()))
 
     def play(self):
         for sound_name, sound in self.sounds.items():
@@ -44,55 +329,84 @@ class Audio:
                 sound.play(-1)
 
     def stop(self):
-        for sound_name, sound in self.sounds.items():
-            sound.stop()
+        self.transitions.stop()
+        # Ramps are gone, so layers still fading out never reach the release at the end of theirs
+        with self.lifecycle_lock:
+            fading = [layer for layer in self.layers.values() if layer.state == FADING]
+        for layer in fading:
+            self.release(layer)
+        with self.lifecycle_lock:
+            layers = list(self.layers.values())
+        for layer in layers:
+            if layer.sound is not None:
+                layer.sound.stop()
+        if self.software_mixer is not None:
+            self.software_mixer.stop()
 
+    # Volume and mute changes of the current preset only move gains, nothing is added or removed. Every layer keeps
+    # its own level, so a change recomputes just the gains it affects: one layer, or every layer of the current
+    # preset when it's the preset's volume or mute. set_current_preset is for when the layers themselves change.
     def set_volume(self, volume):
+        if volume == self.volume:
+            return
         self.volume = volume
-        self.build()
+        self.apply_preset_gain()
+
+    def set_mute(self, mute):
+        if mute == self.mute:
+            return
+        self.mute = mute
+        self.apply_preset_gain(duration=self.transitions.crossfade)
+
+    def apply_preset_gain(self, duration=None):
+        self.volume_with_mute = self.volume * float(not self.mute)
+        for layer in self.sound_layers.values():
+            self.transitions.set_gain(layer.sound, self.layer_gain(layer), duration=duration)
 
     def set_sound_volume(self, sound_name, volume):
-        sound = self.sounds[sound_name]
-        sound.set_volume(float(volume)/100 * self.volume_with_mute)
+        if sound_name not in self.sounds:
+            self.go_live()
+        layer = self.sound_layers.get(sound_name)
+        if layer is None:
+            # Skipped duplicate of another sound's file
+            return
+        layer.volume = float(volume)/100
+        self.transitions.set_gain(layer.sound, self.layer_gain(layer))
 
     def set_sound_mute(self, sound_name, mute):
-        sound = self.sounds[sound_name]
-        if mute:
-            sound.set_volume(0)
-        else:
-            sound.set_volume(float(self.current_preset.sounds[sound_name]['volume'])/100 * self.volume_with_mute)
+        if sound_name not in self.sounds:
+            self.go_live()
+        layer = self.sound_layers.get(sound_name)
+        if layer is None:
+            return
+        layer.mute = mute
+        self.transitions.set_gain(layer.sound, self.layer_gain(layer))
 
     def set_current_preset(self, new_preset):
+        if new_preset is not self.current_preset:
+            # Edits are done, next time this preset is played its mixdown is re-rendered if anything changed
+            self.live_preset = None
         self.volume = new_preset.volume/100
         self.mute = new_preset.mute
         self.volume_with_mute = self.volume * float(not self.mute)
-        sounds_to_remove = set(self.sounds.keys()) - set(new_preset.sounds.keys())
-        sounds_to_add = set(new_preset.sounds.keys()) - set(self.sounds.keys())
-        sounds_to_update = set(new_preset.sounds.keys()) & set(self.sounds.keys())
+        layers = self.preset_layers(new_preset)
+        sounds_to_remove = set(self.sounds.keys()) - set(layers.keys())
+        sounds_to_add = set(layers.keys()) - set(self.sounds.keys())
+        sounds_to_update = set(layers.keys()) & set(self.sounds.keys())
         for sound_name in sounds_to_remove:
-            self.sounds[sound_name].stop()
+            self.retire(sound_name)
         for sound_name in sounds_to_add:
-            sound_path = new_preset.sounds[sound_name]['path']
-            sound = self.mixer.Sound(sound_path)
-            volume = float(new_preset.sounds[sound_name]['volume'])/100 * self.volume_with_mute
-            mute = new_preset.sounds[sound_name]['mute']
-            if not mute:
-                sound.set_volume(volume)
-            else:
-                sound.set_volume(0)
-            self.sounds[sound_name] = sound
-            self.sounds[sound_name].play(-1)
+            sound = self.acquire(sound_name, layers[sound_name])
+            if sound.get_num_channels() == 0:
+                self.transitions.jump(sound, 0.0)
+                sound.play(-1)
+            # Still fading out from the last switch? Fade-in picks up from its current gain
+            self.transitions.fade_in(sound, self.layer_gain(self.sound_layers[sound_name]))
         for sound_name in sounds_to_update:
             sound = self.sounds[sound_name]
-            volume = float(new_preset.sounds[sound_name]['volume'])/100 * self.volume_with_mute
-            mute = new_preset.sounds[sound_name]['mute']
-            if not mute:
-                sound.set_volume(volume)
-            else:
-                sound.set_volume(0)
+            layer = self.sound_layers[sound_name]
+            layer.set_levels(layers[sound_name])
+            self.transitions.set_gain(sound, self.layer_gain(layer), duration=self.transitions.crossfade)
             if sound.get_num_channels() == 0:
                 sound.play(-1)
         self.current_preset = new_preset
-
-
-
@@ -0,0 +1,116 @@
+import queue
+# Commands posted to the worker thread, which is the only one allowed to touch presets and audio. A command can
+# carry 'origin', the front end it came from: that one already shows the change and isn't refreshed for it.
+
+
+class CommandQueue(queue.Queue):
+    # Queue that merges preset moves still waiting to be handled, so five "next" presses become one jump of +5
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self.pending_move = None
+        self.coalesced = 0
+
+    def _put(self, item):
+        # Called with the queue mutex held, so the pending move can be changed in place safely
+        if item['name'] == 'move_preset':
+            # Only merge with a move at the tail, jumping over e.g. a mute would change which preset gets muted.
+            # Moves waiting for a reply stay separate, their caller has to hear back.
+            if self.pending_move is not None and self.queue[-1] is self.pending_move and 'reply' not in item:
+                self.pending_move['steps'] += item['steps']
+                self.coalesced += 1
+                # Caller's put() still bumps unfinished_tasks, keep task_done()/join() balanced
+                self.unfinished_tasks -= 1
+                return
+            item = dict(item)
+            self.pending_move = item
+        elif self.is_toggle(item) and self.queue and self.is_toggle(self.queue[-1]):
+            # Two mute toggles waiting back to back cancel out, neither has to be handled
+            self.queue.pop()
+            self.coalesced += 2
+            self.unfinished_tasks -= 2
+            return
+        super()._put(item)
+
+    @staticmethod
+    def is_toggle(item):
+        return item['name'] == 'mute_preset' and item.get('mute') is None and 'reply' not in item
+
+    def _get(self):
+        item = super()._get()
+        if item is self.pending_move:
+            self.pending_move = None
+        return item
+
+
+def move_preset(steps):
+    return {'name': 'move_preset', 'steps': steps}
+
+
+def mute_preset(mute=None, preset_name=None):
+    # None toggles
+    if mute is None:
+        return {'name': 'mute_preset'}
+    command = {'name': 'mute_preset', 'mute': mute}
+    if preset_name is not None:
+        command['preset'] = preset_name
+    return command
+
+
+def select_preset(preset_name):
+    return {'name': 'select_preset', 'preset': preset_name}
+
+
+def set_preset_volume(volume, preset_name=None):
+    # Current preset unless named
+    command = {'name': 'set_preset_volume', 'volume': volume}
+    if preset_name is not None:
+        command['preset'] = preset_name
+    return command
+
+
+def set_sound_volume(sound_name, volume, preset_name=None):
+    command = {'name': 'set_sound_volume', 'sound': sound_name, 'volume': volume}
+    if preset_name is not None:
+        command['preset'] = preset_name
+    return command
+
+
+def set_sound_mute(sound_name, mute, preset_name=None):
+    # With a preset name, dropped if that preset is no longer the current one by the time it's handled
+    command = {'name': 'set_sound_mute', 'sound': sound_name, 'mute': mute}
+    if preset_name is not None:
+        command['preset'] = preset_name
+    return command
+
+
+def add_sounds(sound_paths):
+    return {'name': 'add_sounds', 'paths': list(sound_paths)}
+
+
+def remove_sound(sound_name, preset_name=None):
+    command = {'name': 'remove_sound', 'sound': sound_name}
+    if preset_name is not None:
+        command['preset'] = preset_name
+    return command
+
+
+def add_preset(preset_name, after_preset_name=None):
+    # The new preset becomes the current one
+    return {'name': 'add_preset', 'preset': preset_name, 'after': after_preset_name}
+
+
+def remove_preset(preset_name):
+    return {'name': 'remove_preset', 'preset': preset_name}
+
+
+def rename_preset(preset_name, new_preset_name):
+    return {'name': 'rename_preset', 'preset': preset_name, 'new_name': new_preset_name}
+
+
+def get_state():
+    return {'name': 'get_state'}
+
+
+def dump_metrics():
+    return {'name': 'dump_metrics'}
@@ -0,0 +1,240 @@
+import sys
+import json
+import socket
+import asyncio
+import threading
+import logging
+
+from .commands import (move_preset, mute_preset, select_preset, set_preset_volume, set_sound_volume, set_sound_mute,
+                       get_state)
+# Local control endpoint: newline-delimited JSON on 127.0.0.1, feeding the same worker queue as the hotkeys.
+#   {"id": 1, "command": "next"}                        -> {"id": 1, "ok": true, "state": {...}}
+#   {"id": 2, "commands": [{"command": "select", "preset": "Silence"}, {"command": "preset_volume", "volume": 30}]}
+#                                                       -> {"id": 2, "results": [{...}, {...}]}
+#   {"command": "subscribe"}                            -> then {"event": "state", "state": {...}} on every change
+
+DEFAULT_PORT = 47813
+
+
+def volume(request):
+    value = request["volume"]
+    # bool is an int too, "volume": true is a mistake
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 100:
+        raise ValueError(f"volume has to be a number from 0 to 100, got {value!r}")
+    return float(value)
+
+
+def mute(request, required=True):
+    # Only a JSON true or false, bool("false") would be True
+    if not required and request.get("mute") is None:
+        return None
+    value = request["mute"]
+    if not isinstance(value, bool):
+        raise ValueError(f"mute has to be true or false, got {value!r}")
+    return value
+
+
+def steps(request):
+    value = request["steps"]
+    if isinstance(value, bool) or not isinstance(value, int):
+        raise ValueError(f"steps has to be a whole number, got {value!r}")
+    return value
+
+
+COMMANDS = {
+    "next": lambda request: move_preset(1),
+    "previous": lambda request: move_preset(-1),
+    "move": lambda request: move_preset(steps(request)),
+    "select": lambda request: select_preset(request["preset"]),
+    # Without "mute" it toggles
+    "mute": lambda request: mute_preset(mute(request, required=False)),
+    "preset_volume": lambda request: set_preset_volume(volume(request)),
+    "sound_volume": lambda request: set_sound_volume(request["sound"], volume(request)),
+    "sound_mute": lambda request: set_sound_mute(request["sound"], mute(request)),
+    "state": lambda request: get_state(),
+}
+
+
+def parse_command(request):
+    name = request.get("command")
+    if name not in COMMANDS:
+        raise ValueError(f"Unknown command {name}")
+    return COMMANDS[name](request)
+
+
+def resolve(future, result):
+    # Client may have gone away (and the future been cancelled) before the worker got to the command
+    if not future.done():
+        future.set_result(result)
+
+
+STOPPED = {"ok": False, "error": "Stopped before the command was handled"}
+
+
+class ControlServer(threading.Thread):
+    def __init__(self, main_queue, state, port=DEFAULT_PORT, host="127.0.0.1"):
+        threading.Thread.__init__(self, daemon=True)
+        self.main_queue = main_queue
+        # Called on the worker thread after a change, returns what subscribers get sent
+        self.state = state
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.server = None
+        self.subscribers = set()
+        self.ready = threading.Event()
+        # Futures of commands the worker hasn't answered yet, only touched on the event loop
+        self.pending = set()
+        self.stopped = False
+
+        self.requests = 0
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except OSError as e:
+            # Port taken, e.g. by a second copy of the program. Hotkeys and GUI still work.
+            logging.error(f"Control endpoint not started: {e}")
+            self.ready.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        # Port 0 picks a free one
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.ready.set()
+        try:
+            await self.server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+
+    def stop(self):
+        # Called as the worker stops: nothing queued from here on gets an answer from it
+        if self.loop is not None and self.server is not None:
+            self.loop.call_soon_threadsafe(self.shutdown)
+
+    def shutdown(self):
+        self.stopped = True
+        for future in list(self.pending):
+            resolve(future, dict(STOPPED))
+        self.pending.clear()
+        self.server.close()
+
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as e:
+                    response = {"ok": False, "error": f"Invalid JSON: {e}"}
+                else:
+                    response = await self.respond(request, writer)
+                writer.write((json.dumps(response) + "\n").encode())
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            # Client gone, or the server shutting down with the client still connected
+            pass
+        finally:
+            self.subscribers.discard(writer)
+            writer.close()
+
+    async def respond(self, request, writer):
+        self.requests += 1
+        if "commands" in request:
+            # Batch: everything is queued in one go and handled back to back by the worker
+            futures = [self.post(command_request) for command_request in request["commands"]]
+            response = {"results": list(await asyncio.gather(*futures))}
+        elif request.get("command") == "subscribe":
+            self.subscribers.add(writer)
+            response = await self.post({"command": "state"})
+        else:
+            response = await self.post(request)
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    def post(self, request):
+        future = self.loop.create_future()
+        if self.stopped:
+            future.set_result(dict(STOPPED))
+            return future
+        try:
+            command = parse_command(request)
+        except (KeyError, ValueError, TypeError) as e:
+            future.set_result({"ok": False, "error": str(e)})
+            return future
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        command["reply"] = lambda result: self.loop.call_soon_threadsafe(resolve, future, result)
+        self.main_queue.put(command)
+        return future
+
+    def on_state_changed(self):
+        # Front end hook, runs on the worker thread
+        if self.subscribers and self.loop is not None:
+            self.loop.call_soon_threadsafe(self.publish, self.state())
+
+    def publish(self, state):
+        line = (json.dumps({"event": "state", "state": state}) + "\n").encode()
+        for writer in list(self.subscribers):
+            if writer.is_closing():
+                self.subscribers.discard(writer)
+            else:
+                writer.write(line)
+
+
+def send(requests, port=DEFAULT_PORT, host="127.0.0.1", timeout=5):
+    # Blocking client for scripts: sends each request and returns the replies in order
+    with socket.create_connection((host, port), timeout=timeout) as connection:
+        stream = connection.makefile("rw")
+        replies = []
+        for request in requests:
+            stream.write(json.dumps(request) + "\n")
+            stream.flush()
+            replies.append(json.loads(stream.readline()))
+        return replies
+
+
+def parse_args(args):
+    # "next", "select Silence", "volume 30", "sound rain.ogg 40", "mute on"...
+    name, values = args[0], args[1:]
+    if name == "select":
+        return {"command": "select", "preset": " ".join(values)}
+    if name == "move":
+        return {"command": "move", "steps": int(values[0])}
+    if name == "volume":
+        return {"command": "preset_volume", "volume": float(values[0])}
+    if name == "sound":
+        return {"command": "sound_volume", "sound": values[0], "volume": float(values[1])}
+    if name == "mute" and values:
+        return {"command": "mute", "mute": values[0] == "on"}
+    return {"command": name}
+
+
+def main(argv):
+    # python -m stimulant_noise.control next|previous|move N|select NAME|mute [on|off]|volume N|sound NAME N|state|subscribe
+    if len(argv) < 2:
+        print("Usage: python -m stimulant_noise.control next|previous|move N|select NAME|mute [on|off]|volume N|"
+              "sound NAME N|state|subscribe")
+        return 1
+    from .settings import InternalSettings
+    port = InternalSettings(settings_file_location="internal_settings.json").control_port or DEFAULT_PORT
+    request = parse_args(argv[1:])
+    if request["command"] == "subscribe":
+        with socket.create_connection(("127.0.0.1", port)) as connection:
+            stream = connection.makefile("rw")
+            stream.write(json.dumps(request) + "\n")
+            stream.flush()
+            for line in stream:
+                print(line, end="", flush=True)
+        return 0
+    reply = send([request], port=port)[0]
+    print(json.dumps(reply, indent=4))
+    return 0 if reply.get("ok") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,113 @@
+import math
+import functools
+
+import pygame as pg
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+# Noise synthesized block by block, for layers that don't need a recording at all
+
+
+GENERATORS = ("white", "pink", "brown")
+
+# Paul Kellet's economy pink filter: three one-pole lowpasses plus a bit of the white input
+PINK_POLES = (0.99765, 0.96300, 0.57000)
+PINK_GAINS = (0.0990460, 0.2965164, 1.0526913)
+PINK_DIRECT = 0.1848
+# Leak keeps the brown random walk from drifting off, while staying well below audible frequencies
+BROWN_POLE = 0.998
+
+# Output is scaled to roughly the same loudness (standard deviation) for every colour
+LEVEL = 0.2
+PINK_SCALE = LEVEL / 3.0
+BROWN_SCALE = LEVEL * math.sqrt(1 - BROWN_POLE ** 2)
+# Largest pole^-k one_pole lets a chunk reach, far from float64's limit
+MAX_GROWTH = math.log(1e250)
+# Frames synthesized at a time, larger pieces no longer fit the CPU cache and cost more per frame
+PIECE_FRAMES = 2048
+
+
+def generators_available():
+    return np is not None
+
+
+def one_pole(x, pole, state):
+    # y[n] = pole * y[n-1] + x[n] along axis 0, with one pole for every column or one per column. Returns (y, last y).
+    # y[k] = pole^k * (pole * state + cumsum(x[j] * pole^-j)) within a chunk, and every chunk (and column) goes
+    # through the same cumsum, so a block is one pass however many filters it holds. Rounding stays relative to y,
+    # chunks only have to be short enough for pole^-j not to overflow.
+    frames, columns = x.shape
+    poles = np.broadcast_to(np.asarray(pole, dtype=float), (columns,))
+    chunks = -(-frames // max(1, int(MAX_GROWTH / -math.log(poles.min()))))
+    chunk = -(-frames // chunks)
+    powers, inverse = chunk_powers(poles.tobytes(), chunk)
+    if chunks * chunk != frames:
+        padded = np.zeros((chunks * chunk, columns))
+        padded[:frames] = x
+        x = padded
+    sums = np.cumsum(x.reshape(chunks, chunk, columns) * inverse, axis=1)
+    # pole * state going into each chunk, a loop over chunks rather than samples
+    ends = sums[:, -1] * powers[-1]
+    for index in range(chunks):
+        state = poles * state
+        sums[index] += state
+        state = state * powers[-1] + ends[index]
+    y = (sums * powers).reshape(chunks * chunk, columns)[:frames]
+    return y, y[-1].copy()
+
+
+@functools.lru_cache(maxsize=16)
+def chunk_powers(poles, chunk):
+    # pole^k and pole^-k for k in a chunk, the same for every block of a generator
+    powers = np.frombuffer(poles) ** np.arange(chunk)[:, None]
+    return powers, 1 / powers
+
+
+class NoiseGenerator:
+    # Source with read(frames) like FileBlockSource, so it plays through StreamingSound or the SoftwareMixer
+    def __init__(self, kind, seed=None):
+        if kind not in GENERATORS:
+            raise ValueError(f"Unknown generator {kind}")
+        self.kind = kind
+        self.frequency, size, self.channels = pg.mixer.get_init()
+        # Every channel gets its own stream from the same seed, so a seeded preset sounds the same every time
+        self.rngs = [np.random.default_rng(child) for child in np.random.SeedSequence(seed).spawn(self.channels)]
+        # Pink runs its three filters side by side as columns of one array, weighted and summed back into channels
+        # by one small matrix. Brown has one filter per channel.
+        self.poles = np.repeat(PINK_POLES, self.channels) if kind == "pink" else BROWN_POLE
+        self.mix = np.vstack([gain * np.eye(self.channels) for gain in PINK_GAINS])
+        self.state = np.zeros(len(PINK_POLES) * self.channels if kind == "pink" else self.channels)
+
+    def white(self, frames):
+        return np.stack([rng.standard_normal(frames) for rng in self.rngs], axis=1)
+
+    def read(self, frames):
+        block = np.empty((frames, self.channels), dtype=np.float32)
+        for start in range(0, frames, PIECE_FRAMES):
+            block[start:start + PIECE_FRAMES] = self.synthesize(min(PIECE_FRAMES, frames - start))
+        return block
+
+    def synthesize(self, frames):
+        white = self.white(frames)
+        if self.kind == "white":
+            block = white * LEVEL
+        elif self.kind == "pink":
+            filtered, self.state = one_pole(np.tile(white, len(PINK_POLES)), self.poles, self.state)
+            block = white * PINK_DIRECT + filtered @ self.mix
+            block *= PINK_SCALE
+        else:
+            block, self.state = one_pole(white, self.poles, self.state)
+            block *= BROWN_SCALE
+        return block
+
+    def skip(self, frames):
+        # Noise has no position to keep
+        pass
+
+    def get_length(self):
+        return 0.0
+
+    def close(self):
+        pass
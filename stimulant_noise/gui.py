@@ -1,7 +1,16 @@
+import queue
+import logging
+import threading
+
 import flet as ft
 
 from .hotkeys import Hotkeys
 from .preset import PresetsManager
+from .commands import (dump_metrics, move_preset, select_preset, mute_preset, set_sound_mute, add_sounds, remove_sound,
+                       add_preset, remove_preset, rename_preset, set_preset_volume, set_sound_volume)
+from .metrics import metrics
+from .startup import startup
+from .throttle import Throttle
 
 
 class GUI:
@@ -17,13 +26,45 @@ class GUI:
         self.queue = queue
 
         self.current_preset = self.presets_manager.get_current_preset()
+        internal_settings = self.presets_manager.presets_manager_settings.internal_settings
 
         self.page = None
+        self.built = False
+        self.pick_files_dialog = None
+        # Controls that change after the page is built, kept so updates don't have to walk the page
+        self.preset_name_text = None
+        self.preset_volume_slider = None
+        self.preset_mute_toggle = None
+        self.loading_row = None
+        self.sounds_column = None
+        self.sound_controls = {}
+        self.presets_column = None
+        self.preset_buttons = {}
+        self.highlighted_preset = None
+        self.hotkey_displays = {}
+        self.hotkey_capture_status = None
+        self.hotkey_cancel_button = None
+        self.hotkey_capture_timeout = internal_settings.hotkey_capture_timeout_s
+        # Capture events come from the keyboard hook, which mustn't wait on flet. They're shown from this thread.
+        self.capture_events = queue.Queue()
+        self.capture_thread = threading.Thread(target=self.show_capture_events, daemon=True)
+        self.capture_thread.start()
+        self.hotkeys.add_capture_listener(self.on_capture_changed)
+
+        # flet sends on_change for every pixel a slider moves, the throttle keeps only the latest value per slider
+        self.slider_throttle = Throttle(self.apply_slider, rate=internal_settings.slider_rate_hz)
+        self.slider_throttle.start()
+        if metrics.enabled:
+            metrics.gauge('gui.slider_events', self.slider_throttle.stats)
 
     def main(self, page: ft.Page):
         self.page = page
         self.build_page()
+        # One picker for the lifetime of the page, building it per render kept growing page.overlay
+        self.pick_files_dialog = ft.FilePicker(on_result=self.add_sounds)
+        self.page.overlay.append(self.pick_files_dialog)
         self.build_container()
+        startup.mark('window')
 
     def build_page(self):
         self.page.title = "Noise Generator"
@@ -36,6 +77,7 @@ class GUI:
         self.page.on_disconnect = lambda _: self.queue.put({'name': 'close_all'})
 
     def build_container(self):
+        # Built once, after that only the controls that changed are touched (see show_current_preset)
         left_column = self.build_left_column()
         left_container = ft.Container(content=left_column,
                                       margin=4,
@@ -57,13 +99,12 @@ class GUI:
                       )
         self.page.controls = [rows]
         self.page.update()
+        self.built = True
 
     def build_left_column(self):
-        pick_files_dialog = ft.FilePicker(on_result=self.add_sounds)
-        self.page.overlay.append(pick_files_dialog)
         add_sound_button = ft.FloatingActionButton(text='Add sounds',
                                                    icon=ft.icons.ADD_CIRCLE,
-                                                   on_click=lambda _: pick_files_dialog.pick_files(
+                                                   on_click=lambda _: self.pick_files_dialog.pick_files(
                                                        allow_multiple=True,
                                                    ))
         change_preset_name_button = ft.FloatingActionButton(text='Change preset name',
@@ -74,29 +115,35 @@ class GUI:
                                                        icon=ft.icons.DELETE,
                                                        height=30,
                                                        on_click=self.remove_preset)
-        volume_slider = ft.Slider(
+        self.preset_name_text = ft.Text(self.current_preset.name, size=20, weight='w600')
+        self.preset_volume_slider = ft.Slider(
             value=self.current_preset.volume,
             min=0,
             max=100,
-            on_change=lambda e: self.set_preset_volume(e),
+            on_change=lambda e: self.slider_throttle.submit(('preset', self.current_preset.name), e.control.value),
             width=300,
             height=30,
         )
 
-        preset_mute_toggle = ft.Checkbox(label='Mute', value=self.current_preset.mute,
-                                         on_change=lambda e: self.mute_current_preset(e))
+        self.preset_mute_toggle = ft.Checkbox(label='Mute', value=self.current_preset.mute,
+                                              on_change=lambda e: self.mute_current_preset(e))
 
-        slider_row = ft.Row(controls=[ft.Text('Volume'), volume_slider, preset_mute_toggle])
+        slider_row = ft.Row(controls=[ft.Text('Volume'), self.preset_volume_slider, self.preset_mute_toggle])
 
         options_row = ft.Row(controls=[change_preset_name_button, remove_preset_button])
 
         preset_options_row = ft.ResponsiveRow(controls=[slider_row, options_row])
 
-        left_column = ft.Column(
-            controls=[ft.Text(self.current_preset.name, size=20, weight='w600'),
-                      preset_options_row, self.build_sounds_column(), add_sound_button],
-            spacing=10, scroll='auto'
-        )
+        # Hidden by the worker's notification once audio is up
+        self.loading_row = ft.Row(controls=[ft.ProgressRing(width=16, height=16), ft.Text('Loading sounds...')],
+                                  visible=not self.presets_manager.audio_ready.is_set())
+
+        self.sounds_column = ft.Column(spacing=10)
+        self.build_sounds_column()
+
+        left_column = ft.Column(controls=[self.preset_name_text, self.loading_row, preset_options_row,
+                                          self.sounds_column, add_sound_button],
+                                spacing=10, scroll='auto')
         return left_column
 
     def build_right_column(self):
@@ -121,11 +168,20 @@ class GUI:
                                                       on_click=self.previous_preset, width=100)
         preset_controls_row = ft.Row(controls=[previous_preset_button, next_preset_button], spacing=10)
         presets_control_container = ft.Container(content=preset_controls_row, padding=3, border_radius=10)
-        settings_control_container = ft.Container(content=ft.Column(controls=[add_preset_button,
-                                                                              change_hotkeys_button]),
+        settings_controls = [add_preset_button, change_hotkeys_button]
+        if metrics.enabled:
+            metrics_button = ft.FloatingActionButton(text='Metrics',
+                                                     icon=ft.icons.TIMER,
+                                                     on_click=lambda _: self.display_metrics_dialog(),
+                                                     height=30,
+                                                     shape=ft.RoundedRectangleBorder(radius=10))
+            settings_controls.append(metrics_button)
+        settings_control_container = ft.Container(content=ft.Column(controls=settings_controls),
                                                   padding=10, border_radius=10)
-
-        right_column = ft.Column(controls=[dark_mode_toggle, presets_text, self.build_presets_column(),
+        self.presets_column = ft.Column(spacing=5, width=200, height=350, scroll="auto")
+        self.build_presets_column()
+        presets_container = ft.Container(content=self.presets_column, padding=ft.padding.all(5))
+        right_column = ft.Column(controls=[dark_mode_toggle, presets_text, presets_container,
                                            presets_control_container, settings_control_container],
                                  spacing=10)
         return right_column
@@ -135,31 +191,39 @@ class GUI:
         self.page.update()
 
     def build_sounds_column(self):
-        names = []
-        sliders = []
-        toggles = []
-        remove_buttons = []
+        # Only the rows of the sounds column are replaced, the column itself stays in the page
+        self.sound_controls = {}
+        rows = []
         for sound_name, sound_settings in self.current_preset.sounds.items():
-            sound_container = self.build_sound_row(sound_name, sound_settings)
-            names.append(sound_container[0])
-            sliders.append(sound_container[1])
-            toggles.append(sound_container[2])
-            remove_buttons.append(sound_container[3])
-
-        names_column = ft.Column(controls=names, spacing=10)
-        sliders_column = ft.Column(controls=sliders, spacing=10)
-        toggles_column = ft.Column(controls=toggles, spacing=10)
-        remove_buttons_column = ft.Column(controls=remove_buttons, spacing=10)
-        sounds_row = ft.Row(controls=[names_column, sliders_column, toggles_column, remove_buttons_column], spacing=5)
-        return sounds_row
+            rows.append(self.build_sound_row(sound_name, sound_settings))
+        self.sounds_column.controls = rows
 
+    def show_current_preset(self):
+        # Brings the page in line with presets_manager: values set in place, sound rows rebuilt only if the
+        # sounds themselves changed, then a single update
+        self.current_preset = self.presets_manager.get_current_preset()
+        self.preset_name_text.value = self.current_preset.name
+        self.preset_volume_slider.value = self.current_preset.volume
+        self.preset_mute_toggle.value = self.current_preset.mute
+        self.loading_row.visible = not self.presets_manager.audio_ready.is_set()
+        if list(self.sound_controls) != list(self.current_preset.sounds):
+            self.build_sounds_column()
+        else:
+            for sound_name, sound_settings in self.current_preset.sounds.items():
+                self.sound_controls[sound_name]['volume'].value = sound_settings['volume']
+                self.sound_controls[sound_name]['mute'].value = sound_settings['mute']
+        if list(self.preset_buttons) != self.presets_manager.presets_order:
+            self.build_presets_column()
+        else:
+            self.highlight_current_preset()
+        self.page.update()
+
+    # Changes go to the worker, which owns presets and audio. The page follows once the worker calls on_state_changed.
     def next_preset(self, e):
-        self.current_preset = self.presets_manager.next_preset()
-        self.build_container()
+        self.queue.put(move_preset(1))
 
     def previous_preset(self, e):
-        self.current_preset = self.presets_manager.previous_preset()
-        self.build_container()
+        self.queue.put(move_preset(-1))
 
     def add_sounds(self, e: ft.FilePickerResultEvent):
         sounds = []
@@ -167,17 +231,17 @@ class GUI:
             print(f'Adding sound {file.name}, path: {file.path}, size: {file.size}')
             sounds.append(file.path)
         print(f'Adding sounds: {sounds}')
-        self.presets_manager.add_sounds(sounds)
-        self.build_container()
+        self.queue.put(add_sounds(sounds))
 
     def build_sound_row(self, sound_file_name, sound_settings):
         sound_name = ft.Text(sound_file_name.split('.')[0])
-        sound_name_container = ft.Container(content=sound_name, padding=2, height=50, border_radius=10)
+        sound_name_container = ft.Container(content=sound_name, padding=2, width=100, height=50, border_radius=10)
         volume_slider = ft.Slider(
             min=0,
             max=100,
             value=sound_settings['volume'],
-            on_change=lambda e: self.set_sound_volume(sound_file_name, e)
+            on_change=lambda e: self.slider_throttle.submit(('sound', self.current_preset.name, sound_file_name),
+                                                            e.control.value)
         )
         volume_slider_container = ft.Container(content=volume_slider, padding=2, height=50, border_radius=10)
         mute_button = ft.Checkbox(label='Mute', value=sound_settings['mute'],
@@ -190,58 +254,73 @@ class GUI:
                                                 height=30,
                                                 shape=ft.RoundedRectangleBorder(radius=10))
         remove_button_container = ft.Container(content=remove_button, padding=2, height=50, border_radius=10)
-        return sound_name_container, volume_slider_container, mute_button_container, remove_button_container
-
-    def set_sound_volume(self, sound_name, e):
-        volume = e.control.value
-        self.presets_manager.set_sound_volume(sound_name, volume)
-        if self.current_preset.sounds[sound_name]['mute']:
-            self.set_mute_from_slider(sound_name, False)
-
-    def set_mute_from_slider(self, sound_name, mute):
-        self.presets_manager.set_sound_mute(sound_name, mute)
-        columns_count = len(self.page.controls[0].controls[0].content.controls[2].controls[0].controls)
-        for column_id in range(columns_count):
-            if self.page.controls[0].controls[0].content.controls[2].controls[0].controls[column_id].\
-                    content.value == sound_name.split('.')[0]:
-                self.page.controls[0].controls[0].content.controls[2].controls[2].controls[column_id].\
-                    content.value = mute
-                break
-        self.page.update()
+        self.sound_controls[sound_file_name] = {'volume': volume_slider, 'mute': mute_button}
+        return ft.Row(controls=[sound_name_container, volume_slider_container, mute_button_container,
+                                remove_button_container], spacing=5)
+
+    def apply_slider(self, key, value):
+        # Runs on the throttle's thread. Values are posted to the worker like any other change, carrying the preset
+        # they were dragged in, so one that arrives after a preset switch is dropped.
+        if key[0] == 'preset':
+            self.set_preset_volume(key[1], value)
+        elif key[1] == self.current_preset.name and key[2] in self.current_preset.sounds:
+            # A sound slider of a preset that's no longer shown is dropped
+            self.set_sound_volume(key[1], key[2], value)
+
+    def post_from_slider(self, command):
+        # The slider already shows its value, the worker doesn't have to refresh the page for it
+        command['origin'] = self
+        self.queue.put(command)
+
+    def set_sound_volume(self, preset_name, sound_name, volume):
+        self.post_from_slider(set_sound_volume(sound_name, float(volume), preset_name=preset_name))
+        mute_button = self.sound_controls.get(sound_name, {}).get('mute')
+        if mute_button is not None and mute_button.value:
+            # Moving a muted sound's slider unmutes it
+            self.post_from_slider(set_sound_mute(sound_name, False, preset_name=preset_name))
+            mute_button.value = False
+            mute_button.update()
 
     def mute_current_preset(self, e):
-        self.presets_manager.mute_current_preset()
+        # The checkbox's value rather than a toggle, so it ends up where it shows whatever else is queued
+        self.queue.put(mute_preset(e.control.value))
 
     def mute_sound(self, sound_name, e):
         mute = e.control.value
-        self.presets_manager.set_sound_mute(sound_name, mute)
+        self.queue.put(set_sound_mute(sound_name, mute, preset_name=self.current_preset.name))
 
     def remove_sound(self, sound_name):
-        self.presets_manager.remove_sound(sound_name)
-        self.build_container()
+        self.queue.put(remove_sound(sound_name, preset_name=self.current_preset.name))
 
     def build_presets_column(self):
-        rows = []
+        # Only when presets were added, removed or renamed, moving between them just moves the highlight
+        self.preset_buttons = {}
         for preset_name in self.presets_manager.presets_order:
-            preset_button = ft.ElevatedButton(
+            self.preset_buttons[preset_name] = ft.ElevatedButton(
                 text=preset_name,
                 on_click=lambda e: self.change_preset(e.control.text)
             )
-            rows.append(preset_button)
-        column = ft.Column(controls=rows, spacing=5, width=200, height=350, scroll="auto")
-        container = ft.Container(content=column, padding=ft.padding.all(5))
-        return container
+        self.presets_column.controls = list(self.preset_buttons.values())
+        self.highlighted_preset = None
+        self.highlight_current_preset()
+
+    def highlight_current_preset(self):
+        if self.highlighted_preset == self.current_preset.name:
+            return
+        if self.highlighted_preset in self.preset_buttons:
+            self.preset_buttons[self.highlighted_preset].icon = None
+        self.preset_buttons[self.current_preset.name].icon = ft.icons.PLAY_ARROW_ROUNDED
+        self.highlighted_preset = self.current_preset.name
 
     def change_preset(self, preset_name):
-        self.current_preset = self.presets_manager.set_current_preset(preset_name)
-        self.build_container()
+        self.queue.put(select_preset(preset_name))
 
     def display_new_preset_dialog(self):
-        user_input_dialog = ft.TextField(label="Name", on_submit=lambda e: self.add_preset(e.control.value))
+        self.new_preset_name_field = ft.TextField(label="Name", on_submit=lambda e: self.add_preset(e.control.value))
         submit_button = ft.ElevatedButton(text='Create New Preset',
-                                          on_click=lambda _: self.add_preset(user_input_dialog.value))
+                                          on_click=lambda _: self.add_preset(self.new_preset_name_field.value))
         dialog_container = ft.Container(
-            content=ft.Column(controls=[user_input_dialog, submit_button], spacing=10),
+            content=ft.Column(controls=[self.new_preset_name_field, submit_button], spacing=10),
             height=200,
             border_radius=10,
             margin=ft.margin.all(10)
@@ -255,27 +334,32 @@ class GUI:
         self.page.dialog.open = False
 
     def add_preset(self, preset_name):
-        try:
-            self.presets_manager.add_preset(preset_name, after_preset_name=self.current_preset.name)
-        except Exception as e:
-            if 'already exists' in str(e):
-                self.page.dialog.content.content.controls[1].error_text = 'Preset with this name already exists'
-                self.page.update()
-                return
+        command = add_preset(preset_name, after_preset_name=self.current_preset.name)
+        command['reply'] = self.on_preset_added
+        self.queue.put(command)
+
+    def on_preset_added(self, result):
+        # Called on the worker thread, after the new preset became the current one
+        if not result['ok'] and 'already exists' in result['error']:
+            self.new_preset_name_field.error_text = 'Preset with this name already exists'
+            self.new_preset_name_field.update()
+            return
         self.close_dialog()
-        self.current_preset = self.presets_manager.set_current_preset(preset_name)
-        self.build_container()
+        self.page.update()
 
     def remove_preset(self, e):
-        current_preset_name = self.current_preset.name
-        self.current_preset = self.presets_manager.previous_preset()
-        self.presets_manager.remove_preset(current_preset_name)
-        self.build_container()
-
-    def set_preset_volume(self, e):
-        self.presets_manager.set_preset_volume(self.current_preset.name, float(e.control.value))
-        self.page.controls[0].controls[0].content.controls[1].controls[0].controls[2].value = False
-        self.page.update()
+        # PresetsManager moves to the previous preset first
+        self.queue.put(remove_preset(self.current_preset.name))
+
+    def set_preset_volume(self, preset_name, volume):
+        if preset_name not in self.presets_manager.presets:
+            return
+        self.post_from_slider(set_preset_volume(float(volume), preset_name=preset_name))
+        if preset_name == self.current_preset.name and self.preset_mute_toggle.value:
+            # Same as a sound slider: moving it unmutes the preset
+            self.post_from_slider(mute_preset(False, preset_name=preset_name))
+            self.preset_mute_toggle.value = False
+            self.preset_mute_toggle.update()
 
     def display_change_current_preset_name_dialog(self, e):
         new_preset_text = ft.Text(f'Change {self.current_preset.name} name to:')
@@ -293,11 +377,9 @@ class GUI:
         self.page.update()
 
     def change_preset_name(self, preset_name):
-        self.presets_manager.change_preset_name(self.current_preset.name, preset_name)
-        self.current_preset = self.presets_manager.set_current_preset(preset_name)
-        self.build_left_column()
+        self.queue.put(rename_preset(self.current_preset.name, preset_name))
         self.close_dialog()
-        self.build_container()
+        self.page.update()
 
     def display_change_hotkeys_dialog(self):
         dialog_container = self.build_change_hotkeys_dialog()
@@ -308,15 +390,20 @@ class GUI:
         self.page.update()
 
     def build_change_hotkeys_dialog(self):
+        self.hotkey_displays = {}
         previous_hotkey_row = self.build_hotkey_row('previous')
         next_hotkey_row = self.build_hotkey_row('next')
         mute_hotkey_row = self.build_hotkey_row('mute')
 
         hotkeys_column = ft.Column(controls=[previous_hotkey_row, next_hotkey_row, mute_hotkey_row],
                                    alignment='center', spacing=10)
+        self.hotkey_capture_status = ft.Text('')
+        self.hotkey_cancel_button = ft.TextButton(text='Cancel', visible=False,
+                                                  on_click=lambda _: self.hotkeys.cancel_capture())
+        status_row = ft.Row(controls=[self.hotkey_capture_status, self.hotkey_cancel_button], alignment='center')
 
         dialog_container = ft.Container(
-            content=ft.Column(controls=[hotkeys_column], spacing=10), height=150,
+            content=ft.Column(controls=[hotkeys_column, status_row], spacing=10), height=200,
             border_radius=10, alignment=ft.alignment.center, margin=ft.margin.all(10),
         )
         return dialog_container
@@ -324,16 +411,14 @@ class GUI:
     def build_hotkey_row(self, hotkey_name):
         hotkey_name_formatted = hotkey_name.capitalize()
         if hotkey_name == 'previous':
-            current_hotkey = self.hotkeys.previous
             icon = ft.Icon(name=ft.icons.KEYBOARD_ARROW_UP_ROUNDED)
         elif hotkey_name == 'next':
-            current_hotkey = self.hotkeys.next
             icon = ft.Icon(name=ft.icons.KEYBOARD_ARROW_DOWN_ROUNDED)
         elif hotkey_name == 'mute':
-            current_hotkey = self.hotkeys.mute
             icon = ft.Icon(name=ft.icons.VOLUME_OFF_ROUNDED)
         else:
             raise ValueError(f'Unknown hotkey name {hotkey_name}')
+        current_hotkey = self.hotkeys.bindings[hotkey_name]
 
         hotkey_text = ft.Text(f'{hotkey_name_formatted}', weight='w600')
         hotkey_row = ft.Row(controls=[hotkey_text, icon], alignment='spaceAround')
@@ -345,6 +430,7 @@ class GUI:
                                                  on_click=lambda e_: self.activate_hotkey_change(hotkey_name))
         button_container = ft.Container(content=change_hotkey_button, width=100, alignment=ft.alignment.center)
         hotkey_display = ft.Text(readable_hotkey, size=20)
+        self.hotkey_displays[hotkey_name] = hotkey_display
 
         display_container = ft.Container(content=hotkey_display, width=250, border_radius=10, border=ft.border.all(3),
                                          alignment=ft.alignment.center)
@@ -354,23 +440,90 @@ class GUI:
         return hotkey_row
 
     def activate_hotkey_change(self, hotkey_name):
-        self.hotkeys.set_which(hotkey_name)
-        while self.page.dialog.open:
-            if hotkey_name == 'previous':
-                self.page.dialog.content.content.controls[0].controls[0].controls[1].content.value = self.hotkeys.previous.human_readable
-            elif hotkey_name == 'next':
-                self.page.dialog.content.content.controls[0].controls[1].controls[1].content.value = self.hotkeys.next.human_readable
-            elif hotkey_name == 'mute':
-                self.page.dialog.content.content.controls[0].controls[2].controls[1].content.value = self.hotkeys.mute.human_readable
-            self.page.update()
+        # Hotkeys reports every change through on_capture_changed, nothing is polled while the dialog is open
+        if self.hotkeys.which and self.hotkeys.which != hotkey_name:
+            self.hotkeys.cancel_capture()
+        self.hotkeys.start_capture(hotkey_name, timeout=self.hotkey_capture_timeout)
+
+    def on_capture_changed(self, event):
+        # Called from the keyboard hook
+        self.capture_events.put(event)
+
+    def show_capture_events(self):
+        while True:
+            events = [self.capture_events.get()]
+            # Everything that piled up while flet was busy goes out in one update
+            while True:
+                try:
+                    events.append(self.capture_events.get_nowait())
+                except queue.Empty:
+                    break
+            if None in events:
+                return
+            try:
+                if any([self.show_capture_event(event) for event in events]):
+                    self.page.dialog.update()
+            except Exception as e:
+                # Dialog closed while the events were being shown
+                logging.exception(e)
+
+    def show_capture_event(self, event):
+        hotkey_display = self.hotkey_displays.get(event['which'])
+        if hotkey_display is None:
+            return False
+        hotkey_display.value = event['hotkey']
+        self.hotkey_capture_status.value = {
+            'capturing': 'Press the new hotkey, Esc cancels',
+            'done': 'Hotkey changed',
+            'cancelled': 'Kept the old hotkey',
+            'timeout': 'No hotkey pressed, kept the old one',
+        }[event['state']]
+        self.hotkey_cancel_button.visible = event['state'] == 'capturing'
+        return True
+
+    def display_metrics_dialog(self):
+        bottom_sheet = ft.BottomSheet(content=self.build_metrics_dialog(), open=True)
+        self.page.dialog = bottom_sheet
+        self.page.update()
+
+    def build_metrics_dialog(self):
+        snapshot = metrics.snapshot()
+        rows = []
+        for name, latency in snapshot['latency'].items():
+            if latency['count'] == 0:
+                continue
+            rows.append(ft.Text(f"{name}: p50 {latency['p50_ms']:.2f} ms, p99 {latency['p99_ms']:.2f} ms, "
+                                f"max {latency['max_ms']:.2f} ms ({latency['count']})"))
+        for name, value in snapshot['gauges'].items():
+            rows.append(ft.Text(f'{name}: {value}'))
+        refresh_button = ft.ElevatedButton(text='Refresh', on_click=lambda _: self.display_metrics_dialog())
+        save_button = ft.ElevatedButton(text='Save to file', on_click=lambda _: self.queue.put(dump_metrics()))
+        dialog_container = ft.Container(
+            content=ft.Column(controls=rows + [ft.Row(controls=[refresh_button, save_button])],
+                              spacing=5, scroll='auto'),
+            height=400, border_radius=10, margin=ft.margin.all(10),
+        )
+        return dialog_container
 
     def finish_hotkey_change(self, e):
-        self.hotkeys.set_which(False)
+        self.hotkeys.cancel_capture()
+        self.hotkey_displays = {}
         self.hotkeys.settings.save()
 
+    def on_state_changed(self):
+        self.rebuild_on_hotkey()
+
     def rebuild_on_hotkey(self):
-        self.current_preset = self.presets_manager.get_current_preset()
-        self.build_container()
+        if not self.built:
+            # Worker can finish loading audio before the window is up
+            return
+        self.show_current_preset()
+
+    def stop(self):
+        self.slider_throttle.stop()
+        self.hotkeys.remove_capture_listener(self.on_capture_changed)
+        self.capture_events.put(None)
+        self.capture_thread.join(1.0)
 
     def run(self):
         ft.app(target=self.main)
@@ -1,113 +1,226 @@
 import pynput
 
 from .preset import PresetsManager
-from .pressed_keys import PressedKeys
+from .pressed_keys import PressedKeys, key_code, is_modifier
 from .settings import HotkeySettings
+from .commands import move_preset, mute_preset
+from .metrics import metrics
 
 import queue
+import threading
+import time
 
+# Hotkey name in hotkey_settings.json -> command it posts
+ACTIONS = {
+    'next': lambda: move_preset(1),
+    'previous': lambda: move_preset(-1),
+    'mute': lambda: mute_preset(),
+}
 
 
 class Hotkeys:
 
-    def __init__(self, settings: HotkeySettings, presets_manager: PresetsManager, main_queue: queue.Queue):
+    def __init__(self, settings: HotkeySettings, presets_manager: PresetsManager, main_queue: queue.Queue,
+                 repeat_rate=None):
         self.settings = settings
         self.pressed_keys = PressedKeys()
-        self.next = PressedKeys(hashed=self.settings.settings['next'])
-        self.previous = PressedKeys(hashed=self.settings.settings['previous'])
-        self.mute = PressedKeys(hashed=self.settings.settings['mute'])
+        self.bindings = {which: self.settings.get_hotkey(which) for which in ACTIONS}
+        # Chord (frozenset of key codes) -> command factory, every key event is one lookup here
+        self.dispatch = {}
+        self.build_dispatch()
 
         self.presets_manager = presets_manager
         self.main_queue = main_queue
 
+        # A hotkey fires once per press. Holding it only fires again if repeat_rate is set, at most that many times a
+        # second, instead of once per OS auto-repeat.
+        self.repeat_interval = 1 / repeat_rate if repeat_rate else None
+        self.last_fired = 0.0
+        self.repeats_suppressed = 0
+
         self.which = False
+        self.listener = None
+
+        # Hotkey capture: callbacks get {'which', 'state', 'hotkey'} whenever what the capture shows changes, with
+        # state one of 'capturing', 'done', 'cancelled' or 'timeout'. They're called from the keyboard hook.
+        self.capture_listeners = []
+        self.capture_lock = threading.Lock()
+        self.capture_timer = None
+        self.captured = None
+        # The capture times out after capture_timeout seconds without a key event, not after it started
+        self.capture_timeout = None
+        self.capture_activity = 0.0
+
+        # Time spent inside the keyboard hook per event, in nanoseconds
+        self.events = 0
+        self.event_time_total = 0
+        self.event_time_max = 0
 
     def run(self):
         with pynput.keyboard.Listener(on_press=self.on_press, on_release=self.on_release) as self.listener:
             self.listener.join()
 
+    def stop(self):
+        # Listener only exists once run() got going on its thread
+        if self.listener is not None:
+            self.listener.stop()
+
     def on_press(self, key):
+        start = time.perf_counter_ns()
         if self.which:
             self.on_press_change(key)
         else:
             self.on_press_default(key)
+        self.record_event(time.perf_counter_ns() - start)
+        if metrics.enabled:
+            metrics.record('hotkeys.on_press', (time.perf_counter_ns() - start) / 1e9)
 
     def on_release(self, key):
+        start = time.perf_counter_ns()
         if self.which:
             self.on_release_change(key)
         else:
             self.on_release_default(key)
+        self.record_event(time.perf_counter_ns() - start)
+
+    def record_event(self, elapsed):
+        self.events += 1
+        self.event_time_total += elapsed
+        if elapsed > self.event_time_max:
+            self.event_time_max = elapsed
+
+    def stats(self):
+        return {
+            'events': self.events,
+            'mean_ns': self.event_time_total / self.events if self.events else 0,
+            'max_ns': self.event_time_max,
+            'repeats_suppressed': self.repeats_suppressed,
+        }
+
+    def build_dispatch(self):
+        self.dispatch = {hotkey.chord: ACTIONS[which] for which, hotkey in self.bindings.items() if hotkey.chord}
+
+    def update_pressed(self, key):
+        if is_modifier(key):
+            self.pressed_keys.add_modifier(key_code(key))
+        else:
+            self.pressed_keys.set_key(key_code(key))
 
     def on_press_default(self, key):
-        try:
-            if key.value is not None:
-                self.pressed_keys.add_modifier(key)
-        except AttributeError:
-            self.pressed_keys.set_key(key)
-        if self.pressed_keys.hashed == self.next.hashed:
-            self.presets_manager.next_preset()
-            self.main_queue.put({
-                'name': 'next_preset'
-            })
-        elif self.pressed_keys.hashed == self.previous.hashed:
-            self.presets_manager.previous_preset()
-            self.main_queue.put({
-                'name': 'previous_preset'
-            })
-        elif self.pressed_keys.hashed == self.mute.hashed:
-            self.presets_manager.mute_current_preset()
-            self.main_queue.put({
-                'name': 'mute_preset'
-            })
-        else:
-            pass
+        held = self.pressed_keys.chord
+        self.update_pressed(key)
+        # This runs inside the OS keyboard hook, only post a command and let the worker do the actual work
+        action = self.dispatch.get(self.pressed_keys.chord)
+        if action is None:
+            return
+        if self.pressed_keys.chord == held:
+            # Same keys as before the event: auto-repeat of a key that's being held down
+            if self.repeat_interval is None or time.monotonic() - self.last_fired < self.repeat_interval:
+                self.repeats_suppressed += 1
+                return
+        self.last_fired = time.monotonic()
+        self.post(action())
+
+    def post(self, command):
+        if metrics.enabled:
+            # Worker measures queue wait and time until the new gains are on the channels from here
+            command['created'] = time.perf_counter()
+        self.main_queue.put(command)
 
     def on_press_change(self, key):
-        try:
-            if key == pynput.keyboard.Key.esc:
-                self.which = False
-                return False
-            if key.value is not None:
-                self.pressed_keys.add_modifier(key)
-        except AttributeError as e:
-            if "'KeyCode' object has no attribute 'value'" in str(e):
-                self.pressed_keys.set_key(key)
-            else:
-                raise e
+        # Only a timestamp here, the timer checks it when it fires
+        self.capture_activity = time.monotonic()
+        if key == pynput.keyboard.Key.esc:
+            # Returning False here used to stop the listener, and with it every hotkey
+            self.cancel_capture()
+            return
+        self.update_pressed(key)
+        # Auto-repeat of a held key changes nothing, so it doesn't reach the GUI
+        if self.pressed_keys.chord != self.captured:
+            self.captured = self.pressed_keys.chord
+            self.capture_changed('capturing', self.pressed_keys.human_readable)
 
     def on_release_default(self, key):
-        try:
-            if key.value is not None:
-                self.pressed_keys.remove_modifier(key)
-        except AttributeError as e:
-            if "'KeyCode' object has no attribute 'value'" in str(e):
-                self.pressed_keys.remove_key()
-        except KeyError:
-            pass
+        if is_modifier(key):
+            self.pressed_keys.remove_modifier(key_code(key))
+        else:
+            self.pressed_keys.remove_key()
 
     def on_release_change(self, key):
-        try:
-            if key.value is not None:
-                try:
-                    self.pressed_keys.remove_modifier(key)
-                except KeyError:
-                    pass
-        except AttributeError as e:
-            if "'KeyCode' object has no attribute 'value'" in str(e):
-                if self.which == 'next':
-                    self.settings.set_hotkey('next', self.pressed_keys)
-                    self.next = PressedKeys(hashed=self.settings.settings['next'])
-                    self.which = False
-                elif self.which == 'previous':
-                    self.settings.set_hotkey('previous', self.pressed_keys)
-                    self.previous = PressedKeys(hashed=self.settings.settings['previous'])
-                    self.which = False
-                elif self.which == 'mute':
-                    self.settings.set_hotkey('mute', self.pressed_keys)
-                    self.mute = PressedKeys(hashed=self.settings.settings['mute'])
-                    self.which = False
-            else:
-                raise e
-
-    def set_which(self, which):
-        self.which = which
+        self.capture_activity = time.monotonic()
+        if is_modifier(key):
+            self.pressed_keys.remove_modifier(key_code(key))
+        else:
+            self.finish_capture()
+
+    def start_capture(self, which, timeout=None):
+        # The next combination ending in a non-modifier key becomes the hotkey for which. Esc, cancel_capture() or
+        # the timeout give up and keep the old one.
+        with self.capture_lock:
+            self.cancel_timer()
+            self.which = which
+            self.captured = None
+            self.capture_timeout = timeout
+            self.capture_activity = time.monotonic()
+            if timeout:
+                self.start_timer(timeout)
+        self.capture_changed('capturing', 'Press new hotkey')
+
+    def start_timer(self, delay):
+        self.capture_timer = threading.Timer(delay, self.on_capture_timer)
+        self.capture_timer.daemon = True
+        self.capture_timer.start()
+
+    def on_capture_timer(self):
+        with self.capture_lock:
+            if self.capture_timer is not threading.current_thread():
+                # Cancelled, or a newer capture started, while this one was about to fire
+                return
+            remaining = self.capture_activity + self.capture_timeout - time.monotonic()
+            if remaining > 0:
+                # Keys were pressed since the timer started
+                self.start_timer(remaining)
+                return
+            which = self.which
+            self.which = False
+            self.capture_timer = None
+        self.capture_changed('timeout', self.bindings[which].human_readable, which=which)
+
+    def finish_capture(self):
+        with self.capture_lock:
+            which = self.which
+            if which not in ACTIONS:
+                return
+            self.settings.set_hotkey(which, self.pressed_keys)
+            self.bindings[which] = self.settings.get_hotkey(which)
+            self.build_dispatch()
+            self.which = False
+            self.cancel_timer()
+        self.capture_changed('done', self.bindings[which].human_readable, which=which)
+
+    def cancel_capture(self, state='cancelled'):
+        with self.capture_lock:
+            which = self.which
+            if not which:
+                return
+            self.which = False
+            self.cancel_timer()
+        self.capture_changed(state, self.bindings[which].human_readable, which=which)
+
+    def cancel_timer(self):
+        if self.capture_timer is not None:
+            self.capture_timer.cancel()
+            self.capture_timer = None
+
+    def add_capture_listener(self, listener):
+        self.capture_listeners.append(listener)
+
+    def remove_capture_listener(self, listener):
+        if listener in self.capture_listeners:
+            self.capture_listeners.remove(listener)
+
+    def capture_changed(self, state, hotkey, which=None):
+        event = {'which': which or self.which, 'state': state, 'hotkey': hotkey}
+        for listener in list(self.capture_listeners):
+            listener(event)
+
@@ -0,0 +1,324 @@
+import os
+import sys
+import json
+import sqlite3
+import threading
+
+from .settings import PresetSettings, PresetsManagerSettings, InternalSettings
+# Single-file preset library in SQLite, an alternative to one JSON file per preset
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS presets (
+    name TEXT PRIMARY KEY,
+    position REAL NOT NULL,
+    volume REAL NOT NULL,
+    mute INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS presets_position ON presets (position);
+CREATE TABLE IF NOT EXISTS sounds (
+    preset TEXT NOT NULL REFERENCES presets (name) ON UPDATE CASCADE ON DELETE CASCADE,
+    name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    volume REAL NOT NULL,
+    mute INTEGER NOT NULL,
+    generator TEXT,
+    seed INTEGER,
+    PRIMARY KEY (preset, name)
+);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class PresetLibrary:
+    def __init__(self, library_location="presets.sqlite3"):
+        self.library_location = library_location
+        self.lock = threading.RLock()
+        # Presets are saved from the write-behind timer threads as well as the worker
+        self.connection = sqlite3.connect(library_location, check_same_thread=False)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+        # Libraries made before generator layers existed
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(sounds)")]
+        for column, column_type in (("generator", "TEXT"), ("seed", "INTEGER")):
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE sounds ADD COLUMN {column} {column_type}")
+
+    def is_empty(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM presets").fetchone()[0] == 0
+
+    def presets_order(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT name FROM presets ORDER BY position").fetchall()
+        return [row[0] for row in rows]
+
+    def positions(self):
+        with self.lock:
+            return dict(self.connection.execute("SELECT name, position FROM presets").fetchall())
+
+    def load_preset(self, preset_name):
+        with self.lock:
+            row = self.connection.execute("SELECT volume, mute FROM presets WHERE name = ?",
+                                          (preset_name,)).fetchone()
+            if row is None:
+                raise KeyError(preset_name)
+            rows = self.connection.execute(
+                "SELECT name, path, volume, mute, generator, seed FROM sounds WHERE preset = ?",
+                (preset_name,)).fetchall()
+        sounds = {}
+        for name, path, volume, mute, generator, seed in rows:
+            if generator is not None:
+                sounds[name] = {"generator": generator, "volume": volume, "mute": bool(mute)}
+                if seed is not None:
+                    sounds[name]["seed"] = seed
+            else:
+                sounds[name] = {"path": path, "volume": volume, "mute": bool(mute)}
+        return {
+            "name": preset_name,
+            "volume": row[0],
+            "mute": bool(row[1]),
+            "sounds": sounds,
+        }
+
+    def save_preset(self, settings):
+        # One transaction touching only this preset's rows
+        with self.lock, self.connection:
+            self.write_preset(settings)
+
+    def write_preset(self, settings):
+        self.connection.execute("UPDATE presets SET volume = ?, mute = ? WHERE name = ?",
+                                (settings["volume"], int(settings["mute"]), settings["name"]))
+        self.connection.execute("DELETE FROM sounds WHERE preset = ?", (settings["name"],))
+        self.connection.executemany(
+            "INSERT INTO sounds (preset, name, path, volume, mute, generator, seed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(settings["name"], name, sound.get("path", ""), sound["volume"], int(sound["mute"]),
+              sound.get("generator"), sound.get("seed"))
+             for name, sound in settings["sounds"].items()])
+
+    def add_preset(self, preset_name, position, volume=50, mute=True):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO presets (name, position, volume, mute) VALUES (?, ?, ?, ?)",
+                                    (preset_name, position, volume, int(mute)))
+
+    def remove_preset(self, preset_name):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM presets WHERE name = ?", (preset_name,))
+
+    def rename_preset(self, preset_name, new_preset_name):
+        # Sounds follow through ON UPDATE CASCADE
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE presets SET name = ? WHERE name = ?", (new_preset_name, preset_name))
+
+    def set_position(self, preset_name, position):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE presets SET position = ? WHERE name = ?", (position, preset_name))
+
+    def renumber(self, presets_order):
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE presets SET position = ? WHERE name = ?",
+                                        [(float(index), name) for index, name in enumerate(presets_order)])
+
+    def get_state(self, key, default=None):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", (key, value))
+
+    def import_json(self, presets_manager_settings: PresetsManagerSettings):
+        # Copy a JSON library (manager settings + preset files) in, keeping its order and current preset
+        settings = presets_manager_settings.settings
+        with self.lock, self.connection:
+            for position, preset_name in enumerate(settings["presets_order"]):
+                preset_settings = PresetSettings(settings["presets"][preset_name],
+                                                 internal_settings=presets_manager_settings.internal_settings)
+                self.connection.execute(
+                    "INSERT OR REPLACE INTO presets (name, position, volume, mute) VALUES (?, ?, ?, ?)",
+                    (preset_name, float(position), preset_settings.settings["volume"],
+                     int(preset_settings.settings["mute"])))
+                self.write_preset(dict(preset_settings.settings, name=preset_name))
+            self.connection.execute("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                                    ("current_preset", settings["current_preset"]))
+
+    def export_json(self, presets_dir, settings_file_location):
+        # Write the library back out in the one-file-per-preset layout
+        if not os.path.exists(presets_dir):
+            os.mkdir(presets_dir)
+        presets_order = self.presets_order()
+        manager_settings = {
+            "presets": {},
+            "presets_order": presets_order,
+            "current_preset": self.get_state("current_preset", presets_order[0] if presets_order else "None"),
+        }
+        for preset_name in presets_order:
+            preset_path = os.path.join(presets_dir, preset_name + ".json")
+            with open(preset_path, "w") as f:
+                json.dump(self.load_preset(preset_name), f, indent=4, sort_keys=True)
+            manager_settings["presets"][preset_name] = preset_path
+        with open(settings_file_location, "w") as f:
+            json.dump(manager_settings, f, indent=4, sort_keys=True)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class LibraryPresetSettings(PresetSettings):
+    # Same interface as PresetSettings, but the preset is a row in a PresetLibrary instead of a file
+    def __init__(self, library: PresetLibrary, preset_name, internal_settings=None):
+        self.library = library
+        super().__init__(settings_file_location=library.library_location, internal_settings=internal_settings,
+                         name=preset_name)
+
+    def load(self):
+        # A preset missing from the library raises KeyError, there is no file to create
+        settings = self.library.load_preset(self.name)
+        self.last_written = self.dumps_settings(settings)
+        return settings
+
+    def dumps(self):
+        return self.dumps_settings(self.settings)
+
+    @staticmethod
+    def dumps_settings(settings):
+        return json.dumps(settings, sort_keys=True)
+
+    def write(self, content):
+        self.library.save_preset(self.settings)
+
+
+class LibraryPresetsManagerSettings(PresetsManagerSettings):
+    # Same interface as PresetsManagerSettings. Rename, delete and reorder each touch a single row.
+    def __init__(self, library: PresetLibrary, internal_settings=None):
+        self.library = library
+        super().__init__(settings_file_location=library.library_location, internal_settings=internal_settings)
+
+    def load(self):
+        presets_order = self.library.presets_order()
+        self.positions = self.library.positions()
+        settings = {
+            # Presets are looked up by name, there is no path any more
+            "presets": {preset_name: preset_name for preset_name in presets_order},
+            "presets_order": presets_order,
+            "current_preset": self.library.get_state("current_preset", presets_order[0] if presets_order else "None"),
+        }
+        self.last_written = settings["current_preset"]
+        return settings
+
+    def dumps(self):
+        # Only the current preset is kept as state, everything else is written by the method that changed it
+        return self.settings["current_preset"]
+
+    def write(self, content):
+        self.library.set_state("current_preset", content)
+
+    def open_preset(self, preset_name):
+        return LibraryPresetSettings(self.library, preset_name, internal_settings=self.internal_settings)
+
+    def position_between(self, previous_name, next_name):
+        if previous_name is None and next_name is None:
+            return 0.0
+        if previous_name is None:
+            return self.positions[next_name] - 1.0
+        if next_name is None:
+            return self.positions[previous_name] + 1.0
+        position = (self.positions[previous_name] + self.positions[next_name]) / 2
+        if position in (self.positions[previous_name], self.positions[next_name]):
+            # Ran out of float precision between the two, spread everything out again
+            self.library.renumber([name for name in self.settings["presets_order"] if name in self.positions])
+            self.positions = self.library.positions()
+            position = (self.positions[previous_name] + self.positions[next_name]) / 2
+        return position
+
+    def position_at(self, preset_name):
+        presets_order = self.settings["presets_order"]
+        index = presets_order.index(preset_name)
+        previous_name = presets_order[index - 1] if index > 0 else None
+        next_name = presets_order[index + 1] if index + 1 < len(presets_order) else None
+        return self.position_between(previous_name, next_name)
+
+    def add_preset(self, preset_name, to_order=True):
+        with self.lock:
+            if preset_name in self.settings["presets"]:
+                raise ValueError("Preset with name {} already exists".format(preset_name))
+            if to_order:
+                self.settings["presets_order"].append(preset_name)
+            position = self.position_at(preset_name)
+            self.library.add_preset(preset_name, position)
+            self.positions[preset_name] = position
+            self.settings["presets"][preset_name] = preset_name
+
+    def remove_preset(self, preset_name):
+        with self.lock:
+            self.library.remove_preset(preset_name)
+            del self.settings["presets"][preset_name]
+            del self.positions[preset_name]
+            self.settings["presets_order"].remove(preset_name)
+            if self.settings["current_preset"] == preset_name:
+                # Only happens when the last preset goes, PresetsManager moves away from the current one first
+                presets_order = self.settings["presets_order"]
+                self.settings["current_preset"] = presets_order[0] if presets_order else "None"
+
+    def change_preset_order(self, preset_name, after_preset_name):
+        with self.lock:
+            if preset_name not in self.settings["presets"]:
+                raise ValueError("Preset does not exist")
+            if after_preset_name not in self.settings["presets"]:
+                raise ValueError("Preset does not exist")
+            self.settings["presets_order"].remove(preset_name)
+            self.settings["presets_order"].insert(self.settings["presets_order"].index(after_preset_name) + 1, preset_name)
+            position = self.position_at(preset_name)
+            self.library.set_position(preset_name, position)
+            self.positions[preset_name] = position
+            return self.settings["presets_order"]
+
+    def change_preset_name(self, preset_name, new_preset_name):
+        with self.lock:
+            if preset_name not in self.settings["presets"]:
+                raise ValueError("Preset does not exist")
+            if new_preset_name in self.settings["presets"]:
+                raise ValueError(f"Preset with name {new_preset_name} already exists")
+            self.library.rename_preset(preset_name, new_preset_name)
+            if preset_name == self.settings["current_preset"]:
+                self.settings["current_preset"] = new_preset_name
+            del self.settings["presets"][preset_name]
+            self.settings["presets"][new_preset_name] = new_preset_name
+            self.positions[new_preset_name] = self.positions.pop(preset_name)
+            preset_index = self.settings["presets_order"].index(preset_name)
+            self.settings["presets_order"][preset_index] = new_preset_name
+            return new_preset_name
+
+
+def open_library(internal_settings: InternalSettings, settings_file_location="preset_manager_settings.json"):
+    # First start with the SQLite backend: bring in the existing JSON presets
+    library = PresetLibrary(internal_settings.library_location)
+    if library.is_empty():
+        library.import_json(PresetsManagerSettings(settings_file_location=settings_file_location,
+                                                   internal_settings=internal_settings))
+    return LibraryPresetsManagerSettings(library, internal_settings=internal_settings)
+
+
+def main(argv):
+    # python -m stimulant_noise.library import|export
+    internal_settings = InternalSettings(settings_file_location="internal_settings.json")
+    library = PresetLibrary(internal_settings.library_location)
+    if len(argv) == 2 and argv[1] == "import":
+        library.import_json(PresetsManagerSettings(settings_file_location="preset_manager_settings.json",
+                                                   internal_settings=internal_settings))
+    elif len(argv) == 2 and argv[1] == "export":
+        library.export_json(internal_settings.presets_dir, "preset_manager_settings.json")
+    else:
+        print("Usage: python -m stimulant_noise.library import|export")
+        return 1
+    library.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
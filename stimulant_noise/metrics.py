@@ -0,0 +1,106 @@
+import json
+import math
+import os
+import threading
+import time
+# Latency histograms and resource gauges. Off by default, every call site checks metrics.enabled first.
+
+# Half-octave buckets over microseconds: bucket 2 * e (+1) holds samples below 2^e (or 2^e * sqrt 2)
+BUCKETS = 64
+HALF_OCTAVE = math.sqrt(0.5)
+
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        mantissa, exponent = math.frexp(seconds * 1e6)
+        bucket = min(max(2 * exponent - (mantissa < HALF_OCTAVE), 0), BUCKETS - 1)
+        with self.lock:
+            self.buckets[bucket] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def percentile(self, fraction):
+        # Upper edge of the bucket the sample falls in, in seconds
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= target:
+                return min(2 ** (bucket / 2) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        with self.lock:
+            if self.count == 0:
+                return {"count": 0}
+            return {
+                "count": self.count,
+                "mean_ms": self.total / self.count * 1000,
+                "p50_ms": self.percentile(0.5) * 1000,
+                "p90_ms": self.percentile(0.9) * 1000,
+                "p99_ms": self.percentile(0.99) * 1000,
+                "max_ms": self.max * 1000,
+            }
+
+
+class Metrics:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        # Gauges are read only when a snapshot is taken, so they cost nothing in between
+        self.gauges = {}
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+
+    def record(self, name, seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(name, Histogram())
+        histogram.record(seconds)
+
+    def since(self, name, start):
+        self.record(name, time.perf_counter() - start)
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = repr(e)
+        with self.lock:
+            histograms = dict(self.histograms)
+        return {
+            "enabled": self.enabled,
+            "uptime_seconds": time.time() - self.started_at,
+            "latency": {name: histogram.snapshot() for name, histogram in sorted(histograms.items())},
+            "gauges": gauges,
+        }
+
+    def dump(self, file):
+        temporary_file = file + ".tmp"
+        with open(temporary_file, "w") as f:
+            json.dump(self.snapshot(), f, indent=4)
+        os.replace(temporary_file, file)
+        return file
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+        self.started_at = time.time()
+
+
+metrics = Metrics()
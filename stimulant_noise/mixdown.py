@@ -0,0 +1,183 @@
+import os
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import pygame as pg
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .sound_cache import resolve_path
+from .mixer import load_array
+# Presets rendered into one loopable buffer at their saved volumes, cached on disk, played on a single channel
+
+# Part of every key, bumped when render() changes so mixdowns rendered the old way are done again
+RENDER_VERSION = 2
+
+
+def mixdown_available():
+    return np is not None
+
+
+class MixdownCache:
+    def __init__(self, cache_dir, sound_cache, make_layer=None, max_bytes=512 * 1024 * 1024, loaded_max=3,
+                 seam_seconds=0.25):
+        self.cache_dir = cache_dir
+        # Layers already decoded for normal playback are reused instead of decoded again
+        self.sound_cache = sound_cache
+        # Turns a rendered array into something Audio can play, a pygame Sound unless told otherwise
+        self.make_layer = make_layer if make_layer is not None else pg.sndarray.make_sound
+        self.max_bytes = max_bytes
+        self.loaded_max = loaded_max
+        # Crossfade where a shorter layer is cut off by the end of the mixdown
+        self.seam_seconds = seam_seconds
+        self.loaded = OrderedDict()
+        # Key Audio is about to play, the prefetcher preparing neighbours must not evict it before layer() is called
+        self.pinned = None
+        self.preset_keys = {}
+        self.lock = threading.RLock()
+
+        self.renders = 0
+        self.disk_hits = 0
+        self.memory_hits = 0
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def eligible(self, preset, is_streamed):
+        # Generators never repeat and streamed files are too long to hold rendered, those presets play live
+        if not preset.sounds:
+            return False
+        for sound_settings in preset.sounds.values():
+            if 'path' not in sound_settings or is_streamed(sound_settings['path']):
+                return False
+        return True
+
+    def key(self, preset):
+        # Anything that changes what the mixdown sounds like has to be in here. Preset volume and mute aren't,
+        # they are applied live on the mixdown's channel.
+        frequency, size, channels = pg.mixer.get_init()
+        inputs = [RENDER_VERSION, frequency, size, channels]
+        for sound_name in sorted(preset.sounds):
+            sound_settings = preset.sounds[sound_name]
+            path = resolve_path(sound_settings['path'])
+            stat = os.stat(path)
+            inputs.append([path, stat.st_mtime, stat.st_size, sound_settings['volume'], sound_settings['mute']])
+        return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def prepare(self, preset, pin=False):
+        # Render or load the preset's mixdown, returns its key
+        key = self.key(preset)
+        with self.lock:
+            if pin:
+                self.pinned = key
+            old_key = self.preset_keys.get(preset.name)
+            # Before invalidating, so the old key only counts as used if another preset renders to it too
+            self.preset_keys[preset.name] = key
+            if old_key is not None and old_key != key:
+                # Inputs changed since the last render, that file is of no use any more
+                self.invalidate(old_key)
+            if key in self.loaded:
+                self.loaded.move_to_end(key)
+                self.memory_hits += 1
+                return key
+        if os.path.exists(self.path(key)):
+            array = np.load(self.path(key), mmap_mode='r')
+            os.utime(self.path(key))
+            self.disk_hits += 1
+        else:
+            array = self.render(preset)
+            self.store(key, array)
+            self.renders += 1
+        with self.lock:
+            self.loaded[key] = self.make_layer(np.ascontiguousarray(array))
+            while len(self.loaded) > self.loaded_max:
+                oldest = next(loaded_key for loaded_key in self.loaded if loaded_key != self.pinned)
+                del self.loaded[oldest]
+        return key
+
+    def is_loaded(self, preset):
+        with self.lock:
+            return self.preset_keys.get(preset.name) in self.loaded
+
+    def layer(self, key):
+        with self.lock:
+            return self.loaded[key]
+
+    def load_layer_array(self, path):
+        frequency, size, channels = pg.mixer.get_init()
+        if path not in self.sound_cache:
+            # Not worth pushing the playing layers out of the cache for a one-off render
+            return load_array(path)
+        sound = self.sound_cache.get(path)
+        if not isinstance(sound, np.ndarray):
+            sound = pg.sndarray.array(sound)
+        return sound.reshape(-1, channels)
+
+    def render(self, preset):
+        frequency, size, channels = pg.mixer.get_init()
+        arrays = []
+        for sound_settings in preset.sounds.values():
+            if sound_settings['mute']:
+                continue
+            array = self.load_layer_array(sound_settings['path'])
+            arrays.append((array, float(sound_settings['volume']) / 100))
+        if not arrays:
+            return np.zeros((frequency, channels), dtype=np.int16)
+        # One pass of the longest layer, shorter layers loop inside it
+        length = max(len(array) for array, gain in arrays)
+        mix = np.zeros((length, channels), dtype=np.float32)
+        for array, gain in arrays:
+            scale = gain / 32768 if array.dtype == np.int16 else gain
+            repeats = -(-length // len(array))
+            layer = np.tile(array, (repeats, 1))[:length].astype(np.float32)
+            if length % len(array):
+                # The mixdown ends partway through this layer and loops back to the layer's start. Its last frames
+                # are crossfaded into the ones that lead up to that start, so the loop has no jump in it.
+                fade = min(int(frequency * self.seam_seconds), len(array))
+                if fade:
+                    shape = np.linspace(0, np.pi / 2, fade, dtype=np.float32)[:, None]
+                    lead_in = array[len(array) - fade:].astype(np.float32)
+                    layer[length - fade:] = layer[length - fade:] * np.cos(shape) + lead_in * np.sin(shape)
+            mix += layer * np.float32(scale)
+        if size == -16:
+            return (np.clip(mix, -1.0, 1.0) * 32767).astype(np.int16)
+        return mix
+
+    def store(self, key, array):
+        temporary_path = self.path(key) + ".tmp.npy"
+        np.save(temporary_path, array)
+        os.replace(temporary_path, self.path(key))
+        self.evict()
+
+    def evict(self):
+        # Least recently used files go first once the directory is over its size cap
+        files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith(".npy")]
+        files.sort(key=os.path.getmtime)
+        total = sum(os.path.getsize(path) for path in files)
+        for path in files:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def invalidate(self, key):
+        with self.lock:
+            self.loaded.pop(key, None)
+            if key not in self.preset_keys.values() and os.path.exists(self.path(key)):
+                os.remove(self.path(key))
+
+    def stats(self):
+        return {
+            "renders": self.renders,
+            "disk_hits": self.disk_hits,
+            "memory_hits": self.memory_hits,
+            "loaded": len(self.loaded),
+        }
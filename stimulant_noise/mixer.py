@@ -0,0 +1,175 @@
+import threading
+
+import pygame as pg
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .sound_cache import SoundCache
+from .streaming import StreamingSound, FileBlockSource
+# Software mixer: all layers are summed with NumPy into one output stream on a single mixer channel
+
+
+def software_mixer_available():
+    return np is not None
+
+
+def load_array(path):
+    # Decode with pygame so every format it reads works here too, then keep only the samples
+    frequency, size, channels = pg.mixer.get_init()
+    array = pg.sndarray.array(pg.mixer.Sound(path))
+    return array.reshape(-1, channels)
+
+
+# Decoded layers as arrays, same LRU budget logic as the pygame sound cache
+array_cache = SoundCache(loader=load_array)
+
+
+class ArraySource:
+    # Loops over a decoded array, handing out float blocks
+    def __init__(self, array):
+        self.array = array
+        self.position = 0
+        if array.dtype == np.int16:
+            self.scale = np.float32(1 / 32768)
+        else:
+            self.scale = np.float32(1.0)
+
+    def read(self, frames):
+        length = len(self.array)
+        end = self.position + frames
+        if end <= length:
+            block = self.array[self.position:end]
+        else:
+            # Wrap around, tiling if the array is shorter than the block
+            indices = np.arange(self.position, end) % length
+            block = self.array[indices]
+        self.position = end % length
+        return block.astype(np.float32) * self.scale
+
+    def skip(self, frames):
+        self.position = (self.position + frames) % len(self.array)
+
+    def close(self):
+        self.array = None
+
+
+class MixerLayer:
+    # Quacks like pg.mixer.Sound, but playing only means being summed by the SoftwareMixer
+    def __init__(self, software_mixer, open_source):
+        self.software_mixer = software_mixer
+        self.open_source = open_source
+        self.source = None
+        self.volume = 1.0
+        # Gain the last block ended on, so gain changes are ramped across a block instead of clicking
+        self.applied_volume = 0.0
+
+    def play(self, loops=-1):
+        if self.source is None:
+            self.source = self.open_source()
+            self.applied_volume = self.volume
+            self.software_mixer.add(self)
+
+    def stop(self):
+        if self.source is not None:
+            # The pump may be reading this source right now, the mixer closes it once that block is done
+            self.software_mixer.remove(self)
+            self.source = None
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def get_volume(self):
+        return self.volume
+
+    def get_num_channels(self):
+        return 0 if self.source is None else 1
+
+    def get_length(self):
+        return 0.0
+
+
+class SoftwareMixer:
+    def __init__(self, block_seconds=0.05):
+        self.frequency, size, self.channels = pg.mixer.get_init()
+        self.layers = []
+        # Sources of layers removed since the last block, closed on the pump thread before it reads the next one
+        self.closing = []
+        self.lock = threading.Lock()
+
+        self.peak = 0.0
+        self.blocks_mixed = 0
+        self.layers_mixed = 0
+        self.layers_skipped = 0
+
+        # Short blocks, as gain changes only reach the speakers once queued blocks have played
+        self.output = StreamingSound(source=self, block_seconds=block_seconds, ring_blocks=1)
+
+    def start(self):
+        self.output.set_volume(1.0)
+        self.output.play()
+
+    def stop(self):
+        # Returns once the pump is done with its block, nothing reads the sources after that
+        self.output.stop()
+        self.close_removed()
+
+    def add(self, layer):
+        with self.lock:
+            self.layers.append(layer)
+
+    def remove(self, layer):
+        with self.lock:
+            if layer in self.layers:
+                self.layers.remove(layer)
+                self.closing.append(layer.source)
+
+    def close_removed(self):
+        with self.lock:
+            closing, self.closing = self.closing, []
+        for source in closing:
+            source.close()
+
+    def read(self, frames):
+        self.close_removed()
+        output = np.zeros((frames, self.channels), dtype=np.float32)
+        with self.lock:
+            # Sources taken with the layers, a layer stopped meanwhile keeps its source open until the next block
+            layers = [(layer, layer.source) for layer in self.layers]
+        for layer, source in layers:
+            start, end = layer.applied_volume, layer.volume
+            layer.applied_volume = end
+            if start == 0 and end == 0:
+                # Muted layers cost nothing but keeping their place
+                source.skip(frames)
+                self.layers_skipped += 1
+                continue
+            block = source.read(frames)
+            if start == end:
+                block *= np.float32(end)
+            else:
+                block *= np.linspace(start, end, frames, dtype=np.float32)[:, None]
+            output += block
+            self.layers_mixed += 1
+        self.blocks_mixed += 1
+        self.peak = float(np.abs(output).max()) if frames else 0.0
+        return output
+
+    def close(self):
+        pass
+
+    def load_layer(self, path, streamed=False):
+        if streamed:
+            return MixerLayer(self, lambda: FileBlockSource(path))
+        return MixerLayer(self, lambda: ArraySource(array_cache.get(path)))
+
+    def stats(self):
+        return {
+            "layers": len(self.layers),
+            "blocks_mixed": self.blocks_mixed,
+            "layers_mixed": self.layers_mixed,
+            "layers_skipped": self.layers_skipped,
+            "peak": self.peak,
+        }
@@ -0,0 +1,169 @@
+import os
+import sys
+import mmap
+import hashlib
+import json
+import threading
+
+import pygame as pg
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .settings import InternalSettings, PresetsManagerSettings
+from .sound_cache import resolve_path
+from .streaming import should_stream
+# Decoded sounds kept on disk in the mixer's own format, so a file is decoded once and not on every start
+
+ARRAY_TYPES = {-16: "int16", 16: "uint16", -8: "int8", 8: "uint8", 32: "float32"}
+
+
+class PcmCache:
+    def __init__(self, cache_dir, max_bytes=1024 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def key(self, path):
+        # A different source file or mixer format can't reuse old PCM
+        path = resolve_path(path)
+        stat = os.stat(path)
+        inputs = [path, stat.st_size, stat.st_mtime, pg.mixer.get_init()]
+        return hashlib.sha1(json.dumps(inputs).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".pcm")
+
+    def open(self, path):
+        # Memory map of the cached PCM, or None on a miss
+        cache_path = self.path(self.key(path))
+        try:
+            with open(cache_path, 'rb') as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return None
+                mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+        # Modification time doubles as last use, for eviction
+        os.utime(cache_path)
+        with self.lock:
+            self.hits += 1
+        return mapped
+
+    def store(self, path, raw):
+        cache_path = self.path(self.key(path))
+        temporary_path = cache_path + ".tmp"
+        with open(temporary_path, 'wb') as file:
+            file.write(raw)
+        os.replace(temporary_path, cache_path)
+        with self.lock:
+            self.misses += 1
+        self.evict()
+
+    def load_sound(self, path):
+        # Drop-in for pg.mixer.Sound(path) as a SoundCache loader
+        mapped = self.open(path)
+        if mapped is None:
+            sound = pg.mixer.Sound(path)
+            self.store(path, sound.get_raw())
+            return sound
+        try:
+            return pg.mixer.Sound(buffer=mapped)
+        finally:
+            mapped.close()
+
+    def load_array(self, path):
+        # Same for the software mixer, the array stays backed by the mapped file instead of being copied
+        frequency, size, channels = pg.mixer.get_init()
+        mapped = self.open(path)
+        if mapped is None:
+            array = pg.sndarray.array(pg.mixer.Sound(path)).reshape(-1, channels)
+            self.store(path, array.tobytes())
+            return array
+        return np.frombuffer(mapped, dtype=ARRAY_TYPES[size]).reshape(-1, channels)
+
+    def warm(self, path):
+        # Decode into the cache without keeping anything in memory, returns True if it had to decode
+        mapped = self.open(path)
+        if mapped is not None:
+            mapped.close()
+            return False
+        self.store(path, pg.mixer.Sound(path).get_raw())
+        return True
+
+    def evict(self):
+        # Least recently used files go first. A file still mapped by a playing layer can't be removed on Windows,
+        # it's skipped and goes on a later pass.
+        with self.lock:
+            files = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)
+                     if name.endswith(".pcm")]
+            files.sort(key=os.path.getmtime)
+            total = sum(os.path.getsize(path) for path in files)
+            for path in files:
+                if total <= self.max_bytes:
+                    break
+                size = os.path.getsize(path)
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+def library_sound_paths(presets_manager_settings):
+    sound_paths = []
+    for preset_name in presets_manager_settings.settings["presets_order"]:
+        for sound_settings in presets_manager_settings.open_preset(preset_name).settings["sounds"].values():
+            if 'path' in sound_settings and sound_settings['path'] not in sound_paths:
+                sound_paths.append(sound_settings['path'])
+    return sound_paths
+
+
+def main(argv):
+    # python -m stimulant_noise.pcm_cache warm
+    if len(argv) != 2 or argv[1] != "warm":
+        print("Usage: python -m stimulant_noise.pcm_cache warm")
+        return 1
+    internal_settings = InternalSettings(settings_file_location="internal_settings.json")
+    if internal_settings.library_backend == "sqlite":
+        from .library import open_library
+        presets_manager_settings = open_library(internal_settings)
+    else:
+        presets_manager_settings = PresetsManagerSettings(settings_file_location="preset_manager_settings.json",
+                                                          internal_settings=internal_settings)
+    pg.mixer.init()
+    pcm_cache = PcmCache(internal_settings.pcm_cache_dir, max_bytes=internal_settings.pcm_cache_bytes)
+    decoded = 0
+    for sound_path in library_sound_paths(presets_manager_settings):
+        # Streamed sounds are never decoded whole, caching them would only take space
+        if should_stream(sound_path, internal_settings.stream_threshold_bytes):
+            continue
+        try:
+            if pcm_cache.warm(sound_path):
+                decoded += 1
+        except (OSError, pg.error) as error:
+            print(f"Skipped {sound_path}: {error}")
+    print(f"Decoded {decoded} sounds into {internal_settings.pcm_cache_dir}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
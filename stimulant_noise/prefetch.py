@@ -0,0 +1,126 @@
+import threading
+import queue
+
+from .sound_cache import sound_cache
+# Decodes sounds of neighbouring presets in the background, so hotkey switches don't wait for a decode
+
+
+class Prefetcher(threading.Thread):
+    def __init__(self, depth=1, cache=None, is_streamed=None, mixdowns=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.depth = depth
+        self.cache = cache if cache is not None else sound_cache
+        # Streamed sounds are never decoded whole, so there is nothing to prefetch for them
+        self.is_streamed = is_streamed if is_streamed is not None else (lambda sound_path: False)
+        # With mixdowns on, eligible neighbours are rendered ahead instead of having their sounds decoded
+        self.mixdowns = mixdowns
+        self.queue = queue.Queue()
+        self.generation = 0
+        # Sound paths of the presets around the current one, Audio keeps these decoded when it lets go of them
+        self.window = frozenset()
+        # Set by PresetsManager: whether Audio still has a layer playing the path. By default sounds that leave the
+        # window are left to the cache's budget.
+        self.in_use = lambda sound_path: True
+
+        self.warm_switches = 0
+        self.cold_switches = 0
+        self.prefetched = 0
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            generation, presets = job
+            if self.mixdowns is not None:
+                presets = self.prefetch_mixdowns(generation, presets)
+            # Neighbours may not be loaded yet, parse them here rather than on the switching thread
+            sound_paths = []
+            for preset in presets:
+                if generation != self.generation:
+                    break
+                for sound_settings in preset.sounds.values():
+                    # Generators have nothing to decode
+                    if 'path' in sound_settings and sound_settings['path'] not in sound_paths:
+                        sound_paths.append(sound_settings['path'])
+            if generation == self.generation:
+                left = self.window - set(sound_paths)
+                self.window = frozenset(sound_paths)
+                for sound_path in left:
+                    # Out of reach now, the decoded copy goes unless something still plays it
+                    if not self.in_use(sound_path):
+                        self.cache.discard(sound_path)
+            for sound_path in sound_paths:
+                # User jumped somewhere else, whatever is left belongs to the old neighbourhood
+                if generation != self.generation:
+                    break
+                if sound_path in self.cache or self.is_streamed(sound_path):
+                    continue
+                try:
+                    self.cache.get(sound_path)
+                    self.prefetched += 1
+                except (FileNotFoundError, OSError):
+                    # Missing file will surface when the preset is actually played
+                    pass
+
+    def prefetch_mixdowns(self, generation, presets):
+        # Returns the presets that still play live and need their sounds decoded
+        live = []
+        for preset in presets:
+            if generation != self.generation:
+                break
+            if not self.mixdowns.eligible(preset, self.is_streamed):
+                live.append(preset)
+                continue
+            try:
+                self.mixdowns.prepare(preset)
+                self.prefetched += 1
+            except (FileNotFoundError, OSError):
+                live.append(preset)
+        return live
+
+    def wanted(self, sound_path):
+        return sound_path in self.window
+
+    def neighbours(self, presets_order, preset_name):
+        # Closest first, alternating sides: +1, -1, +2, -2...
+        if preset_name not in presets_order:
+            return []
+        index = presets_order.index(preset_name)
+        names = []
+        for distance in range(1, self.depth + 1):
+            for step in (distance, -distance):
+                name = presets_order[(index + step) % len(presets_order)]
+                if name != preset_name and name not in names:
+                    names.append(name)
+        return names
+
+    def prefetch_around(self, presets, presets_order, preset_name):
+        neighbours = [presets[name] for name in self.neighbours(presets_order, preset_name)]
+        self.generation += 1
+        self.queue.put((self.generation, neighbours))
+
+    def record_switch(self, preset):
+        # Has to be called before Audio loads the preset, afterwards everything is warm
+        if self.mixdowns is not None and self.mixdowns.eligible(preset, self.is_streamed):
+            warm = self.mixdowns.is_loaded(preset)
+        else:
+            warm = all('path' not in sound_settings or sound_settings['path'] in self.cache
+                       or self.is_streamed(sound_settings['path'])
+                       for sound_settings in preset.sounds.values())
+        if warm:
+            self.warm_switches += 1
+        else:
+            self.cold_switches += 1
+
+    def stop(self):
+        self.generation += 1
+        self.queue.put(None)
+
+    def stats(self):
+        return {
+            "warm_switches": self.warm_switches,
+            "cold_switches": self.cold_switches,
+            "prefetched": self.prefetched,
+            "depth": self.depth,
+        }
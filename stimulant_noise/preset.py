@@ -1,43 +1,76 @@
 from .settings import PresetsManagerSettings, PresetSettings
-from .audio import Audio
+from .metrics import metrics
 
+import functools
+import threading
+import time
 import timeit
 
 
 class Preset:
-    def __init__(self, preset_settings: PresetSettings):
-        self.preset_settings = preset_settings
-        settings = preset_settings.settings
-        self.name = settings['name']
-        self.volume = settings['volume']
-        self.sounds = settings['sounds']
-        self.mute = settings['mute']
+    # Handle to a preset file. JSON is only parsed the first time something inside the preset is needed.
+    def __init__(self, preset_settings: PresetSettings = None, loader=None, name=None):
+        self._preset_settings = preset_settings
+        # Called without arguments to get the PresetSettings, so the preset can live in a file or in a library
+        self.loader = loader
+        self._name = name
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._preset_settings is not None
+
+    @property
+    def preset_settings(self):
+        if self._preset_settings is None:
+            # Prefetcher may touch the same handle from its thread
+            with self.lock:
+                if self._preset_settings is None:
+                    self._preset_settings = self.loader()
+        return self._preset_settings
+
+    @property
+    def name(self):
+        if self._name is not None and not self.loaded:
+            return self._name
+        return self.preset_settings.settings['name']
+
+    @property
+    def volume(self):
+        return self.preset_settings.settings['volume']
+
+    @property
+    def sounds(self):
+        return self.preset_settings.settings['sounds']
+
+    @property
+    def mute(self):
+        return self.preset_settings.settings['mute']
 
     def set_volume(self, volume):
-        self.volume = volume
         self.preset_settings.set_volume(volume)
         self.preset_settings.save()
         return self.volume
 
+    # Changes go through PresetSettings, which holds its lock while changing the dict a pending write serialises
     def set_sound_volume(self, sound_name, volume):
-        self.sounds[sound_name]['volume'] = volume
         self.preset_settings.set_sound_volume(sound_name, volume)
         self.preset_settings.save()
         return self.sounds[sound_name]['volume']
 
     def set_sound_mute(self, sound_name, mute):
-        self.sounds[sound_name]['mute'] = mute
         self.preset_settings.set_sound_mute(sound_name, mute)
         self.preset_settings.save()
         return self.sounds[sound_name]['mute']
 
     def add_sound(self, sound_path, save=True):
-        sound_name = self.preset_settings.add_sound(sound_path)
-        self.sounds[sound_name] = {
-            'path': sound_path,
-            'volume': 50,
-            'mute': True,
-        }
+        sound_name = self.preset_settings.add_sound(sound_path, volume=50, mute=True)
+        if save:
+            self.preset_settings.save()
+        return sound_name, self.sounds[sound_name]
+
+    def add_generator(self, kind, save=True):
+        sound_name = self.preset_settings.add_generator(kind)
         if save:
             self.preset_settings.save()
         return sound_name, self.sounds[sound_name]
@@ -54,32 +87,82 @@ class Preset:
         return self.sounds
 
     def set_mute(self, mute):
-        self.mute = mute
         self.preset_settings.set_mute(mute)
         self.preset_settings.save()
         return self.mute
 
 
 class PresetsManager:
-    def __init__(self, preset_manage_settings: PresetsManagerSettings):
+    def __init__(self, preset_manage_settings: PresetsManagerSettings, start_audio=True):
         self.presets_manager_settings = preset_manage_settings
         self.settings = preset_manage_settings.settings
         self.presets, self.presets_order, self.current_preset = self.load_presets()
-        self.audio = Audio(self.current_preset)
+        # Audio can be started later (and on another thread), so a window can show up before any sound is decoded.
+        # Until then self.audio and self.prefetcher wait for it, so only the worker (which starts it) uses them. If
+        # starting fails they raise audio_error instead.
+        self.audio_ready = threading.Event()
+        self.audio_error = None
+        self._audio = None
+        self._prefetcher = None
+        if start_audio:
+            self.start_audio()
+
+    def start_audio(self):
+        # Imported here, pygame's mixer, numpy and soundfile are the slow part of starting up
+        from .audio import Audio
+        from .prefetch import Prefetcher
+        try:
+            self._audio = Audio(self.current_preset, internal_settings=self.presets_manager_settings.internal_settings)
+            self._prefetcher = Prefetcher(depth=self.presets_manager_settings.internal_settings.prefetch_depth,
+                                          cache=self._audio.sound_cache, is_streamed=self._audio.is_streamed,
+                                          mixdowns=self._audio.mixdowns)
+            self._prefetcher.start()
+            self._audio.retained = self._prefetcher.wanted
+            if not self.presets_manager_settings.internal_settings.keep_released_sounds:
+                self._prefetcher.in_use = self._audio.holds
+            self._prefetcher.prefetch_around(self.presets, self.presets_order, self.current_preset.name)
+        except BaseException as e:
+            self.audio_error = e
+            raise
+        finally:
+            self.audio_ready.set()
+
+    @property
+    def audio_failed(self):
+        return self.audio_error is not None
+
+    def wait_for_audio(self):
+        self.audio_ready.wait()
+        if self.audio_error is not None:
+            raise RuntimeError(f"Audio failed to start: {self.audio_error}") from self.audio_error
+
+    @property
+    def audio(self):
+        self.wait_for_audio()
+        return self._audio
+
+    @property
+    def prefetcher(self):
+        self.wait_for_audio()
+        return self._prefetcher
 
     def load_presets(self):
         presets = {}
         presets_order = self.settings['presets_order']
         current_preset = None
         for preset_name in presets_order:
-            preset_settings_location = self.settings['presets'][preset_name]
-            preset = Preset(PresetSettings(preset_settings_location,
-                                           internal_settings=self.presets_manager_settings.internal_settings))
+            preset = self.make_preset(preset_name)
             presets[preset_name] = preset
             if preset_name == self.settings['current_preset']:
+                # Only the current preset is parsed at startup, the rest waits until it's visited
+                preset.preset_settings
                 current_preset = preset
         return presets, presets_order, current_preset
 
+    def make_preset(self, preset_name):
+        return Preset(loader=functools.partial(self.presets_manager_settings.open_preset, preset_name),
+                      name=preset_name)
+
     def get_preset(self, preset_name):
         return self.presets[preset_name]
 
@@ -87,68 +170,86 @@ class PresetsManager:
         return self.current_preset
 
     def set_current_preset(self, preset_name):
+        start = time.perf_counter()
         self.presets_manager_settings.set_current_preset(preset_name)
         self.presets_manager_settings.save()
         self.current_preset = self.presets[preset_name]
+        self.prefetcher.record_switch(self.current_preset)
         self.audio.set_current_preset(self.current_preset)
+        self.prefetcher.prefetch_around(self.presets, self.presets_order, self.current_preset.name)
+        if metrics.enabled:
+            metrics.since('presets_manager.set_current_preset', start)
         return self.current_preset
 
-    def next_preset(self):
+    def move_preset(self, steps):
+        # Move through presets_order by any number of steps, wrapping around both ends
+        if steps == 0:
+            return self.current_preset
         current_preset_index = self.presets_order.index(self.current_preset.name)
-        try:
-            next_preset = self.presets_order[current_preset_index + 1]
-        except IndexError:
-            next_preset = self.presets_order[0]
-        self.set_current_preset(next_preset)
+        self.set_current_preset(self.presets_order[(current_preset_index + steps) % len(self.presets_order)])
         return self.current_preset
 
+    def next_preset(self):
+        return self.move_preset(1)
+
     def previous_preset(self):
-        current_preset_index = self.presets_order.index(self.current_preset.name)
-        try:
-            previous_preset = self.presets_order[current_preset_index - 1]
-        except IndexError:
-            previous_preset = self.presets_order[0]
-        self.set_current_preset(previous_preset)
-        return self.current_preset
+        return self.move_preset(-1)
 
     def add_preset(self, preset_name, after_preset_name=None):
         assert preset_name not in self.presets_order, 'Preset with this name already exists'
-        if after_preset_name:
-            after_preset_index = self.presets_order.index(after_preset_name)
-            self.presets_order.insert(after_preset_index + 1, preset_name)
-        else:
-            self.presets_order.append(preset_name)
-        self.settings['presets_order'] = self.presets_order
-        self.presets_manager_settings.add_preset(preset_name, to_order=False)
+        # presets_order is the list in the settings, a pending write may be serialising it
+        with self.presets_manager_settings.lock:
+            if after_preset_name:
+                after_preset_index = self.presets_order.index(after_preset_name)
+                self.presets_order.insert(after_preset_index + 1, preset_name)
+            else:
+                self.presets_order.append(preset_name)
+            self.settings['presets_order'] = self.presets_order
+            self.presets_manager_settings.add_preset(preset_name, to_order=False)
         self.presets_manager_settings.save()
-        new_preset = Preset(PresetSettings(self.settings['presets'][preset_name],
-                                           internal_settings=self.presets_manager_settings.internal_settings))
-        self.presets[preset_name] = new_preset
+        self.presets[preset_name] = self.make_preset(preset_name)
         return self.presets[preset_name]
 
     def remove_preset(self, preset_name):
+        # Only the removed preset is touched, the rest of the library stays as it is
+        if self.current_preset.name == preset_name and len(self.presets_order) > 1:
+            self.previous_preset()
         self.presets_manager_settings.remove_preset(preset_name)
         self.presets_manager_settings.save()
-        self.presets, self.presets_order, self.current_preset = self.load_presets()
+        removed_preset = self.presets.pop(preset_name)
+        if removed_preset.loaded:
+            removed_preset.preset_settings.discard()
+        # Also drops prefetch work that might still hold the removed preset
+        self.prefetcher.prefetch_around(self.presets, self.presets_order, self.current_preset.name)
         return self.presets_order
 
     def change_preset_order(self, preset_name, after_preset_name):
-        self.presets_order.remove(preset_name)
-        after_preset_index = self.presets_order.index(after_preset_name)
-        self.presets_order.insert(after_preset_index + 1, preset_name)
-        self.settings['presets_order'] = self.presets_order
+        self.presets_manager_settings.change_preset_order(preset_name, after_preset_name)
         self.presets_manager_settings.save()
         return self.presets_order
 
     def change_preset_name(self, preset_name, new_preset_name):
+        preset = self.presets[preset_name]
+        if preset.loaded:
+            # JSON backend copies the file, pending changes have to be in it first
+            preset.preset_settings.flush()
         self.presets_manager_settings.change_preset_name(preset_name, new_preset_name)
         self.presets_manager_settings.save()
-        self.presets, self.presets_order, self.current_preset = self.load_presets()
+        if preset.loaded:
+            preset.preset_settings.discard()
+        del self.presets[preset_name]
+        new_preset = self.make_preset(new_preset_name)
+        self.presets[new_preset_name] = new_preset
+        if self.current_preset is preset:
+            self.current_preset = new_preset
+            self.audio.current_preset = new_preset
+        self.prefetcher.prefetch_around(self.presets, self.presets_order, self.current_preset.name)
         return self.presets_order
 
     def set_preset_volume(self, preset_name, volume):
         self.presets[preset_name].set_volume(volume)
-        self.audio.set_current_preset(self.current_preset)
+        if self.presets[preset_name] is self.current_preset:
+            self.audio.set_volume(self.current_preset.volume/100)
         return self.presets[preset_name].volume
 
     def set_sound_volume(self, sound_name, volume):
@@ -166,6 +267,11 @@ class PresetsManager:
         self.audio.set_current_preset(self.current_preset)
         return sound_name, sound
 
+    def add_generator(self, kind):
+        sound_name, sound = self.current_preset.add_generator(kind)
+        self.audio.set_current_preset(self.current_preset)
+        return sound_name, sound
+
     def add_sounds(self, sound_paths):
         self.current_preset.add_sounds(sound_paths)
         self.audio.set_current_preset(self.current_preset)
@@ -178,5 +284,5 @@ class PresetsManager:
 
     def mute_current_preset(self):
         self.current_preset.set_mute(not self.current_preset.mute)
-        self.audio.set_current_preset(self.current_preset)
+        self.audio.set_mute(self.current_preset.mute)
         return self.current_preset
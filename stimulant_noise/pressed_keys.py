@@ -1,120 +1,140 @@
+import re
+import ast
 import pynput
 
+Key = pynput.keyboard.Key
 
-class PressedKeys:
-    def __init__(self, hashed=None):
-        self.modifiers = set()
-        self.key = None
-        self.hashed = str()
-        self.human_readable = ' '
-        if hashed is not None:
-            self.hashed = hashed
-            self.parse_hash()
-            self.human_readable = self.readable()
-        else:
-            self.make_hash()
-            self.human_readable = self.readable()
+# Every key is a single int, so the keys held at any moment are one frozenset of ints and finding the hotkey they
+# make up is one dict lookup. Ordinary keys are their character, pynput's special keys (ctrl, shift, arrows...)
+# and keys without a character get ranges above Unicode. Codes only live in memory, settings store key names.
+SPECIAL_BASE = 0x110000
+VK_BASE = 0x120000
+SPECIAL_CODES = {key: SPECIAL_BASE + index for index, key in enumerate(Key)}
+SPECIAL_KEYS = {code: key for key, code in SPECIAL_CODES.items()}
+# Keys from settings written on another platform that pynput doesn't have here, they can't be pressed but keep
+# their names
+UNKNOWN_CODES = {}
 
-    def __str__(self):
-        return f'{self.modifiers} + {self.key}'
-
-    def make_hash(self):
-        # Make a string of the set of modifiers and the key, so it doesn't change when JSON is loaded
-        self.hashed = f'{self.modifiers} + {self.key}'
-
-    def parse_hash(self):
-        # Split string of set from string of key, then set modifiers to the set and key to the key
-        modifiers, key = self.hashed.split(' + ')
-        if len(modifiers) > 10:
-            modifiers = modifiers[1:]
-        else:
-            modifiers = modifiers
-        modifiers = modifiers.split(', ')
-        modifiers = set(modifiers)
-        self.modifiers = modifiers
+# Ctrl + letter comes in as a control character
+CONTROL_CHARACTERS = {chr(code): chr(code + 64) for code in range(32)}
+CONTROL_CHARACTERS['\x7f'] = '?'
+
+
+def is_modifier(key):
+    # Special keys (pynput's Key) count as modifiers, a hotkey is any number of them plus at most one ordinary key
+    return isinstance(key, Key)
+
+
+def key_code(key):
+    if isinstance(key, Key):
+        return SPECIAL_CODES[key]
+    if key.char is not None and len(key.char) == 1:
+        return ord(key.char)
+    return VK_BASE + key.vk
+
+
+def code_name(code):
+    # Name as stored in hotkey_settings.json: Key name, the character itself, or the virtual key code
+    if code < 0:
+        return next(name for name, unknown_code in UNKNOWN_CODES.items() if unknown_code == code)
+    if code >= VK_BASE:
+        return code - VK_BASE
+    if code >= SPECIAL_BASE:
+        return SPECIAL_KEYS[code].name
+    return chr(code)
+
+
+def name_code(name):
+    if isinstance(name, int):
+        return VK_BASE + name
+    if len(name) == 1:
+        return ord(name)
+    try:
+        return SPECIAL_CODES[Key[name]]
+    except KeyError:
+        return UNKNOWN_CODES.setdefault(name, -1 - len(UNKNOWN_CODES))
+
+
+def parse_legacy(hashed):
+    # Hotkeys used to be saved as "{<Key.ctrl_l: <162>>, <Key.shift: <160>>} + '\x0e'", a set of modifiers and the
+    # repr of a KeyCode. Everything in that string is kept: modifier names, and the character or virtual key code.
+    modifiers, key = hashed.rsplit(' + ', 1)
+    modifier_names = re.findall(r'Key\.(\w+)', modifiers)
+    key = key.strip()
+    if key == 'None':
+        key_name = None
+    elif key.startswith('<') and key.endswith('>'):
+        key_name = int(key[1:-1])
+    else:
+        if key.startswith('[') and key.endswith(']'):
+            # Dead key
+            key = key[1:-1]
+        key_name = ast.literal_eval(key)
+    return {'modifiers': modifier_names, 'key': key_name}
+
+
+class PressedKeys:
+    def __init__(self, modifiers=(), key=None):
+        # Codes of held special keys and of the one ordinary key, chord is both together
+        self.modifiers = frozenset(modifiers)
         self.key = key
-        return self.modifiers, self.key
-
-    def readable(self):
-        mapping = {
-            "'\\0'": '@',
-            "'\\x01'": 'A',
-            "'\\x02'": 'B',
-            "'\\x03'": 'C',
-            "'\\x04'": 'D',
-            "'\\x05'": 'E',
-            "'\\x06'": 'F',
-            "'\\x07'": 'G',
-            "'\\x08'": 'H',
-            "'\\t'": 'I',
-            "'\\n'": 'J',
-            "'\\x0b'": 'K',
-            "'\\x0c'": 'L',
-            "'\\r'": 'M',
-            "'\\x0e'": 'N',
-            "'\\x0f'": 'O',
-            "'\\x10'": 'P',
-            "'\\x11'": 'Q',
-            "'\\x12'": 'R',
-            "'\\x13'": 'S',
-            "'\\x14'": 'T',
-            "'\\x15'": 'U',
-            "'\\x16'": 'V',
-            "'\\x17'": 'W',
-            "'\\x18'": 'X',
-            "'\\x19'": 'Y',
-            "'\\x1a'": 'Z',
-            "'\\x1b'": '[',
-            "'\\x1c'": '\\',
-            "'\\x1d'": ']',
-            "'\\x1e'": '^',
-            "'\\x1f'": '_',
-            "'\\x7f'": '?',
+        self.chord = self.make_chord()
+
+    @classmethod
+    def from_settings(cls, value):
+        if isinstance(value, str):
+            value = parse_legacy(value)
+        key = value.get('key')
+        return cls(modifiers=[name_code(name) for name in value.get('modifiers', [])],
+                   key=None if key is None else name_code(key))
+
+    def to_settings(self):
+        return {
+            'modifiers': sorted(code_name(code) for code in self.modifiers),
+            'key': None if self.key is None else code_name(self.key),
         }
-        # Make a human readable string of the pressed keys
+
+    def __str__(self):
+        return self.human_readable
+
+    def make_chord(self):
+        if self.key is None:
+            return self.modifiers
+        return self.modifiers | {self.key}
+
+    @property
+    def human_readable(self):
+        if not self.chord:
+            return 'Empty'
+        names = sorted(code_name(code) for code in self.modifiers)
         if self.key is not None:
-            if self.key in mapping:
-                key = mapping[self.key]
+            key = code_name(self.key)
+            if isinstance(key, int):
+                key = f'<{key}>'
             else:
-                try:
-                    key = self.key
-                except AttributeError:
-                    key = 'unknown'
-            modifiers = ''
-            for modifier in self.modifiers:
-                try:
-                    modifier_name = str(modifier).split('.')[1].split(":")[0]
-                    modifiers += f'{modifier_name} + '
-                except IndexError as e:
-                    if modifier == 'set()':
-                        pass
-                    else:
-                        raise e
-            if not key.isalnum():
-                key = f'"{key}"'
-            human_readable = f'{modifiers}{key}'
-            return human_readable
-        else:
-            return 'Empty'
+                key = CONTROL_CHARACTERS.get(key, key)
+                if not key.isalnum():
+                    key = f'"{key}"'
+            names.append(key)
+        return ' + '.join(names)
 
-    def add_modifier(self, modifier: pynput.keyboard.Key):
-        self.modifiers.add(modifier)
-        self.make_hash()
+    def add_modifier(self, code):
+        self.modifiers = self.modifiers | {code}
+        self.chord = self.make_chord()
 
-    def remove_modifier(self, modifier: pynput.keyboard.Key):
-        self.modifiers.remove(modifier)
-        self.make_hash()
+    def remove_modifier(self, code):
+        self.modifiers = self.modifiers - {code}
+        self.chord = self.make_chord()
 
-    def set_key(self, key: str):
-        self.key = key
-        self.make_hash()
+    def set_key(self, code):
+        self.key = code
+        self.chord = self.make_chord()
 
     def remove_key(self):
         self.key = None
-        self.make_hash()
+        self.chord = self.modifiers
 
     def clear(self):
-        self.modifiers = set()
+        self.modifiers = frozenset()
         self.key = None
-        self.hashed = None
-        self.make_hash()
+        self.chord = self.modifiers
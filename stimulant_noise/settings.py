@@ -1,18 +1,50 @@
 import os
 import json
-import pynput
-from .pressed_keys import PressedKeys
+import atexit
+import threading
+import time
+import weakref
+from .pressed_keys import PressedKeys, parse_legacy
+from .metrics import metrics
 import shutil
 
 
 # Classes for settings component of the program
 
 
+# Settings with a pending delayed write, flushed at shutdown so nothing is lost
+write_behind_settings = weakref.WeakSet()
+
+
+def flush_all():
+    for settings in list(write_behind_settings):
+        settings.flush()
+
+
+atexit.register(flush_all)
+
+
 class Settings:
-    def __init__(self, settings_file_location):
+    def __init__(self, settings_file_location, write_behind=False, debounce=0.5):
         self.settings_file_location = settings_file_location
+        # Write-behind: save() only marks settings dirty, the file is written once per debounce period
+        self.write_behind = write_behind
+        self.debounce = debounce
+        # Held by flush() and by every method that changes self.settings, so a write on the timer thread never sees
+        # a change half done
+        self.lock = threading.RLock()
+        self.timer = None
+        self.dirty = False
+        self.last_written = None
+
+        self.writes_done = 0
+        self.writes_avoided = 0
+
         self.settings = self.load_or_create()
-        self.save()
+        if self.last_written is None:
+            # Only new (or unreadable) files get written here, in write-behind mode too, as whoever created them
+            # expects the file to exist
+            self.flush()
 
     def load_or_create(self):
         try:
@@ -25,12 +57,66 @@ class Settings:
 
     def load(self):
         with open(self.settings_file_location, "r") as f:
-            settings = json.load(f)
+            content = f.read()
+        settings = json.loads(content)
+        self.last_written = content
         return settings
 
     def save(self):
-        with open(self.settings_file_location, "w") as f:
-            json.dump(self.settings, f, indent=4, sort_keys=True)
+        if self.write_behind:
+            self.mark_dirty()
+        else:
+            self.flush()
+
+    def mark_dirty(self):
+        with self.lock:
+            if self.dirty:
+                # Already scheduled, this change goes out with the pending write
+                self.writes_avoided += 1
+                return
+            self.dirty = True
+            write_behind_settings.add(self)
+            self.timer = threading.Timer(self.debounce, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.dirty = False
+            content = self.dumps()
+            if content == self.last_written:
+                self.writes_avoided += 1
+                return
+            start = time.perf_counter()
+            self.write(content)
+            self.last_written = content
+            self.writes_done += 1
+            if metrics.enabled:
+                metrics.since('settings.flush', start)
+
+    def dumps(self):
+        # What gets written, compared with last_written to skip writes that change nothing
+        return json.dumps(self.settings, indent=4, sort_keys=True)
+
+    def write(self, content):
+        # Write next to the target and swap it in, so a crash mid-write never leaves a truncated file
+        temporary_location = self.settings_file_location + ".tmp"
+        with open(temporary_location, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_location, self.settings_file_location)
+
+    def discard(self):
+        # Drop a pending write, e.g. because the file is about to be removed
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.dirty = False
 
     def create(self):
         pass
@@ -39,60 +125,130 @@ class Settings:
 class HotkeySettings(Settings):
     def __init__(self, settings_file_location="hotkey_settings.json"):
         super().__init__(settings_file_location=settings_file_location)
+        # Older files have each hotkey as one formatted string, they're rewritten as key names once
+        legacy = [which for which, hotkey in self.settings.items() if isinstance(hotkey, str)]
+        for which in legacy:
+            self.settings[which] = parse_legacy(self.settings[which])
+        if legacy:
+            self.save()
 
     def create(self):
-        # Each hotkey is a PressedKey object
-        next_hotkey = PressedKeys()
-        next_hotkey.add_modifier(pynput.keyboard.Key.up)
-        previous_hotkey = PressedKeys()
-        previous_hotkey.add_modifier(pynput.keyboard.Key.down)
-        mute_hotkey = PressedKeys()
-        mute_hotkey.add_modifier(pynput.keyboard.Key.left)
+        # Each hotkey is the names of its special keys (pynput's Key) plus an optional ordinary key
         settings = {
-            "next": next_hotkey.hashed,
-            "previous": previous_hotkey.hashed,
-            "mute": mute_hotkey.hashed
+            "next": {"modifiers": ["up"], "key": None},
+            "previous": {"modifiers": ["down"], "key": None},
+            "mute": {"modifiers": ["left"], "key": None},
         }
         return settings
 
     def set_hotkey(self, which, hotkey: PressedKeys):
-        self.settings[which] = hotkey.hashed
+        with self.lock:
+            self.settings[which] = hotkey.to_settings()
+
+    def get_hotkey(self, which):
+        return PressedKeys.from_settings(self.settings[which])
 
     def get_next_hotkey(self):
-        return PressedKeys(self.settings["next"])
+        return self.get_hotkey("next")
 
     def get_previous_hotkey(self):
-        return PressedKeys(self.settings["previous"])
+        return self.get_hotkey("previous")
 
     def get_mute_hotkey(self):
-        return PressedKeys(self.settings["mute"])
+        return self.get_hotkey("mute")
 
 
 class InternalSettings(Settings):
     def __init__(self, settings_file_location="internal_settings.json"):
         super().__init__(settings_file_location=settings_file_location)
+        # Fill in options added after the settings file was first written
+        for key, value in self.create().items():
+            self.settings.setdefault(key, value)
         self.sounds_dir = self.settings["sounds_dir"]
         self.presets_dir = self.settings["presets_dir"]
+        self.sound_cache_bytes = self.settings["sound_cache_bytes"]
+        self.prefetch_depth = self.settings["prefetch_depth"]
+        self.crossfade_ms = self.settings["crossfade_ms"]
+        self.volume_ramp_ms = self.settings["volume_ramp_ms"]
+        self.save_debounce_ms = self.settings["save_debounce_ms"]
+        self.library_backend = self.settings["library_backend"]
+        self.library_location = self.settings["library_location"]
+        self.stream_threshold_bytes = self.settings["stream_threshold_bytes"]
+        self.audio_backend = self.settings["audio_backend"]
+        self.mixdown = self.settings["mixdown"]
+        self.mixdown_dir = self.settings["mixdown_dir"]
+        self.mixdown_cache_bytes = self.settings["mixdown_cache_bytes"]
+        self.metrics = self.settings["metrics"]
+        self.metrics_file = self.settings["metrics_file"]
+        self.control_port = self.settings["control_port"]
+        self.pcm_cache = self.settings["pcm_cache"]
+        self.pcm_cache_dir = self.settings["pcm_cache_dir"]
+        self.pcm_cache_bytes = self.settings["pcm_cache_bytes"]
+        self.slider_rate_hz = self.settings["slider_rate_hz"]
+        self.hotkey_capture_timeout_s = self.settings["hotkey_capture_timeout_s"]
+        self.hotkey_repeat_hz = self.settings["hotkey_repeat_hz"]
+        self.keep_released_sounds = self.settings["keep_released_sounds"]
 
     def create(self):
         settings = {
             # 2 folders in 'stimulant_noise' folder
             "sounds_dir": "sounds",
-            "presets_dir": "presets"
+            "presets_dir": "presets",
+            # Memory budget for decoded sounds shared between presets
+            "sound_cache_bytes": 256 * 1024 * 1024,
+            # How many presets on each side of the current one get decoded ahead of time
+            "prefetch_depth": 1,
+            # Gain ramps: crossfade between presets and smoothing for slider changes
+            "crossfade_ms": 300,
+            "volume_ramp_ms": 50,
+            # Preset files are written at most once per this period while sliders are dragged
+            "save_debounce_ms": 500,
+            # "json" keeps one file per preset, "sqlite" keeps the whole library in library_location
+            "library_backend": "json",
+            "library_location": "presets.sqlite3",
+            # Sounds that would take more than this once decoded are streamed from disk, null turns streaming off
+            "stream_threshold_bytes": 32 * 1024 * 1024,
+            # "pygame" plays each layer on its own channel, "numpy" mixes all layers in software
+            "audio_backend": "pygame",
+            # Presets made only of files are pre-rendered into one buffer and played on a single channel
+            "mixdown": False,
+            "mixdown_dir": "mixdown_cache",
+            "mixdown_cache_bytes": 512 * 1024 * 1024,
+            # Latency histograms and gauges, saved to metrics_file from the GUI
+            "metrics": False,
+            "metrics_file": "metrics.json",
+            # Port on 127.0.0.1 for scripts to control the program (see control.py), null keeps it closed
+            "control_port": None,
+            # Decoded sounds kept on disk, so starting up and visiting a preset again doesn't decode anything
+            "pcm_cache": True,
+            "pcm_cache_dir": "pcm_cache",
+            "pcm_cache_bytes": 1024 * 1024 * 1024,
+            # Slider drags are applied at most this many times a second, the value a slider ends at always is
+            "slider_rate_hz": 30,
+            # Changing a hotkey gives up (and keeps the old one) if nothing is pressed for this long
+            "hotkey_capture_timeout_s": 10,
+            # Holding a hotkey repeats it this many times a second, null fires once per press
+            "hotkey_repeat_hz": None,
+            # Decoded sounds of presets left behind are freed once faded out, unless they're next to the current
+            # preset. True keeps them in memory (up to sound_cache_bytes) so going back doesn't load them again.
+            "keep_released_sounds": False,
         }
         return settings
 
 
 class PresetSettings(Settings):
-    def __init__(self, settings_file_location=None, internal_settings=None):
+    def __init__(self, settings_file_location=None, internal_settings=None, name=None):
         if settings_file_location is None:
             settings_file_location = os.path.join(internal_settings.presets_dir,
                                                   f"Preset_{len(os.listdir(internal_settings.presets_dir))}.json")
-        self.name = os.path.splitext(os.path.basename(settings_file_location))[0]
+        if name is None:
+            name = os.path.splitext(os.path.basename(settings_file_location))[0]
+        self.name = name
         if internal_settings is None:
             internal_settings = InternalSettings()
         self.internal_settings = internal_settings
-        super().__init__(settings_file_location=settings_file_location)
+        super().__init__(settings_file_location=settings_file_location, write_behind=True,
+                         debounce=self.internal_settings.save_debounce_ms / 1000)
 
     def create(self):
         settings = {
@@ -105,45 +261,71 @@ class PresetSettings(Settings):
         return settings
 
     def add_sound(self, path, volume=0.5, mute=True):
-        sound_name = os.path.basename(path)
-        if sound_name in self.settings["sounds"]:
-            raise Exception("Sound already exists")
-        self.settings["sounds"][sound_name] = {
-            "path": path,
-            "volume": volume,
-            "mute": mute,
-        }
-        return sound_name
+        with self.lock:
+            sound_name = os.path.basename(path)
+            if sound_name in self.settings["sounds"]:
+                raise Exception("Sound already exists")
+            # Audio plays each file as one layer, the same file under a second name would share its volume and mute
+            if any(os.path.realpath(sound["path"]) == os.path.realpath(path)
+                   for sound in self.settings["sounds"].values() if "path" in sound):
+                raise Exception("Sound already exists")
+            self.settings["sounds"][sound_name] = {
+                "path": path,
+                "volume": volume,
+                "mute": mute,
+            }
+            return sound_name
+
+    def add_generator(self, kind, volume=50, mute=True, seed=None):
+        # Synthesized noise layer, e.g. "brown" instead of a brown-noise recording
+        with self.lock:
+            sound_name = f"{kind} noise"
+            if sound_name in self.settings["sounds"]:
+                raise Exception("Sound already exists")
+            self.settings["sounds"][sound_name] = {
+                "generator": kind,
+                "volume": volume,
+                "mute": mute,
+            }
+            if seed is not None:
+                self.settings["sounds"][sound_name]["seed"] = seed
+            return sound_name
 
     def remove_sound(self, sound_name):
-        if sound_name not in self.settings["sounds"]:
-            raise Exception("Sound does not exist")
-        del self.settings["sounds"][sound_name]
-        return self.settings["sounds"]
+        with self.lock:
+            if sound_name not in self.settings["sounds"]:
+                raise Exception("Sound does not exist")
+            del self.settings["sounds"][sound_name]
+            return self.settings["sounds"]
 
     def set_volume(self, volume):
-        self.settings["volume"] = volume
-        return volume
+        with self.lock:
+            self.settings["volume"] = volume
+            return volume
 
     def set_mute(self, mute):
-        self.settings["mute"] = mute
-        return mute
+        with self.lock:
+            self.settings["mute"] = mute
+            return mute
 
     def set_name(self, name):
-        self.settings["name"] = name
-        return name
+        with self.lock:
+            self.settings["name"] = name
+            return name
 
     def set_sound_volume(self, sound_name, volume):
-        if sound_name not in self.settings["sounds"]:
-            return False
-        self.settings["sounds"][sound_name]["volume"] = volume
-        return True
+        with self.lock:
+            if sound_name not in self.settings["sounds"]:
+                return False
+            self.settings["sounds"][sound_name]["volume"] = volume
+            return True
 
     def set_sound_mute(self, sound_name, mute):
-        if sound_name not in self.settings["sounds"]:
-            return False
-        self.settings["sounds"][sound_name]["mute"] = mute
-        return True
+        with self.lock:
+            if sound_name not in self.settings["sounds"]:
+                return False
+            self.settings["sounds"][sound_name]["mute"] = mute
+            return True
 
 
 class PresetsManagerSettings(Settings):
@@ -151,7 +333,8 @@ class PresetsManagerSettings(Settings):
         if internal_settings is None:
             internal_settings = InternalSettings()
         self.internal_settings = internal_settings
-        super().__init__(settings_file_location=settings_file_location)
+        super().__init__(settings_file_location=settings_file_location, write_behind=True,
+                         debounce=self.internal_settings.save_debounce_ms / 1000)
 
     def create(self):
         settings = {
@@ -179,52 +362,60 @@ class PresetsManagerSettings(Settings):
         return settings
 
     def add_preset(self, preset_name, to_order=True):
-        if preset_name in self.settings["presets"]:
-            raise ValueError("Preset with name {} already exists".format(preset_name))
-        preset_path = os.path.join(self.internal_settings.presets_dir, preset_name + ".json")
-        PresetSettings(preset_path, internal_settings=self.internal_settings)
-        self.settings["presets"][preset_name] = preset_path
-        if to_order:
-            self.settings["presets_order"].append(preset_name)
+        with self.lock:
+            if preset_name in self.settings["presets"]:
+                raise ValueError("Preset with name {} already exists".format(preset_name))
+            preset_path = os.path.join(self.internal_settings.presets_dir, preset_name + ".json")
+            PresetSettings(preset_path, internal_settings=self.internal_settings)
+            self.settings["presets"][preset_name] = preset_path
+            if to_order:
+                self.settings["presets_order"].append(preset_name)
+
+    def open_preset(self, preset_name):
+        return PresetSettings(self.settings["presets"][preset_name], internal_settings=self.internal_settings)
 
     def remove_preset(self, preset_name):
-        os.remove(self.settings["presets"][preset_name])
-        del self.settings["presets"][preset_name]
-        self.settings["presets_order"].remove(preset_name)
+        with self.lock:
+            os.remove(self.settings["presets"][preset_name])
+            del self.settings["presets"][preset_name]
+            self.settings["presets_order"].remove(preset_name)
 
     def set_current_preset(self, preset_name):
-        if preset_name not in self.settings["presets"].keys():
-            raise ValueError("Preset does not exist")
-        self.settings["current_preset"] = preset_name
-        return self.settings["current_preset"]
+        with self.lock:
+            if preset_name not in self.settings["presets"].keys():
+                raise ValueError("Preset does not exist")
+            self.settings["current_preset"] = preset_name
+            return self.settings["current_preset"]
 
     def change_preset_order(self, preset_name, after_preset_name):
-        if preset_name not in self.settings["presets"]:
-            raise ValueError("Preset does not exist")
-        if after_preset_name not in self.settings["presets"]:
-            raise ValueError("Preset does not exist")
-        self.settings["presets_order"].remove(preset_name)
-        self.settings["presets_order"].insert(self.settings["presets_order"].index(after_preset_name) + 1, preset_name)
-        return self.settings["presets_order"]
+        with self.lock:
+            if preset_name not in self.settings["presets"]:
+                raise ValueError("Preset does not exist")
+            if after_preset_name not in self.settings["presets"]:
+                raise ValueError("Preset does not exist")
+            self.settings["presets_order"].remove(preset_name)
+            self.settings["presets_order"].insert(self.settings["presets_order"].index(after_preset_name) + 1, preset_name)
+            return self.settings["presets_order"]
 
     def change_preset_name(self, preset_name, new_preset_name):
-        if preset_name not in self.settings["presets"]:
-            raise ValueError("Preset does not exist")
-        if new_preset_name in self.settings["presets"]:
-            raise ValueError(f"Preset with name {new_preset_name} already exists")
-        if preset_name == self.settings["current_preset"]:
-            self.settings["current_preset"] = new_preset_name
-        preset_path = self.settings["presets"][preset_name]
-        shutil.copy(preset_path, os.path.join(self.internal_settings.presets_dir, new_preset_name + ".json"))
-        preset_index = self.settings["presets_order"].index(preset_name)
-        self.remove_preset(preset_name)
-        new_preset_settings = PresetSettings(os.path.join(self.internal_settings.presets_dir,
-                                                          new_preset_name + ".json"),
-                                             internal_settings=self.internal_settings)
-        new_preset_settings.set_name(new_preset_name)
-        new_preset_settings.save()
-        self.settings["presets"][new_preset_name] = os.path.join(self.internal_settings.presets_dir,
-                                                                 new_preset_name + ".json")
-
-        self.settings["presets_order"].insert(preset_index, new_preset_name)
-        return new_preset_name
+        with self.lock:
+            if preset_name not in self.settings["presets"]:
+                raise ValueError("Preset does not exist")
+            if new_preset_name in self.settings["presets"]:
+                raise ValueError(f"Preset with name {new_preset_name} already exists")
+            if preset_name == self.settings["current_preset"]:
+                self.settings["current_preset"] = new_preset_name
+            preset_path = self.settings["presets"][preset_name]
+            shutil.copy(preset_path, os.path.join(self.internal_settings.presets_dir, new_preset_name + ".json"))
+            preset_index = self.settings["presets_order"].index(preset_name)
+            self.remove_preset(preset_name)
+            new_preset_settings = PresetSettings(os.path.join(self.internal_settings.presets_dir,
+                                                              new_preset_name + ".json"),
+                                                 internal_settings=self.internal_settings)
+            new_preset_settings.set_name(new_preset_name)
+            new_preset_settings.flush()
+            self.settings["presets"][new_preset_name] = os.path.join(self.internal_settings.presets_dir,
+                                                                     new_preset_name + ".json")
+
+            self.settings["presets_order"].insert(preset_index, new_preset_name)
+            return new_preset_name
@@ -0,0 +1,114 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import pygame as pg
+
+from .metrics import metrics
+# Process-wide cache of decoded sounds, shared by every Audio and preset
+
+
+def resolve_path(path):
+    return os.path.realpath(os.path.normpath(path))
+
+
+def sound_size(sound):
+    # Decoded size in bytes, computed from the mixer format so the raw buffer doesn't have to be copied
+    if hasattr(sound, 'nbytes'):
+        # NumPy array from the software mixer
+        return sound.nbytes
+    frequency, size, channels = pg.mixer.get_init()
+    return int(sound.get_length() * frequency) * channels * (abs(size) // 8)
+
+
+class SoundCache:
+    def __init__(self, budget=256 * 1024 * 1024, loader=None):
+        self.budget = budget
+        self.loader = loader if loader is not None else pg.mixer.Sound
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.RLock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def __contains__(self, path):
+        with self.lock:
+            return resolve_path(path) in self.entries
+
+    def get(self, path):
+        key = resolve_path(path)
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.hits += 1
+                    self.entries.move_to_end(key)
+                    return self.entries[key][0]
+                if key not in self.loading:
+                    self.misses += 1
+                    self.loading[key] = threading.Event()
+                    break
+                loaded = self.loading[key]
+            # Another thread (e.g. the prefetcher) is already decoding this file, wait for it instead of decoding twice
+            loaded.wait()
+        # Decode outside the lock, so a slow file doesn't block lookups of other sounds
+        try:
+            start = time.perf_counter()
+            sound = self.loader(key)
+            if metrics.enabled:
+                metrics.since('sound_cache.load', start)
+            size = sound_size(sound)
+            with self.lock:
+                self.entries[key] = (sound, size)
+                self.bytes += size
+                self.evict(keep=key)
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+        return sound
+
+    def evict(self, keep=None):
+        # Drop least recently used sounds until we're back under budget. Sounds still held by Audio stay playing,
+        # the cache just stops keeping them alive.
+        with self.lock:
+            for key in list(self.entries.keys()):
+                if self.bytes <= self.budget:
+                    break
+                if key == keep:
+                    continue
+                self.discard(key)
+                self.evictions += 1
+
+    def discard(self, path):
+        key = resolve_path(path)
+        with self.lock:
+            if key in self.entries:
+                sound, size = self.entries.pop(key)
+                self.bytes -= size
+
+    def set_budget(self, budget):
+        with self.lock:
+            self.budget = budget
+            self.evict()
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self.bytes,
+                "budget": self.budget,
+                "sounds": len(self.entries),
+            }
+
+
+sound_cache = SoundCache()
@@ -0,0 +1,81 @@
+import sys
+import json
+import time
+import threading
+import subprocess
+# Startup milestones, and python -m stimulant_noise.startup to report them together with import times
+
+REPORT_PREFIX = "startup report: "
+
+
+class StartupTimer:
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.marks = {}
+        self.expected = set()
+        self.lock = threading.Lock()
+        # Set once every expected milestone is reached
+        self.done = threading.Event()
+
+    def mark(self, name):
+        with self.lock:
+            if name not in self.marks:
+                self.marks[name] = time.perf_counter() - self.started_at
+            if self.expected and self.expected <= set(self.marks):
+                self.done.set()
+
+    def expect(self, names):
+        with self.lock:
+            self.expected = set(names)
+            if self.expected <= set(self.marks):
+                self.done.set()
+
+    def report(self):
+        with self.lock:
+            return dict(sorted(self.marks.items(), key=lambda mark: mark[1]))
+
+
+# Created on first import, which is when the package starts loading
+startup = StartupTimer()
+
+
+def parse_importtime(output, limit=15):
+    # -X importtime lines: "import time: self [us] | cumulative | imported package". Self times are added up per
+    # top-level package, so numpy's cost shows as numpy wherever it got imported from.
+    packages = {}
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        if len(fields) != 3:
+            continue
+        name = fields[2].strip().split(".")[0]
+        packages[name] = packages.get(name, 0) + int(fields[0])
+    slowest = sorted(packages.items(), key=lambda package: package[1], reverse=True)[:limit]
+    return {name: self_time / 1000 for name, self_time in slowest}
+
+
+def main(argv):
+    # python -m stimulant_noise.startup [--gui]
+    headless = "--gui" not in argv
+    code = f"from stimulant_noise.stimulant_noise import run; run(headless={headless}, startup_report=True)"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    milestones = None
+    for line in result.stdout.splitlines():
+        if line.startswith(REPORT_PREFIX):
+            milestones = json.loads(line[len(REPORT_PREFIX):])
+    if milestones is None:
+        print(result.stderr[-2000:])
+        return 1
+    print(json.dumps({
+        "mode": "headless" if headless else "gui",
+        # Seconds since the package started importing
+        "milestones": milestones,
+        # Milliseconds spent importing each package, slowest first
+        "imports": parse_importtime(result.stderr),
+    }, indent=4))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
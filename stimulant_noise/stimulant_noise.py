@@ -1,64 +1,330 @@
+import os
+import json
 import threading
 import queue
+import time
+import logging
 
+from .startup import startup, REPORT_PREFIX
 from .hotkeys import Hotkeys
-from .gui import GUI
 from .preset import PresetsManager
+from .commands import CommandQueue
+from .metrics import metrics
+from .library import open_library
 
-from .settings import HotkeySettings, PresetsManagerSettings, InternalSettings
+from .settings import HotkeySettings, PresetsManagerSettings, InternalSettings, flush_all
 
 
 class StimulantNoiseThread(threading.Thread):
-    def __init__(self, worker_queue, noise_generator):
+    def __init__(self, worker_queue, noise_generator, timeout=0.5):
         threading.Thread.__init__(self)
         self.queue = worker_queue
         self.noise_generator = noise_generator
+        self.timeout = timeout
+        self.running = True
+
+        self.commands_processed = 0
+        # Command name -> {'count', 'total', 'max'} of handling time in seconds
+        self.latency = {}
+
+        self.handlers = {}
+        self.register('stop', self.on_stop)
+        self.register('close_all', self.on_stop)
+        self.register('move_preset', self.on_move_preset)
+        self.register('mute_preset', self.on_mute_preset)
+        self.register('dump_metrics', self.on_dump_metrics)
+        self.register('start_audio', self.on_start_audio)
+        self.register('select_preset', self.on_select_preset)
+        self.register('set_preset_volume', self.on_set_preset_volume)
+        self.register('set_sound_volume', self.on_set_sound_volume)
+        self.register('set_sound_mute', self.on_set_sound_mute)
+        self.register('get_state', self.on_get_state)
+        self.register('add_sounds', self.on_add_sounds)
+        self.register('remove_sound', self.on_remove_sound)
+        self.register('add_preset', self.on_add_preset)
+        self.register('remove_preset', self.on_remove_preset)
+        self.register('rename_preset', self.on_rename_preset)
+
+    def register(self, name, handler):
+        self.handlers[name] = handler
 
     def run(self):
+        while self.running:
+            try:
+                # Block instead of polling, timeout only so a stopped worker notices it should exit
+                command = self.queue.get(timeout=self.timeout)
+            except queue.Empty:
+                continue
+            try:
+                self.handle(command)
+            finally:
+                # So queue.join() returns once everything posted so far was handled
+                self.queue.task_done()
+
+    def handle(self, command):
+        handler = self.handlers.get(command['name'])
+        if handler is None:
+            logging.warning(f"Unknown command {command['name']}")
+            self.reply(command, error=f"Unknown command {command['name']}")
+            return
+        start = time.perf_counter()
+        if metrics.enabled and 'created' in command:
+            metrics.record('command.queue_wait', start - command['created'])
+        try:
+            handler(command)
+        except Exception as e:
+            logging.exception(e)
+            self.reply(command, error=str(e))
+        else:
+            self.reply(command)
+        self.record(command['name'], time.perf_counter() - start)
+        if metrics.enabled:
+            metrics.record(f"command.{command['name']}", time.perf_counter() - start)
+
+    def reply(self, command, error=None):
+        # Commands from the control endpoint carry a callback, answered with the state after the command
+        if 'reply' not in command:
+            return
+        if error is not None:
+            command['reply']({'ok': False, 'error': error})
+        elif self.running:
+            command['reply']({'ok': True, 'state': self.noise_generator.state()})
+        else:
+            command['reply']({'ok': True})
+
+    def gains_set(self, command):
+        # Key press to the new gains reaching the channels, measured before the GUI gets rebuilt
+        if metrics.enabled and 'created' in command:
+            self.noise_generator.presets_manager.audio.transitions.notify_applied('hotkey.to_gains',
+                                                                                command['created'])
+
+    def record(self, name, elapsed):
+        self.commands_processed += 1
+        latency = self.latency.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        latency['count'] += 1
+        latency['total'] += elapsed
+        latency['max'] = max(latency['max'], elapsed)
+
+    def stats(self):
+        return {
+            'commands_processed': self.commands_processed,
+            'latency': {name: dict(latency, mean=latency['total'] / latency['count'])
+                        for name, latency in self.latency.items()},
+        }
+
+    def stop(self):
+        self.running = False
+
+    def handle_pending(self):
+        # Whatever is still queued when stopping, e.g. the last values of a slider, without waiting for more
         while True:
-            if not self.queue.empty():
-                result = self.queue.get()
-                if result['name'] == 'stop':
-                    self.noise_generator.stop()
-                    break
-                elif result['name'] == 'next_preset':
-                    self.noise_generator.gui.rebuild_on_hotkey()
-                elif result['name'] == 'previous_preset':
-                    self.noise_generator.gui.rebuild_on_hotkey()
-                elif result['name'] == 'mute_preset':
-                    self.noise_generator.gui.rebuild_on_hotkey()
-                elif result['name'] == 'close_all':
-                    self.noise_generator.presets_manager.audio.stop()
-                    self.noise_generator.hotkeys.listener.stop()
-                    exit()
+            try:
+                command = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if command['name'] not in ('stop', 'close_all'):
+                self.handle(command)
+            self.queue.task_done()
+
+    def on_stop(self, command):
+        self.noise_generator.stop()
+        self.stop()
+
+    def on_move_preset(self, command):
+        # Steps of every move queued before this one got handled are already added up by CommandQueue
+        self.noise_generator.presets_manager.move_preset(command['steps'])
+        self.gains_set(command)
+        self.noise_generator.notify_front_ends()
+
+    def on_mute_preset(self, command):
+        if not self.for_current_preset(command):
+            return
+        presets_manager = self.noise_generator.presets_manager
+        if command.get('mute') is None or command['mute'] != presets_manager.current_preset.mute:
+            presets_manager.mute_current_preset()
+        self.gains_set(command)
+        self.noise_generator.notify_front_ends(origin=command.get('origin'))
+
+    def on_select_preset(self, command):
+        self.noise_generator.presets_manager.set_current_preset(command['preset'])
+        self.noise_generator.notify_front_ends()
+
+    def on_set_preset_volume(self, command):
+        presets_manager = self.noise_generator.presets_manager
+        preset_name = command.get('preset', presets_manager.current_preset.name)
+        if preset_name not in presets_manager.presets:
+            # Removed while the slider was still being dragged
+            return
+        presets_manager.set_preset_volume(preset_name, float(command['volume']))
+        self.noise_generator.notify_front_ends(origin=command.get('origin'))
+
+    def on_set_sound_volume(self, command):
+        if not self.for_current_preset(command):
+            return
+        self.noise_generator.presets_manager.set_sound_volume(command['sound'], float(command['volume']))
+        self.noise_generator.notify_front_ends(origin=command.get('origin'))
+
+    def on_set_sound_mute(self, command):
+        if not self.for_current_preset(command):
+            return
+        self.noise_generator.presets_manager.set_sound_mute(command['sound'], bool(command['mute']))
+        self.noise_generator.notify_front_ends(origin=command.get('origin'))
+
+    def for_current_preset(self, command):
+        # Sound commands from the GUI name the preset they were made in, a switch queued before them wins
+        return command.get('preset', self.noise_generator.presets_manager.current_preset.name) == \
+            self.noise_generator.presets_manager.current_preset.name
+
+    def on_add_sounds(self, command):
+        self.noise_generator.presets_manager.add_sounds(command['paths'])
+        self.noise_generator.notify_front_ends()
+
+    def on_remove_sound(self, command):
+        if not self.for_current_preset(command):
+            return
+        self.noise_generator.presets_manager.remove_sound(command['sound'])
+        self.noise_generator.notify_front_ends()
+
+    def on_add_preset(self, command):
+        presets_manager = self.noise_generator.presets_manager
+        presets_manager.add_preset(command['preset'], after_preset_name=command.get('after'))
+        presets_manager.set_current_preset(command['preset'])
+        self.noise_generator.notify_front_ends()
+
+    def on_remove_preset(self, command):
+        self.noise_generator.presets_manager.remove_preset(command['preset'])
+        self.noise_generator.notify_front_ends()
+
+    def on_rename_preset(self, command):
+        self.noise_generator.presets_manager.change_preset_name(command['preset'], command['new_name'])
+        self.noise_generator.notify_front_ends()
+
+    def on_get_state(self, command):
+        pass
+
+    def on_start_audio(self, command):
+        self.noise_generator.presets_manager.start_audio()
+        startup.mark('audio_ready')
+        # Front ends showed a loading state until now
+        self.noise_generator.notify_front_ends()
+
+    def on_dump_metrics(self, command):
+        file = metrics.dump(self.noise_generator.internal_settings.metrics_file)
+        logging.info(f"Metrics written to {file}")
 
 
 class StimulantNoise:
 
-    def __init__(self):
-        self.queue = queue.Queue()
+    def __init__(self, headless=False, startup_report=False):
+        self.queue = CommandQueue()
+        # Headless runs only presets, audio and hotkeys, flet is never imported
+        self.headless = headless
+        # Anything showing state (the GUI) that has to be refreshed after a hotkey changed it
+        self.front_ends = []
+        self.gui = None
+        self.control = None
 
         self.internal_settings = InternalSettings(settings_file_location="internal_settings.json")
-        self.presets_manager_settings = PresetsManagerSettings(settings_file_location="preset_manager_settings.json",
-                                                               internal_settings=self.internal_settings)
+        metrics.enabled = self.internal_settings.metrics
+        if self.internal_settings.library_backend == "sqlite":
+            self.presets_manager_settings = open_library(self.internal_settings,
+                                                         settings_file_location="preset_manager_settings.json")
+        else:
+            self.presets_manager_settings = PresetsManagerSettings(
+                settings_file_location="preset_manager_settings.json", internal_settings=self.internal_settings)
         self.hotkey_settings = HotkeySettings(settings_file_location="hotkey_settings.json")
 
-        self.presets_manager = PresetsManager(self.presets_manager_settings)
+        # Window and hotkeys come up first, the worker starts audio as its first command, before any hotkey
+        self.presets_manager = PresetsManager(self.presets_manager_settings, start_audio=False)
+        self.queue.put({'name': 'start_audio'})
+        startup.mark('settings_loaded')
 
-        self.hotkeys = Hotkeys(self.hotkey_settings, self.presets_manager, self.queue)
-        self.hotkeys_thread = threading.Thread(target=self.hotkeys.run)
+        self.hotkeys = Hotkeys(self.hotkey_settings, self.presets_manager, self.queue,
+                               repeat_rate=self.internal_settings.hotkey_repeat_hz)
+        # Daemon, so a keyboard hook that never returns from stop() can't keep the process alive
+        self.hotkeys_thread = threading.Thread(target=self.hotkeys.run, daemon=True)
         self.hotkeys_thread.start()
+        startup.mark('hotkeys_started')
+
+        if startup_report:
+            startup.expect({'first_sound', 'audio_ready'} if self.headless else {'first_sound', 'audio_ready', 'window'})
+            threading.Thread(target=self.report_startup, daemon=True).start()
 
-        self.gui = GUI(presets_manager=self.presets_manager, hotkeys=self.hotkeys, queue=self.queue)
+        if not self.headless:
+            from .gui import GUI
+            self.gui = GUI(presets_manager=self.presets_manager, hotkeys=self.hotkeys, queue=self.queue)
+            self.attach(self.gui)
+
+        if self.internal_settings.control_port is not None:
+            from .control import ControlServer
+            self.control = ControlServer(self.queue, self.state, port=self.internal_settings.control_port)
+            self.attach(self.control)
+            self.control.start()
 
         self.worker = StimulantNoiseThread(self.queue, self)
         self.worker.start()
 
+    def attach(self, front_end):
+        self.front_ends.append(front_end)
+
+    def detach(self, front_end):
+        if front_end in self.front_ends:
+            self.front_ends.remove(front_end)
+
+    def notify_front_ends(self, origin=None):
+        # The front end a change came from already shows it, e.g. a slider that is still being dragged
+        for front_end in list(self.front_ends):
+            if front_end is not origin:
+                front_end.on_state_changed()
+
+    def state(self):
+        # Snapshot for the control endpoint, only read on the worker thread
+        current_preset = self.presets_manager.current_preset
+        return {
+            'preset': current_preset.name,
+            'volume': current_preset.volume,
+            'mute': current_preset.mute,
+            'sounds': {sound_name: {'volume': sound_settings['volume'], 'mute': sound_settings['mute']}
+                       for sound_name, sound_settings in current_preset.sounds.items()},
+            'presets': list(self.presets_manager.presets_order),
+        }
+
     def run(self):
+        if self.gui is not None:
+            self.gui.run()
+            return
+        # Join in short steps, so Ctrl+C still gets through on Windows
+        try:
+            while self.worker.is_alive():
+                self.worker.join(0.5)
+        except KeyboardInterrupt:
+            self.queue.put({'name': 'stop'})
+            self.worker.join()
+
+    def report_startup(self):
+        startup.done.wait()
+        print(REPORT_PREFIX + json.dumps(startup.report()), flush=True)
+        self.stop()
+        # Measurement run, the GUI's event loop isn't going to be closed politely
+        os._exit(0)
 
-        self.gui.run()
+    def stop(self):
+        if self.gui is not None:
+            # Slider values still waiting in the GUI's throttle are posted as commands, and the worker exits once
+            # this returns. They're handled here, before audio stops and settings are flushed.
+            self.gui.stop()
+            if threading.current_thread() is self.worker:
+                self.worker.handle_pending()
+        if not self.presets_manager.audio_failed:
+            # Otherwise there is nothing to stop, and the worker still has to get to its own stop()
+            self.presets_manager.audio.stop()
+            self.presets_manager.prefetcher.stop()
+        self.hotkeys.stop()
+        if self.control is not None:
+            self.control.stop()
+        flush_all()
 
 
-def run():
-    stimulant_noise = StimulantNoise()
+def run(headless=False, startup_report=False):
+    stimulant_noise = StimulantNoise(headless=headless, startup_report=startup_report)
     stimulant_noise.run()
@@ -0,0 +1,262 @@
+import threading
+import time
+import logging
+from collections import deque
+
+import pygame as pg
+
+try:
+    import numpy as np
+    import soundfile
+except ImportError:
+    # Streaming needs both, without them every layer is fully decoded as before
+    np = None
+    soundfile = None
+# Layers that decode from disk block by block instead of holding the whole file in memory
+
+
+def streaming_available():
+    return soundfile is not None
+
+
+def decoded_size(path):
+    # Size the file would take once decoded into the mixer's format
+    frequency, size, channels = pg.mixer.get_init()
+    info = soundfile.info(path)
+    return int(info.duration * frequency) * channels * (abs(size) // 8)
+
+
+def should_stream(path, threshold):
+    # Long files are decoded block by block from disk instead of being held in memory whole
+    if not streaming_available() or threshold is None:
+        return False
+    try:
+        return decoded_size(path) >= threshold
+    except RuntimeError:
+        # Format soundfile can't read, leave it to pygame
+        return False
+
+
+def to_mixer_buffer(block):
+    # Float frames in [-1, 1] to the raw layout pg.mixer.Sound(buffer=...) expects
+    frequency, size, channels = pg.mixer.get_init()
+    if size == -16:
+        return (np.clip(block, -1.0, 1.0) * 32767).astype(np.int16).tobytes()
+    if size == 32:
+        return block.astype(np.float32).tobytes()
+    raise ValueError(f"Unsupported mixer format {size}")
+
+
+class FileBlockSource:
+    # Reads a file in blocks, looping back to the start seamlessly and resampling to the mixer rate
+    def __init__(self, path):
+        self.path = path
+        self.frequency, size, self.channels = pg.mixer.get_init()
+        self.file = soundfile.SoundFile(path)
+        self.step = self.file.samplerate / self.frequency
+        self.pending = np.zeros((0, self.channels), dtype=np.float32)
+        self.phase = 0.0
+
+    def read_source(self, frames):
+        data = self.file.read(frames, dtype='float32', always_2d=True)
+        while len(data) < frames:
+            # End of file, carry on from the start so the loop has no gap
+            self.file.seek(0)
+            more = self.file.read(frames - len(data), dtype='float32', always_2d=True)
+            if len(more) == 0:
+                break
+            data = np.concatenate((data, more))
+        if data.shape[1] != self.channels:
+            data = np.repeat(data.mean(axis=1, keepdims=True), self.channels, axis=1)
+        return data
+
+    def read(self, frames):
+        if self.step == 1.0:
+            return self.read_source(frames)
+        # Linear interpolation, keeping the fractional position and the last frames between blocks
+        positions = self.phase + np.arange(frames) * self.step
+        needed = int(positions[-1]) + 2
+        if len(self.pending) < needed:
+            self.pending = np.concatenate((self.pending, self.read_source(needed - len(self.pending))))
+        index = positions.astype(np.int64)
+        fraction = (positions - index)[:, None].astype(np.float32)
+        block = self.pending[index] * (1 - fraction) + self.pending[index + 1] * fraction
+        consumed = int(positions[-1] + self.step)
+        self.pending = self.pending[consumed:]
+        self.phase = positions[-1] + self.step - consumed
+        return block
+
+    def skip(self, frames):
+        # Keep position without producing audio, used for silent layers
+        if self.step == 1.0:
+            self.file.seek((self.file.tell() + frames) % self.file.frames)
+        else:
+            self.read(frames)
+
+    def get_length(self):
+        return self.file.frames / self.file.samplerate
+
+    def close(self):
+        self.file.close()
+
+
+class StreamPump(threading.Thread):
+    # One thread keeps every stream's channel fed, sleeping when nothing is streaming
+    def __init__(self, interval=0.02):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = interval
+        self.streams = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.running = True
+
+    def run(self):
+        while self.running:
+            with self.lock:
+                streams = list(self.streams)
+                if not streams:
+                    self.wake.clear()
+            if not streams:
+                self.wake.wait()
+                continue
+            for stream in streams:
+                try:
+                    stream.pump()
+                except Exception as e:
+                    # One broken stream (unreadable file, device error) goes quiet, the others keep playing
+                    logging.exception(e)
+                    self.remove(stream)
+            time.sleep(self.interval)
+
+    def add(self, stream):
+        with self.lock:
+            self.streams.add(stream)
+        self.wake.set()
+
+    def remove(self, stream):
+        with self.lock:
+            self.streams.discard(stream)
+
+    def stop(self):
+        # Streams still added aren't fed any more, their channels play out what is queued
+        self.running = False
+        self.wake.set()
+
+
+stream_pump = None
+
+
+def get_stream_pump():
+    global stream_pump
+    if stream_pump is None:
+        stream_pump = StreamPump()
+        stream_pump.start()
+    return stream_pump
+
+
+def stop_stream_pump(timeout=1.0):
+    # The next stream to play starts a new pump
+    global stream_pump
+    if stream_pump is not None:
+        stream_pump.stop()
+        stream_pump.join(timeout)
+        stream_pump = None
+
+
+def free_channel():
+    # Never steals a channel another layer plays on. Audio sizes the channels to its layers, so growing here only
+    # happens for streams started behind its back.
+    channel = pg.mixer.find_channel()
+    if channel is None:
+        channels = pg.mixer.get_num_channels()
+        pg.mixer.set_num_channels(channels + 1)
+        channel = pg.mixer.Channel(channels)
+    return channel
+
+
+class StreamingSound:
+    # Quacks like pg.mixer.Sound (play/stop/set_volume/get_volume/get_num_channels), so Audio and
+    # TransitionEngine don't care which one they've got. Plays a file, or any source with read(frames).
+    def __init__(self, path=None, source=None, block_seconds=0.25, ring_blocks=4):
+        self.path = path
+        self.given_source = source
+        self.block_seconds = block_seconds
+        self.ring_blocks = ring_blocks
+        self.volume = 1.0
+        self.source = None
+        self.channel = None
+        self.blocks = deque()
+        self.lock = threading.RLock()
+
+    def next_block(self):
+        frames = int(pg.mixer.get_init()[0] * self.block_seconds)
+        return pg.mixer.Sound(buffer=to_mixer_buffer(self.source.read(frames)))
+
+    def fill(self):
+        while len(self.blocks) < self.ring_blocks:
+            self.blocks.append(self.next_block())
+
+    def pump(self):
+        with self.lock:
+            if self.channel is None:
+                return
+            self.fill()
+            if not self.channel.get_busy():
+                # Starved (e.g. the pump thread was late), restart from the ring
+                self.channel.play(self.blocks.popleft())
+                self.channel.set_volume(self.volume)
+                self.fill()
+            if self.channel.get_queue() is None:
+                self.channel.queue(self.blocks.popleft())
+            self.fill()
+
+    def play(self, loops=-1):
+        with self.lock:
+            if self.channel is not None:
+                return self.channel
+            self.source = self.open_source()
+            self.fill()
+            self.channel = free_channel()
+            self.channel.play(self.blocks.popleft())
+            self.channel.set_volume(self.volume)
+            self.fill()
+            self.channel.queue(self.blocks.popleft())
+            self.fill()
+        get_stream_pump().add(self)
+        return self.channel
+
+    def open_source(self):
+        if self.given_source is not None:
+            return self.given_source
+        return FileBlockSource(self.path)
+
+    def stop(self):
+        # Stopping shouldn't start a pump, e.g. after stop_stream_pump() at shutdown
+        pump = stream_pump
+        if pump is not None:
+            pump.remove(self)
+        with self.lock:
+            if self.channel is not None:
+                self.channel.stop()
+                self.channel = None
+            self.blocks.clear()
+            if self.source is not None and self.source is not self.given_source:
+                self.source.close()
+            self.source = None
+
+    def set_volume(self, volume):
+        with self.lock:
+            self.volume = volume
+            if self.channel is not None:
+                self.channel.set_volume(volume)
+
+    def get_volume(self):
+        return self.volume
+
+    def get_num_channels(self):
+        return 0 if self.channel is None else 1
+
+    def get_length(self):
+        if self.path is None:
+            return 0.0
+        return soundfile.info(self.path).duration
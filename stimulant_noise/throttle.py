@@ -0,0 +1,60 @@
+import threading
+import time
+import logging
+# Slider input coalescing: only the latest value per control is applied, at most rate times a second. The first
+# value after a pause goes out right away and whatever is pending when the window ends always gets applied, so the
+# value a slider is let go at is the last one applied.
+
+
+class Throttle(threading.Thread):
+    def __init__(self, apply, rate=30):
+        threading.Thread.__init__(self, daemon=True)
+        # Called as apply(key, value) on this thread only, so values for a key are applied in order
+        self.apply = apply
+        self.interval = 1 / rate if rate else 0
+        self.pending = {}
+        self.condition = threading.Condition()
+        self.running = True
+        self.last_applied = 0.0
+
+        self.received = 0
+        self.applied = 0
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                wait = self.last_applied + self.interval - time.monotonic()
+                if wait > 0 and self.running:
+                    # Anything arriving meanwhile just replaces the pending value
+                    self.condition.wait(wait)
+                    continue
+                pending, self.pending = self.pending, {}
+                self.last_applied = time.monotonic()
+            for key, value in pending.items():
+                try:
+                    self.apply(key, value)
+                except Exception as e:
+                    # One bad value mustn't stop the sliders working for the rest of the session
+                    logging.exception(e)
+                self.applied += 1
+
+    def submit(self, key, value):
+        with self.condition:
+            self.received += 1
+            self.pending[key] = value
+            self.condition.notify()
+
+    def stop(self, timeout=1.0):
+        # Values still pending are applied before the thread exits
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.is_alive():
+            self.join(timeout)
+
+    def stats(self):
+        return {'received': self.received, 'applied': self.applied}
@@ -0,0 +1,150 @@
+import math
+import threading
+import time
+
+from .metrics import metrics
+# Gain ramps for sounds, all driven by a single timer thread
+
+
+class Ramp:
+    def __init__(self, start, target, duration, curve='linear', on_done=None):
+        self.start = start
+        self.target = target
+        self.duration = duration
+        self.curve = curve
+        self.on_done = on_done
+        self.started_at = time.monotonic()
+
+    def gain_at(self, now):
+        if self.duration <= 0:
+            return self.target, True
+        progress = min((now - self.started_at) / self.duration, 1.0)
+        if self.curve == 'fade_in':
+            # Equal-power: sin/cos halves keep summed power constant while one layer replaces another
+            shape = math.sin(progress * math.pi / 2)
+        elif self.curve == 'fade_out':
+            shape = 1 - math.cos(progress * math.pi / 2)
+        else:
+            shape = progress
+        return self.start + (self.target - self.start) * shape, progress >= 1.0
+
+
+class TransitionEngine(threading.Thread):
+    def __init__(self, crossfade=0.3, volume_ramp=0.05, interval=0.01):
+        threading.Thread.__init__(self, daemon=True)
+        self.crossfade = crossfade
+        self.volume_ramp = volume_ramp
+        self.interval = interval
+
+        self.ramps = {}
+        self.gains = {}
+        self.condition = threading.Condition()
+        self.running = True
+
+        self.retargets = 0
+        # (metric name, perf_counter start) recorded once the next gains are applied
+        self.waiting = []
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.ramps:
+                    # Nothing is moving, sleep until someone asks for a ramp
+                    self.condition.wait()
+                if not self.running:
+                    return
+                finished = self.step(time.monotonic())
+            self.finish(finished)
+            with self.condition:
+                if self.running and self.ramps:
+                    self.condition.wait(self.interval)
+
+    def step(self, now):
+        # Callbacks of the ramps that are done, for finish() once the condition is let go
+        finished = []
+        for sound, ramp in list(self.ramps.items()):
+            gain, done = ramp.gain_at(now)
+            self.apply(sound, gain)
+            if done:
+                del self.ramps[sound]
+                if ramp.on_done is not None:
+                    finished.append(ramp.on_done)
+        if self.waiting:
+            self.record_waiting()
+        return finished
+
+    @staticmethod
+    def finish(finished):
+        # Outside the condition: on_done takes the caller's own locks (Audio's lifecycle_lock), which are held while
+        # asking for ramps
+        for on_done in finished:
+            on_done()
+
+    def record_waiting(self):
+        for name, start in self.waiting:
+            metrics.since(name, start)
+        self.waiting = []
+
+    def notify_applied(self, name, start):
+        # For metrics: time from start until the ramps just set up have applied their first gains
+        with self.condition:
+            self.waiting.append((name, start))
+            if not self.ramps:
+                self.record_waiting()
+
+    def apply(self, sound, gain):
+        self.gains[sound] = gain
+        sound.set_volume(gain)
+
+    def ramp(self, sound, target, duration, curve='linear', on_done=None):
+        with self.condition:
+            if sound in self.ramps:
+                # Retarget from wherever the running ramp got to instead of queueing behind it
+                self.retargets += 1
+            start = self.gains.get(sound, sound.get_volume())
+            self.ramps[sound] = Ramp(start, target, duration, curve=curve, on_done=on_done)
+            finished = []
+            if duration <= 0:
+                finished = self.step(time.monotonic())
+            self.condition.notify()
+        self.finish(finished)
+
+    def set_gain(self, sound, gain, duration=None):
+        if duration is None:
+            duration = self.volume_ramp
+        self.ramp(sound, gain, duration)
+
+    def fade_in(self, sound, gain, duration=None):
+        if duration is None:
+            duration = self.crossfade
+        self.ramp(sound, gain, duration, curve='fade_in')
+
+    def fade_out(self, sound, on_done=None, duration=None):
+        if duration is None:
+            duration = self.crossfade
+        self.ramp(sound, 0.0, duration, curve='fade_out', on_done=on_done)
+
+    def jump(self, sound, gain):
+        # Set gain right away, cancelling any ramp in flight
+        with self.condition:
+            self.ramps.pop(sound, None)
+            self.apply(sound, gain)
+
+    def forget(self, sound):
+        with self.condition:
+            self.ramps.pop(sound, None)
+            self.gains.pop(sound, None)
+
+    def clear(self):
+        with self.condition:
+            self.ramps.clear()
+
+    def is_ramping(self, sound):
+        with self.condition:
+            return sound in self.ramps
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.ramps.clear()
+            self.condition.notify()
@@ -0,0 +1,93 @@
+import os
+import json
+import math
+import wave
+from array import array
+from types import SimpleNamespace
+
+# No sound card, no keyboard hook. Has to be set before pygame and pynput are imported.
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+os.environ.setdefault("PYNPUT_BACKEND", "dummy")
+
+import pytest
+
+FREQUENCY = 44100
+# Short ramps, so tests can wait for a crossfade to finish
+CROSSFADE_MS = 60
+
+
+def write_sound(path, seconds=0.5, pitch=220.0):
+    # Stereo 16 bit sine in the mixer's own format, so nothing gets resampled
+    frames = int(FREQUENCY * seconds)
+    samples = array('h')
+    for frame in range(frames):
+        value = int(8000 * math.sin(2 * math.pi * pitch * frame / FREQUENCY))
+        samples.extend((value, value))
+    with wave.open(path, "wb") as f:
+        f.setnchannels(2)
+        f.setsampwidth(2)
+        f.setframerate(FREQUENCY)
+        f.writeframes(samples.tobytes())
+    return path
+
+
+def make_preset(name, sounds, volume=50, mute=False):
+    # Just what Audio reads from a Preset
+    return SimpleNamespace(name=name, volume=volume, mute=mute, sounds=sounds)
+
+
+def sound(path, volume=50, mute=False):
+    return {"path": path, "volume": volume, "mute": mute}
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # The program runs in its install folder, tests run in a throwaway one
+    monkeypatch.chdir(tmp_path)
+    with open("internal_settings.json", "w") as f:
+        json.dump({"sounds_dir": "sounds", "presets_dir": "presets", "prefetch_depth": 0, "pcm_cache": False,
+                   "crossfade_ms": CROSSFADE_MS, "volume_ramp_ms": 10, "save_debounce_ms": 50}, f)
+    os.mkdir("sounds")
+    os.mkdir("presets")
+    for index, name in enumerate(("a", "b", "c")):
+        write_sound(os.path.join("sounds", f"{name}.wav"), pitch=220.0 * (index + 1))
+    yield tmp_path
+    # Delayed saves use relative paths, they have to land here and not wherever the next test runs
+    from stimulant_noise.settings import flush_all
+    flush_all()
+
+
+@pytest.fixture
+def internal_settings(workdir):
+    from stimulant_noise.settings import InternalSettings
+    return InternalSettings()
+
+
+@pytest.fixture
+def preset_files(internal_settings):
+    # presets/One.json (a, b), Two.json (b, c) and Three.json (c), every sound at 40
+    from stimulant_noise.settings import PresetSettings
+    for name, sound_names in (("One", ("a", "b")), ("Two", ("b", "c")), ("Three", ("c",))):
+        preset_settings = PresetSettings(os.path.join("presets", f"{name}.json"), internal_settings=internal_settings)
+        for sound_name in sound_names:
+            preset_settings.add_sound(os.path.join("sounds", f"{sound_name}.wav"), volume=40, mute=False)
+        preset_settings.set_mute(False)
+        preset_settings.flush()
+
+
+@pytest.fixture
+def make_audio(internal_settings):
+    from stimulant_noise.audio import Audio
+    from stimulant_noise.sound_cache import sound_cache
+    sound_cache.clear()
+    audios = []
+
+    def make(preset):
+        audio = Audio(preset, internal_settings=internal_settings)
+        audios.append(audio)
+        return audio
+
+    yield make
+    for audio in audios:
+        audio.stop()
+    sound_cache.clear()
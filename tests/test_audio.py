@@ -0,0 +1,103 @@
+import os
+
+import pytest
+
+from conftest import make_preset, sound
+
+
+def test_one_layer_per_file(make_audio):
+    # Same file under two names (one through a relative path): one layer, the second name is skipped
+    path = os.path.join("sounds", "a.wav")
+    preset = make_preset("Preset", {"a.wav": sound(path), "a copy": sound(os.path.abspath(path))})
+    audio = make_audio(preset)
+    assert list(audio.sound_layers) == ["a.wav"]
+    assert len(audio.layers) == 1
+    audio.set_sound_volume("a copy", 10)
+    audio.set_sound_mute("a copy", True)
+    assert audio.sound_layers["a.wav"].volume == 0.5
+    assert not audio.sound_layers["a.wav"].mute
+
+
+def test_add_sound_rejects_same_file(internal_settings):
+    from stimulant_noise.settings import PresetSettings
+    preset_settings = PresetSettings(os.path.join("presets", "Preset.json"), internal_settings=internal_settings)
+    preset_settings.add_sound(os.path.join("sounds", "a.wav"))
+    # Different name, same file
+    os.symlink("a.wav", os.path.join("sounds", "link.wav"))
+    with pytest.raises(Exception, match="already exists"):
+        preset_settings.add_sound(os.path.join("sounds", "link.wav"))
+    assert list(preset_settings.settings["sounds"]) == ["a.wav"]
+
+
+def test_pcm_cache_loader_does_not_outlive_its_audio(make_audio, internal_settings):
+    import pygame as pg
+    from stimulant_noise.sound_cache import sound_cache
+    preset = make_preset("Preset", {"a.wav": sound("sounds/a.wav")})
+    internal_settings.pcm_cache = True
+    make_audio(preset)
+    assert sound_cache.loader is not pg.mixer.Sound
+    internal_settings.pcm_cache = False
+    make_audio(preset)
+    assert sound_cache.loader is pg.mixer.Sound
+
+
+def wait_for_fade():
+    import time
+    from conftest import CROSSFADE_MS
+    time.sleep(CROSSFADE_MS / 1000 + 0.2)
+
+
+def test_layer_taken_back_while_fading_is_kept(make_audio):
+    from stimulant_noise.audio import PLAYING
+    one = make_preset("One", {"a.wav": sound("sounds/a.wav")})
+    two = make_preset("Two", {"b.wav": sound("sounds/b.wav")})
+    audio = make_audio(one)
+    layer = audio.sound_layers["a.wav"]
+    audio.set_current_preset(two)
+    audio.set_current_preset(one)
+    assert audio.sound_layers["a.wav"] is layer
+    wait_for_fade()
+    assert layer.state == PLAYING
+    assert audio.layers[layer.key] is layer
+    assert layer.sound is not None
+    assert audio.released == 1
+
+
+def test_layer_released_after_fade_out(make_audio):
+    from stimulant_noise.audio import FADING, RELEASED
+    one = make_preset("One", {"a.wav": sound("sounds/a.wav")})
+    two = make_preset("Two", {"b.wav": sound("sounds/b.wav")})
+    audio = make_audio(one)
+    layer = audio.sound_layers["a.wav"]
+    audio.set_current_preset(two)
+    assert layer.state == FADING
+    wait_for_fade()
+    assert layer.state == RELEASED
+    assert layer.key not in audio.layers
+    assert layer.sound is None
+    assert audio.released == 1
+
+
+def test_fit_channels_keeps_busy_channels(make_audio):
+    preset = make_preset("Preset", {"a.wav": sound("sounds/a.wav")})
+    audio = make_audio(preset)
+    audio.mixer.set_num_channels(16)
+    channel = audio.mixer.Channel(12)
+    channel.play(audio.sounds["a.wav"], loops=-1)
+    audio.fit_channels()
+    assert audio.mixer.get_num_channels() == 13
+    channel.stop()
+    audio.fit_channels()
+    assert audio.mixer.get_num_channels() == audio.min_channels
+
+
+def test_stop_releases_fading_layers(make_audio):
+    from stimulant_noise.audio import FADING, RELEASED
+    one = make_preset("One", {"a.wav": sound("sounds/a.wav")})
+    two = make_preset("Two", {"b.wav": sound("sounds/b.wav")})
+    audio = make_audio(one)
+    layer = audio.sound_layers["a.wav"]
+    audio.set_current_preset(two)
+    audio.stop()
+    assert layer.state == RELEASED
+    assert not [layer for layer in audio.layers.values() if layer.state == FADING]
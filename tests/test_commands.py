@@ -0,0 +1,98 @@
+import threading
+
+from stimulant_noise.commands import CommandQueue, move_preset, mute_preset
+
+
+def drain(command_queue):
+    commands = []
+    while not command_queue.empty():
+        commands.append(command_queue.get())
+        command_queue.task_done()
+    return commands
+
+
+def joins(command_queue, timeout=2.0):
+    joiner = threading.Thread(target=command_queue.join, daemon=True)
+    joiner.start()
+    joiner.join(timeout)
+    return not joiner.is_alive()
+
+
+def test_moves_at_the_tail_are_merged():
+    command_queue = CommandQueue()
+    for steps in (1, 1, -1, 1, 1):
+        command_queue.put(move_preset(steps))
+    assert drain(command_queue) == [move_preset(3)]
+    assert command_queue.coalesced == 4
+
+
+def test_move_after_another_command_is_not_merged():
+    command_queue = CommandQueue()
+    command_queue.put(move_preset(1))
+    command_queue.put(mute_preset(True))
+    command_queue.put(move_preset(1))
+    assert drain(command_queue) == [move_preset(1), mute_preset(True), move_preset(1)]
+
+
+def test_move_waiting_for_a_reply_is_not_merged():
+    command_queue = CommandQueue()
+    command_queue.put(move_preset(1))
+    command_queue.put(dict(move_preset(1), reply=print))
+    assert [command['steps'] for command in drain(command_queue)] == [1, 1]
+
+
+def test_join_returns_after_merged_and_cancelled_commands():
+    command_queue = CommandQueue()
+    for steps in (1, 1, 1):
+        command_queue.put(move_preset(steps))
+    command_queue.put(mute_preset())
+    command_queue.put(mute_preset())
+    command_queue.put(mute_preset())
+    assert command_queue.unfinished_tasks == command_queue.qsize() == 2
+    drain(command_queue)
+    assert command_queue.unfinished_tasks == 0
+    assert joins(command_queue)
+
+
+def test_join_waits_for_commands_not_done():
+    command_queue = CommandQueue()
+    command_queue.put(move_preset(1))
+    command_queue.put(move_preset(1))
+    command_queue.get()
+    assert not joins(command_queue, timeout=0.1)
+    command_queue.task_done()
+    assert joins(command_queue)
+
+
+def test_mute_toggles_waiting_back_to_back_cancel_out():
+    command_queue = CommandQueue()
+    for _ in range(4):
+        command_queue.put(mute_preset())
+    assert drain(command_queue) == []
+    for _ in range(3):
+        command_queue.put(mute_preset())
+    assert drain(command_queue) == [mute_preset()]
+    assert command_queue.coalesced == 6
+
+
+def test_only_plain_toggles_cancel_out():
+    command_queue = CommandQueue()
+    command_queue.put(mute_preset())
+    command_queue.put(mute_preset(True))
+    command_queue.put(mute_preset())
+    command_queue.put(move_preset(1))
+    command_queue.put(mute_preset())
+    command_queue.put(dict(mute_preset(), reply=print))
+    assert [(command['name'], command.get('mute')) for command in drain(command_queue)] == [
+        ('mute_preset', None), ('mute_preset', True), ('mute_preset', None), ('move_preset', None),
+        ('mute_preset', None), ('mute_preset', None)]
+
+
+def test_moves_merge_across_cancelled_toggles():
+    command_queue = CommandQueue()
+    command_queue.put(move_preset(1))
+    command_queue.put(mute_preset())
+    command_queue.put(mute_preset())
+    command_queue.put(move_preset(1))
+    assert drain(command_queue) == [move_preset(2)]
+    assert joins(command_queue)
@@ -0,0 +1,47 @@
+import queue
+import threading
+
+import pytest
+
+from stimulant_noise.control import ControlServer, parse_command, send
+
+
+@pytest.mark.parametrize("request_", [
+    {"command": "sound_mute", "sound": "rain.ogg", "mute": "false"},
+    {"command": "sound_mute", "sound": "rain.ogg", "mute": 0},
+    {"command": "mute", "mute": "on"},
+    {"command": "preset_volume", "volume": 101},
+    {"command": "preset_volume", "volume": -1},
+    {"command": "preset_volume", "volume": "50"},
+    {"command": "sound_volume", "sound": "rain.ogg", "volume": True},
+    {"command": "move", "steps": 1.5},
+])
+def test_invalid_values_are_rejected(request_):
+    with pytest.raises(ValueError):
+        parse_command(request_)
+
+
+def test_valid_values():
+    assert parse_command({"command": "sound_mute", "sound": "rain.ogg", "mute": False})["mute"] is False
+    assert parse_command({"command": "mute"}) == {"name": "mute_preset"}
+    assert parse_command({"command": "mute", "mute": True})["mute"] is True
+    assert parse_command({"command": "preset_volume", "volume": 100})["volume"] == 100.0
+    assert parse_command({"command": "move", "steps": -2})["steps"] == -2
+
+
+def test_pending_commands_fail_when_stopped():
+    # Nothing takes commands off this queue, like a worker that has already stopped
+    main_queue = queue.Queue()
+    control = ControlServer(main_queue, lambda: {}, port=0)
+    control.start()
+    assert control.ready.wait(2.0)
+    replies = []
+    client = threading.Thread(target=lambda: replies.extend(send([{"id": 1, "command": "next"}],
+                                                                   port=control.port)))
+    client.start()
+    command = main_queue.get(timeout=2.0)
+    assert command["name"] == "move_preset"
+    control.stop()
+    client.join(2.0)
+    assert not client.is_alive()
+    assert replies == [{"ok": False, "error": "Stopped before the command was handled", "id": 1}]
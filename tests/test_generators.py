@@ -0,0 +1,68 @@
+import numpy as np
+import pygame as pg
+import pytest
+
+from stimulant_noise.generators import NoiseGenerator, GENERATORS, LEVEL, one_pole
+
+
+def reference(x, poles, state):
+    y = np.empty_like(x)
+    for frame in range(len(x)):
+        state = poles * state + x[frame]
+        y[frame] = state
+    return y, state
+
+
+@pytest.mark.parametrize("poles", [
+    # Short memory: pole^-k outgrows float64 fast, so a block is cut into many chunks
+    [0.3, 0.57],
+    # Long memory: a whole block is one chunk
+    [0.998, 0.99765],
+    [0.99765, 0.963, 0.57],
+])
+def test_one_pole_matches_a_loop(poles):
+    rng = np.random.default_rng(0)
+    poles = np.repeat(poles, 2)
+    state = reference_state = np.zeros(len(poles))
+    # Odd block sizes, and state carried from one block to the next
+    for frames in (3001, 1, 77, 4096):
+        x = rng.standard_normal((frames, len(poles)))
+        y, state = one_pole(x, poles, state)
+        expected, reference_state = reference(x, poles, reference_state)
+        np.testing.assert_allclose(y, expected, rtol=0, atol=1e-9)
+        np.testing.assert_allclose(state, reference_state, rtol=0, atol=1e-9)
+
+
+@pytest.fixture
+def mixer():
+    pg.mixer.init()
+    return pg.mixer.get_init()
+
+
+@pytest.mark.parametrize("kind", GENERATORS)
+def test_blocks_are_float_frames(mixer, kind):
+    frequency, size, channels = mixer
+    block = NoiseGenerator(kind, seed=1).read(5000)
+    assert block.shape == (5000, channels)
+    assert block.dtype == np.float32
+
+
+@pytest.mark.parametrize("kind", GENERATORS)
+def test_output_stays_bounded(mixer, kind):
+    generator = NoiseGenerator(kind, seed=1)
+    frequency = mixer[0]
+    blocks = [generator.read(frequency // 4) for _ in range(4 * 20)]
+    noise = np.concatenate(blocks)
+    # Gaussian peaks now and then go past 1 and get clipped by the mixer, a filter running away goes far beyond
+    assert np.abs(noise).max() < 8 * LEVEL
+    # Same loudness for every colour, and no drift away from zero
+    assert LEVEL / 2 < noise.std() < LEVEL * 2
+    assert abs(noise[-frequency:].mean()) < LEVEL / 2
+
+
+@pytest.mark.parametrize("kind", GENERATORS)
+def test_seeded_generators_repeat(mixer, kind):
+    first = NoiseGenerator(kind, seed=7).read(3000)
+    second = NoiseGenerator(kind, seed=7)
+    # Block boundaries don't change the sound
+    assert np.array_equal(first, np.concatenate([second.read(1000), second.read(2000)]))
@@ -0,0 +1,53 @@
+import time
+
+import pynput
+
+from stimulant_noise.settings import HotkeySettings
+from stimulant_noise.hotkeys import Hotkeys, ACTIONS
+from stimulant_noise.commands import CommandQueue, move_preset
+
+
+def test_capture_times_out_after_no_key_activity(workdir):
+    hotkeys = Hotkeys(HotkeySettings(), None, CommandQueue())
+    events = []
+    hotkeys.add_capture_listener(events.append)
+    hotkeys.start_capture('mute', timeout=0.2)
+
+    # Keys pressed but not let go yet, the capture isn't finished and keeps going past the timeout
+    for char in "abcd":
+        time.sleep(0.1)
+        hotkeys.on_press(pynput.keyboard.KeyCode.from_char(char))
+    assert hotkeys.which == 'mute'
+
+    time.sleep(0.4)
+    assert not hotkeys.which
+    assert events[-1]['state'] == 'timeout'
+    assert events[-1]['which'] == 'mute'
+
+
+def test_cancelled_capture_does_not_time_out(workdir):
+    hotkeys = Hotkeys(HotkeySettings(), None, CommandQueue())
+    events = []
+    hotkeys.add_capture_listener(events.append)
+    hotkeys.start_capture('mute', timeout=0.05)
+    hotkeys.cancel_capture()
+    time.sleep(0.15)
+    assert [event['state'] for event in events] == ['capturing', 'cancelled']
+
+
+def test_held_hotkey_fires_once_per_press(workdir):
+    command_queue = CommandQueue()
+    hotkeys = Hotkeys(HotkeySettings(), None, command_queue)
+    # An ordinary key, the dummy pynput backend has every special key share one code
+    hotkeys.dispatch = {frozenset({ord('n')}): ACTIONS['next']}
+    key = pynput.keyboard.KeyCode.from_char('n')
+    # OS auto-repeat sends a press per repeat
+    for _ in range(10):
+        hotkeys.on_press(key)
+    hotkeys.on_release(key)
+    hotkeys.on_press(key)
+    hotkeys.on_release(key)
+    # Two presses, merged by the queue since nothing handled the first yet
+    assert command_queue.get() == move_preset(2)
+    assert command_queue.empty()
+    assert hotkeys.repeats_suppressed == 9
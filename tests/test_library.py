@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from stimulant_noise.library import PresetLibrary, LibraryPresetsManagerSettings
+
+
+@pytest.fixture
+def library(internal_settings):
+    library = PresetLibrary("presets.sqlite3")
+    yield library
+    library.close()
+
+
+def test_preset_saves_its_row(library, internal_settings):
+    presets_manager_settings = LibraryPresetsManagerSettings(library, internal_settings=internal_settings)
+    presets_manager_settings.add_preset("Rain")
+    preset_settings = presets_manager_settings.open_preset("Rain")
+    assert not preset_settings.dirty and preset_settings.writes_done == 0
+    preset_settings.add_sound(os.path.join("sounds", "a.wav"), volume=30, mute=False)
+    preset_settings.save()
+    preset_settings.flush()
+    assert preset_settings.writes_done == 1
+    assert library.load_preset("Rain")["sounds"]["a.wav"]["volume"] == 30
+    # Nothing changed since, nothing written
+    preset_settings.flush()
+    assert preset_settings.writes_done == 1
+
+
+def test_removing_the_last_preset_clears_current(library, internal_settings):
+    presets_manager_settings = LibraryPresetsManagerSettings(library, internal_settings=internal_settings)
+    presets_manager_settings.add_preset("Rain")
+    presets_manager_settings.set_current_preset("Rain")
+    presets_manager_settings.flush()
+    presets_manager_settings.remove_preset("Rain")
+    presets_manager_settings.flush()
+    assert presets_manager_settings.settings["current_preset"] == "None"
+    assert library.get_state("current_preset") == "None"
+    assert LibraryPresetsManagerSettings(library, internal_settings=internal_settings).settings["presets_order"] == []
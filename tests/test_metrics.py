@@ -0,0 +1,57 @@
+import pytest
+
+from stimulant_noise.metrics import Histogram, Metrics, BUCKETS
+
+
+def bucket_of(seconds):
+    histogram = Histogram()
+    histogram.record(seconds)
+    return histogram.buckets.index(1)
+
+
+def test_buckets_are_half_octaves_of_microseconds():
+    # Bucket b holds [2^((b - 1) / 2), 2^(b / 2)) microseconds
+    assert bucket_of(1.0e-6) == 1
+    assert bucket_of(1.40e-6) == 1
+    assert bucket_of(1.42e-6) == 2
+    assert bucket_of(1.99e-6) == 2
+    assert bucket_of(2.01e-6) == 3
+    assert bucket_of(2.80e-6) == 3
+    assert bucket_of(2.85e-6) == 4
+    assert bucket_of(0.001) == 20
+    # Nothing falls off either end
+    assert bucket_of(0.0) == 0
+    assert bucket_of(1e-9) == 0
+    assert bucket_of(1e9) == BUCKETS - 1
+
+
+def test_counts_and_percentiles():
+    histogram = Histogram()
+    for seconds in [0.001] * 90 + [0.1] * 10:
+        histogram.record(seconds)
+    assert histogram.count == 100
+    assert sum(histogram.buckets) == 100
+    assert histogram.buckets[20] == 90
+    assert histogram.buckets[bucket_of(0.1)] == 10
+    snapshot = histogram.snapshot()
+    # Upper edge of the sample's bucket (2^10 microseconds), capped by the largest sample
+    assert snapshot["p50_ms"] == snapshot["p90_ms"] == pytest.approx(1.024)
+    assert snapshot["p99_ms"] == snapshot["max_ms"] == 100.0
+    assert abs(snapshot["mean_ms"] - 10.9) < 1e-9
+
+
+def test_metrics_snapshot():
+    metrics = Metrics(enabled=True)
+    assert metrics.snapshot()["latency"] == {}
+    metrics.record("b", 0.002)
+    metrics.record("a", 0.001)
+    metrics.record("a", 0.003)
+    metrics.gauge("bytes", lambda: 42)
+    metrics.gauge("broken", lambda: 1 / 0)
+    snapshot = metrics.snapshot()
+    assert list(snapshot["latency"]) == ["a", "b"]
+    assert snapshot["latency"]["a"]["count"] == 2
+    assert snapshot["gauges"]["bytes"] == 42
+    assert "ZeroDivisionError" in snapshot["gauges"]["broken"]
+    metrics.reset()
+    assert metrics.snapshot()["latency"] == {}
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pygame as pg
+import pytest
+
+from conftest import make_preset, sound, write_sound
+from stimulant_noise.mixdown import MixdownCache
+from stimulant_noise.mixer import load_array
+from stimulant_noise.sound_cache import SoundCache
+
+
+@pytest.fixture
+def mixdowns(workdir):
+    pg.mixer.init()
+    return MixdownCache("mixdown_cache", SoundCache())
+
+
+def test_changed_preset_drops_the_old_render(mixdowns):
+    preset = make_preset("Rain", {"a.wav": sound("sounds/a.wav", volume=40)})
+    old_key = mixdowns.prepare(preset)
+    assert os.path.exists(mixdowns.path(old_key))
+    preset.sounds["a.wav"]["volume"] = 60
+    new_key = mixdowns.prepare(preset)
+    assert new_key != old_key
+    assert not os.path.exists(mixdowns.path(old_key))
+    assert os.path.exists(mixdowns.path(new_key))
+    assert old_key not in mixdowns.loaded
+
+
+def test_render_shared_with_another_preset_is_kept(mixdowns):
+    preset = make_preset("Rain", {"a.wav": sound("sounds/a.wav", volume=40)})
+    copy = make_preset("Rain copy", {"a.wav": sound("sounds/a.wav", volume=40)})
+    old_key = mixdowns.prepare(preset)
+    assert mixdowns.prepare(copy) == old_key
+    preset.sounds["a.wav"]["volume"] = 60
+    mixdowns.prepare(preset)
+    assert os.path.exists(mixdowns.path(old_key))
+
+
+def test_shorter_layer_loops_without_a_jump(mixdowns):
+    # Silent 0.73 s layer sets the length, the 0.5 s sine gets cut partway through its second pass
+    write_sound("sounds/long.wav", seconds=0.73, pitch=0)
+    preset = make_preset("Rain", {"a.wav": sound("sounds/a.wav", volume=100),
+                                  "long.wav": sound("sounds/long.wav", volume=100)})
+    mix = mixdowns.render(preset)
+    short = load_array("sounds/a.wav")
+    assert len(mix) == len(load_array("sounds/long.wav"))
+    assert len(mix) % len(short)
+    # Looping back to the mixdown's start is the short layer going from its end back to its start
+    assert np.abs(mix[-1].astype(np.int32) - short[-1]).max() <= 2
+    assert np.abs(mix[0].astype(np.int32) - short[0]).max() <= 2
+
+
+def test_pinned_mixdown_outlives_prefetched_ones(workdir):
+    pg.mixer.init()
+    mixdowns = MixdownCache("mixdown_cache", SoundCache(), loaded_max=1)
+    current = make_preset("Current", {"a.wav": sound("sounds/a.wav")})
+    key = mixdowns.prepare(current, pin=True)
+    # Neighbours prepared by the prefetcher before Audio gets to layer()
+    mixdowns.prepare(make_preset("Next", {"b.wav": sound("sounds/b.wav")}))
+    mixdowns.prepare(make_preset("Previous", {"c.wav": sound("sounds/c.wav")}))
+    assert mixdowns.layer(key) is not None
+    assert len(mixdowns.loaded) == 1
@@ -0,0 +1,83 @@
+import threading
+
+import numpy as np
+import pygame as pg
+import pytest
+
+from stimulant_noise.mixer import SoftwareMixer, MixerLayer, ArraySource
+
+
+class BlockingSource:
+    # Holds the pump inside read() until told to go on
+    def __init__(self):
+        self.entered = threading.Event()
+        self.go = threading.Event()
+        self.closed = False
+        self.closed_while_reading = False
+
+    def read(self, frames):
+        self.entered.set()
+        self.go.wait(2.0)
+        self.closed_while_reading = self.closed
+        return np.zeros((frames, 2), dtype=np.float32)
+
+    def skip(self, frames):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def software_mixer():
+    pg.mixer.init()
+    software_mixer = SoftwareMixer()
+    yield software_mixer
+    software_mixer.stop()
+
+
+def test_stop_during_read_closes_after_the_block(software_mixer):
+    source = BlockingSource()
+    layer = MixerLayer(software_mixer, lambda: source)
+    layer.play()
+    reading = threading.Thread(target=software_mixer.read, args=(64,))
+    reading.start()
+    assert source.entered.wait(2.0)
+    layer.stop()
+    assert not source.closed
+    source.go.set()
+    reading.join()
+    assert not source.closed_while_reading
+    software_mixer.read(64)
+    assert source.closed
+
+
+def test_stop_while_pump_reads(software_mixer):
+    # Muted layers go through skip(), which used to hit a closed source's array=None
+    array = (np.arange(4096, dtype=np.int16).reshape(-1, 2) % 1000)
+    layers = [MixerLayer(software_mixer, lambda: ArraySource(array)) for index in range(4)]
+    for index, layer in enumerate(layers):
+        layer.set_volume(0.0 if index % 2 else 0.5)
+    errors = []
+    done = threading.Event()
+
+    def pump():
+        try:
+            while not done.is_set():
+                software_mixer.read(256)
+        except Exception as e:
+            errors.append(e)
+
+    reading = threading.Thread(target=pump)
+    reading.start()
+    try:
+        for repeat in range(500):
+            for layer in layers:
+                layer.play()
+            for layer in layers:
+                layer.stop()
+    finally:
+        done.set()
+        reading.join()
+    assert errors == []
+    assert software_mixer.layers == []
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pygame as pg
+import pytest
+
+from conftest import write_sound
+from stimulant_noise.pcm_cache import PcmCache, main
+
+
+@pytest.fixture
+def pcm_cache(workdir):
+    pg.mixer.init()
+    return PcmCache("pcm_cache")
+
+
+def cached_files(cache_dir):
+    return sorted(name for name in os.listdir(cache_dir) if name.endswith(".pcm"))
+
+
+def test_cached_samples_match_the_decoded_ones(pcm_cache):
+    path = os.path.join("sounds", "a.wav")
+    decoded = pcm_cache.load_array(path)
+    mapped = pcm_cache.load_array(path)
+    assert np.array_equal(decoded, mapped)
+    assert pcm_cache.load_sound(path).get_raw() == pg.mixer.Sound(path).get_raw()
+    assert pcm_cache.stats() == {"hits": 2, "misses": 1, "evictions": 0}
+
+
+def test_key_follows_the_file_and_the_mixer_format(pcm_cache, monkeypatch):
+    path = os.path.join("sounds", "a.wav")
+    key = pcm_cache.key(path)
+    assert pcm_cache.key(path) == key
+
+    stat = os.stat(path)
+    os.utime(path, (stat.st_atime, stat.st_mtime - 10))
+    moved = pcm_cache.key(path)
+    assert moved != key
+
+    write_sound(path, seconds=0.25)
+    os.utime(path, (stat.st_atime, stat.st_mtime - 10))
+    assert pcm_cache.key(path) not in (key, moved)
+
+    frequency, size, channels = pg.mixer.get_init()
+    resized = pcm_cache.key(path)
+    monkeypatch.setattr(pg.mixer, "get_init", lambda: (frequency // 2, size, channels))
+    assert pcm_cache.key(path) != resized
+
+
+def test_least_recently_used_files_are_evicted(pcm_cache):
+    paths = [os.path.join("sounds", f"{name}.wav") for name in ("a", "b", "c")]
+    pcm_cache.warm(paths[0])
+    file_bytes = os.path.getsize(pcm_cache.path(pcm_cache.key(paths[0])))
+    pcm_cache.max_bytes = 2 * file_bytes
+    pcm_cache.warm(paths[1])
+    for age, path in enumerate(paths[:2]):
+        os.utime(pcm_cache.path(pcm_cache.key(path)), (1000 + age, 1000 + age))
+    # Used again, so b is now the oldest
+    pcm_cache.open(paths[0]).close()
+    pcm_cache.warm(paths[2])
+
+    assert cached_files("pcm_cache") == sorted(os.path.basename(pcm_cache.path(pcm_cache.key(path)))
+                                               for path in (paths[0], paths[2]))
+    assert sum(os.path.getsize(os.path.join("pcm_cache", name)) for name in cached_files("pcm_cache")) \
+        <= pcm_cache.max_bytes
+    assert pcm_cache.stats()["evictions"] == 1
+
+
+def test_warm_decodes_every_library_sound_once(preset_files, internal_settings, capsys):
+    assert main(["pcm_cache", "warm"]) == 0
+    assert "Decoded 3 sounds" in capsys.readouterr().out
+    assert len(cached_files(internal_settings.pcm_cache_dir)) == 3
+    assert main(["pcm_cache", "warm"]) == 0
+    assert "Decoded 0 sounds" in capsys.readouterr().out
+    assert main(["pcm_cache"]) == 1
@@ -0,0 +1,69 @@
+import threading
+from types import SimpleNamespace
+
+from conftest import make_preset, sound
+from stimulant_noise.prefetch import Prefetcher
+from stimulant_noise.sound_cache import SoundCache
+
+
+def decoded(path):
+    # Stands in for a decoded sound, the cache only needs its size
+    return SimpleNamespace(path=path, nbytes=1000)
+
+
+def presets_of(*sound_names):
+    presets = {f"P{index}": make_preset(f"P{index}", {name: sound(f"{name}.wav") for name in names})
+               for index, names in enumerate(sound_names)}
+    return presets, list(presets)
+
+
+def drain(prefetcher):
+    # Unlike stop(), lets every queued job run to its end first
+    prefetcher.queue.put(None)
+    prefetcher.join(2.0)
+    assert not prefetcher.is_alive()
+
+
+def test_switch_to_prefetched_neighbour_is_warm(workdir):
+    cache = SoundCache(loader=decoded)
+    prefetcher = Prefetcher(depth=1, cache=cache)
+    presets, presets_order = presets_of(("a",), ("b",), ("c",), ("d",), ("e",))
+    prefetcher.start()
+    prefetcher.prefetch_around(presets, presets_order, "P0")
+    drain(prefetcher)
+    # P1 and P4 are next to P0, P2 isn't
+    assert "b.wav" in cache and "e.wav" in cache and "c.wav" not in cache
+    assert prefetcher.prefetched == 2
+
+    prefetcher.record_switch(presets["P1"])
+    assert (prefetcher.warm_switches, prefetcher.cold_switches) == (1, 0)
+    prefetcher.record_switch(presets["P2"])
+    assert (prefetcher.warm_switches, prefetcher.cold_switches) == (1, 1)
+    assert prefetcher.stats()["prefetched"] == 2
+
+
+def test_superseded_prefetch_is_cancelled(workdir):
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow(path):
+        started.set()
+        release.wait(2.0)
+        return decoded(path)
+
+    cache = SoundCache(loader=slow)
+    prefetcher = Prefetcher(depth=1, cache=cache)
+    presets, presets_order = presets_of(("a",), ("b", "c"), ("d",), ("e",), ("f",))
+    prefetcher.start()
+    prefetcher.prefetch_around(presets, presets_order, "P0")
+    assert started.wait(2.0)
+    # The user moved on while b.wav of the first neighbourhood was decoding
+    prefetcher.prefetch_around(presets, presets_order, "P3")
+    release.set()
+    drain(prefetcher)
+    # b.wav was already being decoded, c.wav belonged only to the old neighbourhood and is dropped. The new job gets
+    # P4 and P2.
+    assert "b.wav" in cache and "c.wav" not in cache
+    assert "f.wav" in cache and "d.wav" in cache
+    assert prefetcher.prefetched == 3
+    assert prefetcher.window == {"f.wav", "d.wav"}
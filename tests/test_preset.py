@@ -0,0 +1,157 @@
+import pytest
+
+from stimulant_noise.settings import PresetsManagerSettings
+from stimulant_noise.preset import PresetsManager
+
+
+@pytest.fixture
+def presets_manager_settings(internal_settings, preset_files):
+    return PresetsManagerSettings("preset_manager_settings.json", internal_settings=internal_settings)
+
+
+def test_failed_audio_start_is_raised_to_later_callers(presets_manager_settings, monkeypatch):
+    import stimulant_noise.audio
+
+    def broken_audio(*args, **kwargs):
+        raise OSError("no audio device")
+
+    monkeypatch.setattr(stimulant_noise.audio, "Audio", broken_audio)
+    presets_manager = PresetsManager(presets_manager_settings, start_audio=False)
+    with pytest.raises(OSError):
+        presets_manager.start_audio()
+    assert presets_manager.audio_ready.is_set()
+    assert presets_manager.audio_failed
+    with pytest.raises(RuntimeError, match="no audio device"):
+        presets_manager.audio
+    with pytest.raises(RuntimeError):
+        presets_manager.prefetcher
+
+
+@pytest.fixture
+def presets_manager(presets_manager_settings):
+    presets_manager = PresetsManager(presets_manager_settings)
+    presets_manager.set_current_preset("One")
+    yield presets_manager
+    presets_manager.audio.stop()
+    presets_manager.prefetcher.stop()
+
+
+@pytest.fixture
+def worker(presets_manager):
+    from types import SimpleNamespace
+    from stimulant_noise.commands import CommandQueue
+    from stimulant_noise.stimulant_noise import StimulantNoiseThread
+
+    notified = []
+    noise_generator = SimpleNamespace(presets_manager=presets_manager, state=dict,
+                                      notify_front_ends=lambda origin=None: notified.append(origin))
+    return StimulantNoiseThread(CommandQueue(), noise_generator), notified
+
+
+def test_slider_values_apply_to_the_preset_they_were_dragged_in(worker):
+    from stimulant_noise.commands import set_preset_volume, set_sound_volume
+
+    worker, notified = worker
+    presets_manager = worker.noise_generator.presets_manager
+    slider = object()
+    command = set_preset_volume(70, preset_name="Two")
+    command['origin'] = slider
+    worker.handle(command)
+    assert presets_manager.presets["Two"].volume == 70
+    assert notified == [slider]
+
+    # The preset was switched before a sound slider value got handled
+    worker.handle(set_sound_volume("b.wav", 10, preset_name="Two"))
+    assert presets_manager.current_preset.sounds["b.wav"]['volume'] == 40
+    assert presets_manager.presets["Two"].sounds["b.wav"]['volume'] == 40
+    worker.handle(set_sound_volume("b.wav", 10, preset_name="One"))
+    assert presets_manager.current_preset.sounds["b.wav"]['volume'] == 10
+
+    # A preset removed while its slider was dragged
+    worker.handle(set_preset_volume(20, preset_name="Gone"))
+
+
+def gains(audio):
+    return {sound_name: round(audio.transitions.gains[layer.sound], 6)
+            for sound_name, layer in audio.sound_layers.items()}
+
+
+def settled(audio, timeout=2.0):
+    import time
+    deadline = time.monotonic() + timeout
+    while any(audio.transitions.is_ramping(layer.sound) for layer in audio.sound_layers.values()):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    return gains(audio)
+
+
+@pytest.fixture
+def no_reconcile(presets_manager, monkeypatch):
+    # Layers must be left alone: any full preset reconcile fails the test
+    def set_current_preset(preset):
+        raise AssertionError("layers were reconciled")
+    monkeypatch.setattr(presets_manager.audio, "set_current_preset", set_current_preset)
+    return presets_manager.audio
+
+
+def test_mute_and_unmute_only_move_gains(presets_manager, no_reconcile):
+    audio = no_reconcile
+    layers = dict(audio.sound_layers)
+    assert settled(audio) == {"a.wav": 0.2, "b.wav": 0.2}
+    presets_manager.mute_current_preset()
+    assert settled(audio) == {"a.wav": 0.0, "b.wav": 0.0}
+    presets_manager.mute_current_preset()
+    assert settled(audio) == {"a.wav": 0.2, "b.wav": 0.2}
+    assert audio.sound_layers == layers
+    assert all(layer.sound.get_num_channels() for layer in layers.values())
+
+
+def test_volume_of_another_preset_leaves_audio_alone(presets_manager, no_reconcile, monkeypatch):
+    audio = no_reconcile
+    before = settled(audio)
+    monkeypatch.setattr(audio, "set_volume", lambda volume: pytest.fail("current preset's volume was changed"))
+    presets_manager.set_preset_volume("Two", 90)
+    assert presets_manager.presets["Two"].volume == 90
+    assert settled(audio) == before
+
+
+def test_reading_presets_leaves_files_alone(internal_settings, preset_files):
+    import glob
+    import os
+    from stimulant_noise.settings import flush_all
+    from stimulant_noise.sound_cache import resolve_path, sound_cache
+
+    sound_cache.clear()
+    # Far in the past, a rewrite can't end up with the same mtime
+    preset_paths = sorted(glob.glob(os.path.join("presets", "*.json")))
+    for path in preset_paths:
+        os.utime(path, (1000000000, 1000000000))
+
+    def mtimes():
+        flush_all()
+        return [os.stat(path).st_mtime for path in preset_paths]
+
+    # First run builds preset_manager_settings.json from the preset files, the second only reads it
+    PresetsManagerSettings("preset_manager_settings.json", internal_settings=internal_settings)
+    presets_manager = PresetsManager(PresetsManagerSettings("preset_manager_settings.json",
+                                                            internal_settings=internal_settings))
+    try:
+        current = presets_manager.current_preset.name
+        assert [name for name, preset in presets_manager.presets.items() if preset.loaded] == [current]
+        assert sorted(presets_manager.presets_order) == ["One", "Three", "Two"]
+        assert mtimes() == [1000000000] * len(preset_paths)
+
+        # Only the preset that goes live gets its sounds decoded
+        def paths(preset):
+            return {resolve_path(sound_settings['path']) for sound_settings in preset.sounds.values()}
+
+        assert set(sound_cache.entries) == paths(presets_manager.current_preset)
+        other = presets_manager.presets[next(name for name in presets_manager.presets_order if name != current)]
+        assert not other.loaded
+        presets_manager.set_current_preset(other.name)
+        assert other.loaded
+        assert paths(other) <= set(sound_cache.entries)
+        assert mtimes() == [1000000000] * len(preset_paths)
+    finally:
+        presets_manager.audio.stop()
+        presets_manager.prefetcher.stop()
@@ -0,0 +1,53 @@
+import json
+
+import pynput
+import pytest
+
+from stimulant_noise.pressed_keys import PressedKeys, parse_legacy, key_code, is_modifier
+from stimulant_noise.settings import HotkeySettings, flush_all
+from stimulant_noise.hotkeys import Hotkeys
+from stimulant_noise.commands import CommandQueue
+
+Key = pynput.keyboard.Key
+KeyCode = pynput.keyboard.KeyCode
+
+
+@pytest.mark.parametrize("hashed, parsed", [
+    ("{<Key.ctrl_l: <162>>, <Key.shift: <160>>} + '\\x0e'", {'modifiers': ['ctrl_l', 'shift'], 'key': '\x0e'}),
+    ("{<Key.up: <38>>} + None", {'modifiers': ['up'], 'key': None}),
+    ("set() + <65>", {'modifiers': [], 'key': 65}),
+    ("{<Key.alt_gr: <165>>} + ['^']", {'modifiers': ['alt_gr'], 'key': '^'}),
+    ("{<Key.cmd: <91>>} + '+'", {'modifiers': ['cmd'], 'key': '+'}),
+])
+def test_parse_legacy_keeps_every_key(hashed, parsed):
+    assert parse_legacy(hashed) == parsed
+
+
+def chord_of(*keys):
+    pressed_keys = PressedKeys()
+    for key in keys:
+        if is_modifier(key):
+            pressed_keys.add_modifier(key_code(key))
+        else:
+            pressed_keys.set_key(key_code(key))
+    return pressed_keys.chord
+
+
+def test_legacy_hotkey_settings_are_migrated_to_the_same_chords(workdir):
+    legacy = {
+        "mute": "{<Key.ctrl_l: <162>>, <Key.shift: <160>>} + '\\r'",
+        "next": "{<Key.ctrl_l: <162>>, <Key.shift: <160>>} + '\\x0e'",
+        "previous": "{<Key.up: <38>>} + None",
+    }
+    with open("hotkey_settings.json", "w") as f:
+        json.dump(legacy, f)
+    hotkey_settings = HotkeySettings()
+    flush_all()
+    with open("hotkey_settings.json") as f:
+        saved = json.load(f)
+    assert saved == {which: parse_legacy(hashed) for which, hashed in legacy.items()}
+
+    # The keys the listener reports for the old hotkeys still fire them
+    hotkeys = Hotkeys(hotkey_settings, None, CommandQueue())
+    assert hotkeys.bindings['next'].chord == chord_of(Key.ctrl_l, Key.shift, KeyCode.from_char('\x0e'))
+    assert hotkeys.bindings['previous'].chord == chord_of(Key.up)
@@ -0,0 +1,34 @@
+import os
+import json
+import threading
+
+from stimulant_noise.settings import PresetSettings
+
+
+def open_preset(internal_settings, name="Preset"):
+    return PresetSettings(os.path.join("presets", f"{name}.json"), internal_settings=internal_settings)
+
+
+def test_changes_wait_for_a_write_in_progress(internal_settings):
+    preset_settings = open_preset(internal_settings)
+    # Held the way flush() holds it while serialising
+    with preset_settings.lock:
+        adding = threading.Thread(target=preset_settings.add_sound, args=(os.path.join("sounds", "a.wav"),))
+        adding.start()
+        adding.join(0.1)
+        assert adding.is_alive()
+        assert preset_settings.settings["sounds"] == {}
+    adding.join()
+    assert list(preset_settings.settings["sounds"]) == ["a.wav"]
+
+
+def test_write_behind_writes_once(internal_settings):
+    preset_settings = open_preset(internal_settings)
+    writes = preset_settings.writes_done
+    for volume in range(20):
+        preset_settings.set_volume(volume)
+        preset_settings.save()
+    preset_settings.flush()
+    assert preset_settings.writes_done == writes + 1
+    with open(preset_settings.settings_file_location) as f:
+        assert json.load(f)["volume"] == 19
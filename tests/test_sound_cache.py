@@ -0,0 +1,33 @@
+import os
+
+import pygame as pg
+
+from stimulant_noise.sound_cache import SoundCache, sound_size
+
+
+def test_least_recently_used_sounds_go_over_budget(workdir):
+    pg.mixer.init()
+    paths = [os.path.join("sounds", f"{name}.wav") for name in ("a", "b", "c")]
+    cache = SoundCache()
+    size = sound_size(cache.get(paths[0]))
+    # Room for two sounds
+    cache.set_budget(2 * size + size // 2)
+
+    cache.get(paths[1])
+    assert cache.get(paths[0]) is cache.get(paths[0])
+    # b is now the least recently used one
+    cache.get(paths[2])
+    assert paths[0] in cache and paths[2] in cache and paths[1] not in cache
+    assert cache.stats() == {"hits": 2, "misses": 3, "evictions": 1, "bytes": 2 * size, "budget": 2 * size + size // 2,
+                             "sounds": 2}
+
+    # Decoded again, pushing out a this time
+    cache.get(paths[1])
+    assert paths[0] not in cache
+    assert cache.stats()["misses"] == 4 and cache.stats()["evictions"] == 2
+
+    # Shrinking the budget evicts right away, the sound just loaded stays even when it alone is over budget
+    cache.set_budget(size // 2)
+    assert cache.stats()["sounds"] == 0 and cache.stats()["evictions"] == 4
+    cache.get(paths[0])
+    assert paths[0] in cache and cache.stats()["bytes"] == size
@@ -0,0 +1,71 @@
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from stimulant_noise.commands import set_sound_volume
+from stimulant_noise.throttle import Throttle
+
+
+def test_slider_values_pending_at_stop_are_saved(preset_files, monkeypatch):
+    from stimulant_noise.hotkeys import Hotkeys
+    from stimulant_noise.stimulant_noise import StimulantNoise
+
+    # The dummy pynput backend has no keyboard hook to run
+    monkeypatch.setattr(Hotkeys, "run", lambda self: None)
+    stimulant_noise = StimulantNoise(headless=True)
+    stimulant_noise.queue.join()
+    preset_name = stimulant_noise.presets_manager.current_preset.name
+    sound_name = next(iter(stimulant_noise.presets_manager.current_preset.sounds))
+    # Stands in for the GUI: its throttle posts slider values as commands and is flushed by stop()
+    throttle = Throttle(lambda key, value: stimulant_noise.queue.put(set_sound_volume(key, value,
+                                                                                     preset_name=preset_name)),
+                        rate=1)
+    throttle.start()
+    stimulant_noise.gui = SimpleNamespace(stop=throttle.stop)
+    throttle.submit(sound_name, 10)
+    throttle.submit(sound_name, 77)
+    stimulant_noise.queue.put({'name': 'stop'})
+    stimulant_noise.worker.join(5.0)
+    assert not stimulant_noise.worker.is_alive()
+
+    with open(os.path.join("presets", f"{preset_name}.json")) as f:
+        assert json.load(f)["sounds"][sound_name]["volume"] == 77
+
+
+def test_handle_replies_and_records_latency(monkeypatch):
+    from stimulant_noise.metrics import metrics
+    from stimulant_noise.stimulant_noise import StimulantNoiseThread
+
+    monkeypatch.setattr(metrics, "enabled", True)
+    monkeypatch.setattr(metrics, "histograms", {})
+    worker = StimulantNoiseThread(None, SimpleNamespace(state=lambda: {'preset': "One"}))
+
+    def broken(command):
+        raise ValueError("broken")
+
+    worker.register('broken', broken)
+    replies = []
+    worker.handle({'name': 'get_state', 'reply': replies.append})
+    worker.handle({'name': 'get_state'})
+    worker.handle({'name': 'broken', 'reply': replies.append})
+    worker.handle({'name': 'unknown', 'reply': replies.append})
+    assert replies == [{'ok': True, 'state': {'preset': "One"}}, {'ok': False, 'error': "broken"},
+                       {'ok': False, 'error': "Unknown command unknown"}]
+
+    # A stopped worker has no state left to answer with
+    worker.stop()
+    worker.handle({'name': 'get_state', 'reply': replies.append})
+    assert replies[-1] == {'ok': True}
+
+    # Unknown commands are never handled, so they aren't counted
+    stats = worker.stats()
+    assert stats['commands_processed'] == 4
+    assert set(stats['latency']) == {'get_state', 'broken'}
+    assert stats['latency']['get_state']['count'] == 3
+    latency = stats['latency']['get_state']
+    assert 0 <= latency['mean'] <= latency['max'] and latency['total'] == pytest.approx(3 * latency['mean'])
+    assert metrics.histograms['command.get_state'].count == 3
+    assert metrics.histograms['command.broken'].count == 1
+    assert 'command.unknown' not in metrics.histograms
@@ -0,0 +1,74 @@
+import time
+import threading
+
+import pygame as pg
+
+import stimulant_noise.streaming
+from stimulant_noise.streaming import StreamPump, StreamingSound, free_channel, stop_stream_pump
+
+
+class FakeStream:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.pumped = threading.Event()
+        self.pumps = 0
+
+    def pump(self):
+        self.pumps += 1
+        self.pumped.set()
+        if self.fail:
+            raise OSError("unreadable")
+
+
+def test_failing_stream_is_dropped_and_the_rest_keep_playing():
+    pump = StreamPump(interval=0.001)
+    pump.start()
+    broken, healthy = FakeStream(fail=True), FakeStream()
+    pump.add(broken)
+    pump.add(healthy)
+    assert broken.pumped.wait(1.0)
+    time.sleep(0.05)
+    assert broken not in pump.streams
+    assert broken.pumps == 1
+    pumps = healthy.pumps
+    time.sleep(0.05)
+    assert healthy.pumps > pumps
+    pump.stop()
+    pump.join(1.0)
+    assert not pump.is_alive()
+
+
+def test_free_channel_never_steals_a_busy_one(workdir):
+    pg.mixer.init()
+    pg.mixer.set_num_channels(2)
+    sound = pg.mixer.Sound("sounds/a.wav")
+    busy = [pg.mixer.Channel(channel) for channel in range(2)]
+    for channel in busy:
+        channel.play(sound, loops=-1)
+    try:
+        assert all(channel.get_busy() for channel in busy)
+        channel = free_channel()
+        assert pg.mixer.get_num_channels() == 3
+        assert channel.get_busy() is False
+        assert all(channel.get_busy() for channel in busy)
+    finally:
+        pg.mixer.stop()
+        pg.mixer.set_num_channels(8)
+
+
+def test_stop_does_not_start_a_pump(workdir):
+    pg.mixer.init()
+    stop_stream_pump()
+    stream = StreamingSound("sounds/a.wav")
+    stream.stop()
+    assert stimulant_noise.streaming.stream_pump is None
+
+    stream.play(loops=-1)
+    pump = stimulant_noise.streaming.stream_pump
+    assert stream in pump.streams
+    stream.stop()
+    assert stream not in pump.streams
+    stop_stream_pump()
+    # After shutdown, e.g. a layer released late
+    stream.stop()
+    assert stimulant_noise.streaming.stream_pump is None
@@ -0,0 +1,38 @@
+import threading
+
+from stimulant_noise.transitions import TransitionEngine
+
+
+class FakeSound:
+    def __init__(self):
+        self.volume = 1.0
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    def get_volume(self):
+        return self.volume
+
+
+def test_on_done_runs_without_the_condition():
+    engine = TransitionEngine(interval=0.005)
+    engine.start()
+    done = threading.Event()
+    free = []
+
+    def on_done():
+        # Another thread can ask for ramps while the callback runs
+        def acquire():
+            free.append(engine.condition.acquire(timeout=1.0))
+            engine.condition.release()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        done.set()
+
+    try:
+        engine.fade_out(FakeSound(), on_done=on_done, duration=0.02)
+        assert done.wait(2.0)
+        assert free == [True]
+    finally:
+        engine.stop()